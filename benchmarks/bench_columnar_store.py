@@ -0,0 +1,113 @@
+"""
+####################
+bench_columnar_store.py
+####################
+Compares resident memory and pickle size of the default ``Bunch`` backed node/edge
+data with the array-backed ``ColumnStore`` backend on a synthetic graph.
+
+Each backend is built in its own process so the memory numbers do not mix::
+
+    python benchmarks/bench_columnar_store.py --nodes 100000
+"""
+import argparse
+import cPickle
+import gc
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from gfunc.data_classes import GFuncNode
+from gfunc.data_classes import GFuncEdge
+from gfunc.data_classes import ColumnStore
+from gfunc.xpermutations import xuniqueCombinations
+
+
+def current_rss_mb():
+    """
+    Returns the resident set size of this process in MB (Linux only).
+    """
+    rss_pages = int(open('/proc/self/statm').read().split()[1])
+    return rss_pages * os.sysconf('SC_PAGE_SIZE') / 1024.0**2
+
+def build_synthetic_registries(node_count,species_count,vector_len,columnar,seed=0):
+    """
+    *GIVEN:*
+        * ``node_count``: total number of nodes
+        * ``species_count``: nodes are grouped into N-way 1:1 ortholog sets of this size
+        * ``vector_len``: length of each node's expression vector
+        * ``columnar``: use ``ColumnStore`` backends if ``True``
+    *RETURNS:*
+        * ``(node_dict,edge_dict,stores)``
+    """
+    rand = np.random.RandomState(seed)
+    node_store = ColumnStore() if columnar else None
+    edge_store = ColumnStore() if columnar else None
+
+    node_dict = {}
+    edge_dict = {}
+    for set_i in range(node_count // species_count):
+        names = []
+        for sp_i in range(species_count):
+            name = 'SP%s_%08d' % (sp_i,set_i)
+            node = GFuncNode(name=name,species='species %s' % (sp_i),graph=None,store=node_store)
+            node.set_data(rand.gamma(2,3,size=vector_len),'expression_vector')
+            node_dict[name] = node
+            names.append(name)
+
+        for name1,name2 in xuniqueCombinations(names,2):
+            edge = GFuncEdge(node_dict[name1],node_dict[name2],store=edge_store)
+            edge.data.one_to_one_ortholog = True
+            edge.data.divergence = (rand.rand(),0.0,1.0)
+            edge.data.PTCI = rand.rand()
+            edge_dict[edge.key] = edge
+
+    return node_dict,edge_dict,(node_store,edge_store)
+
+def run_backend(args,columnar,results):
+    """
+    Builds one backend and puts its measurements in ``results``.
+    """
+    gc.collect()
+    rss_before = current_rss_mb()
+    t0 = time.time()
+    registries = build_synthetic_registries(args.nodes,args.species,args.vector_len,columnar)
+    build_secs = time.time() - t0
+    gc.collect()
+    rss_after = current_rss_mb()
+
+    t0 = time.time()
+    pickle_bytes = len(cPickle.dumps(registries,protocol=2))
+    pickle_secs = time.time() - t0
+
+    results.put(('columnar' if columnar else 'bunch',
+                 len(registries[0]),len(registries[1]),
+                 rss_after-rss_before,pickle_bytes/1024.0**2,build_secs,pickle_secs))
+
+def main():
+    """
+    Runs both backends and prints a comparison table.
+    """
+    desc = """Memory benchmark: Bunch vs ColumnStore node/edge data backends."""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--nodes', type=int, default=100000,
+                        help="""Number of synthetic nodes. (default = %(default)s)""")
+    parser.add_argument('--species', type=int, default=3,
+                        help="""Size of each synthetic N-way ortholog set. (default = %(default)s)""")
+    parser.add_argument('--vector-len', type=int, default=12,
+                        help="""Length of each expression vector. (default = %(default)s)""")
+    args = parser.parse_args()
+
+    results = multiprocessing.Queue()
+    print "backend\tnodes\tedges\trss_MB\tpickle_MB\tbuild_s\tpickle_s"
+    for columnar in (False,True):
+        proc = multiprocessing.Process(target=run_backend,args=(args,columnar,results))
+        proc.start()
+        row = results.get()
+        proc.join()
+        print "%s\t%d\t%d\t%.1f\t%.1f\t%.2f\t%.2f" % row
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+####################
+bench_hypergeo.py
+####################
+Checks the accuracy and speed of the vectorized log-gamma ``stats.hypergeo_sf`` against
+the exact integer ``stats.exact_hypergeo_sf`` (and the original ``cumHypergeoP`` on a
+small subset) for random enrichment-style ``(n,i,m,N)`` queries::
+
+    python benchmarks/bench_hypergeo.py --queries 2000 --population 20000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from gfunc.stats import cumHypergeoP
+from gfunc.stats import exact_hypergeo_sf
+from gfunc.stats import hypergeo_sf
+
+
+def random_queries(count,population,seed=0):
+    """
+    Returns int array of ``count`` random ``(n,i,m,N)`` rows with ``n+m <= population``.
+    """
+    rand = np.random.RandomState(seed)
+    queries = []
+    for q in range(count):
+        total = rand.randint(2,population+1)
+        n = rand.randint(0,min(total,population//10)+1)
+        N = rand.randint(0,min(total,population//5)+1)
+        i = rand.randint(0,min(n,N)+2)
+        queries.append((n,i,total-n,N))
+    return np.array(queries,dtype=np.int64)
+
+def main():
+    """
+    Prints timings and the worst relative error of the vectorized p-values.
+    """
+    desc = """Accuracy/speed check: vectorized log-gamma hypergeometric vs exact arithmetic."""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--queries', type=int, default=2000,
+                        help="""Number of random (n,i,m,N) queries. (default = %(default)s)""")
+    parser.add_argument('--population', type=int, default=20000,
+                        help="""Largest population size n+m. (default = %(default)s)""")
+    parser.add_argument('--cum-subset', type=int, default=50,
+                        help="""Number of queries also run through the original cumHypergeoP. (default = %(default)s)""")
+    args = parser.parse_args()
+
+    queries = random_queries(args.queries,args.population)
+    n,i,m,N = queries.T
+
+    t0 = time.time()
+    approx = hypergeo_sf(n,i,m,N,exact_below=None)
+    vec_secs = time.time() - t0
+
+    t0 = time.time()
+    exact = np.array([exact_hypergeo_sf(*[int(x) for x in q]) for q in queries])
+    exact_secs = time.time() - t0
+
+    t0 = time.time()
+    with_fallback = hypergeo_sf(n,i,m,N)
+    fallback_secs = time.time() - t0
+
+    representable = exact > 1e-300
+    rel_err = np.abs(approx[representable]-exact[representable])/exact[representable]
+    rel_err_fallback = np.abs(with_fallback[representable]-exact[representable])/exact[representable]
+
+    # cumHypergeoP overflows float for large populations: those queries are skipped
+    subset = queries[:args.cum_subset]
+    cum = np.empty(len(subset))
+    cum.fill(np.nan)
+    t0 = time.time()
+    for q_i,q in enumerate(subset):
+        try:
+            cum[q_i] = cumHypergeoP(*[int(x) for x in q])
+        except OverflowError:
+            pass
+    cum_secs = time.time() - t0
+    ran = ~np.isnan(cum)
+    cum_err = np.abs(approx[:len(subset)][ran]-cum[ran])/np.maximum(cum[ran],1e-300)
+
+    print "method\tqueries\tsecs"
+    print "hypergeo_sf(exact_below=None)\t%d\t%.3f" % (len(queries),vec_secs)
+    print "hypergeo_sf(default fallback)\t%d\t%.3f" % (len(queries),fallback_secs)
+    print "exact_hypergeo_sf\t%d\t%.3f" % (len(queries),exact_secs)
+    print "cumHypergeoP\t%d\t%.3f" % (len(subset),cum_secs)
+    print
+    print "max relative error vs exact (vectorized only): %.3g" % (rel_err.max())
+    print "max relative error vs exact (with fallback):   %.3g" % (rel_err_fallback.max())
+    print "max relative error vs cumHypergeoP subset:     %.3g (%d of %d overflowed)" % (cum_err.max() if ran.any() else np.nan,(~ran).sum(),len(subset))
+    print "underflow agreement (exact < 1e-300 -> approx < 1e-290): %s" % ((approx[~representable] < 1e-290).all())
+
+if __name__ == '__main__':
+    main()
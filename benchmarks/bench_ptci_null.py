@@ -0,0 +1,131 @@
+"""
+####################
+bench_ptci_null.py
+####################
+Compares building a randomized ortholog-set PTCI null by looping over
+``reset_random_edges()``, ``measure_relations()`` and ``get_ortho_set_PTCIs()`` with the
+graph free ``gfunc.fdr.ptci_null()`` engine on a synthetic N-way 1:1 ortholog table::
+
+    python benchmarks/bench_ptci_null.py --sets 10000 --reps 5 --processes 4
+"""
+import argparse
+import os
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas
+
+from gfunc.analysis_classes import PhyloExpnCorrelationIndex
+from gfunc.analysis_classes import RelationsHandler
+from gfunc.fdr import ortho_set_ptcis
+from gfunc.fdr import ptci_null
+from gfunc.graphTools import GraphBuilder
+from gfunc.parsers.edge_lists import OneToOneOrthoListParser
+from gfunc.scripts.gfunc_build_n_way_one2one import get_ortho_set_PTCIs
+from gfunc.scripts.gfunc_build_n_way_one2one import ortho_set_arrays
+from gfunc.scripts.gfunc_build_n_way_one2one import reset_random_edges
+
+
+SPECIES = ('Anopheles_gambiae','Culex_quinquefasciatus','Aedes_aegypti')
+DIVERGENCE = {('Anopheles gambiae','Culex quinquefasciatus'):145.0,
+              ('Anopheles gambiae','Aedes aegypti'):145.0,
+              ('Culex quinquefasciatus','Aedes aegypti'):52.0}
+
+def write_synthetic_ortho_table(path,sets):
+    """
+    Writes a tab delimited N-way 1:1 ortholog table with one column per species.
+    """
+    out_file = open(path,'w')
+    out_file.write('%s\n' % ('\t'.join(SPECIES)))
+    for set_i in xrange(sets):
+        out_file.write('%s\n' % ('\t'.join(['%s_%07d' % (s[:2].upper(),set_i) for s in SPECIES])))
+    out_file.close()
+
+def divergence_info():
+    """
+    Returns ``(div_map,div_min,div_max)`` like ``get_div_info()``.
+    """
+    div_map = defaultdict(lambda:defaultdict(float))
+    for (spec1,spec2),div_time in DIVERGENCE.iteritems():
+        div_map[spec1][spec2] = div_time
+        div_map[spec2][spec1] = div_time
+    return div_map,min(DIVERGENCE.values()),max(DIVERGENCE.values())
+
+def build_graph(path,conditions,seed=0):
+    """
+    Returns ``(gHandler,gBuilder,ortho_parser)`` with random expression vectors on every node.
+    """
+    ortho_parser = OneToOneOrthoListParser(list_path=path,divergence_info=divergence_info())
+    gBuilder = GraphBuilder([ortho_parser])
+    gBuilder.populate_registries()
+    gHandler = gBuilder.map_registries_to_graph()
+    gHandler.install_metric_handlers(rel_hndler=RelationsHandler((PhyloExpnCorrelationIndex(),)),
+                                     vote_hndlr=None)
+
+    rand = np.random.RandomState(seed)
+    for name in sorted(gHandler.node_dict):
+        gHandler.node_dict[name].set_data(rand.gamma(2,3,size=conditions),'expression_vector')
+    return gHandler,gBuilder,ortho_parser
+
+def main():
+    """
+    Prints the time per null replicate of both workflows.
+    """
+    desc = """Benchmark: reset_random_edges() replicate loop vs gfunc.fdr.ptci_null()."""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--sets', type=int, default=10000,
+                        help="""Number of 3-way ortholog sets. (default = %(default)s)""")
+    parser.add_argument('--conditions', type=int, default=6,
+                        help="""Length of each expression vector. (default = %(default)s)""")
+    parser.add_argument('--reps', type=int, default=5,
+                        help="""Replicates run through the graph loop. (default = %(default)s)""")
+    parser.add_argument('--engine-reps', type=int, default=200,
+                        help="""Replicates run through ptci_null(). (default = %(default)s)""")
+    parser.add_argument('--processes', type=int, default=4,
+                        help="""Worker processes of the parallel ptci_null() run. (default = %(default)s)""")
+    args = parser.parse_args()
+
+    handle,path = tempfile.mkstemp(suffix='.tsv')
+    os.close(handle)
+    try:
+        write_synthetic_ortho_table(path,args.sets)
+        gHandler,gBuilder,ortho_parser = build_graph(path,args.conditions)
+        n_way_ortho_table = pandas.read_table(path)
+        gene_list = list(n_way_ortho_table[SPECIES[0]])
+
+        sets = ortho_set_arrays(gHandler,n_way_ortho_table,divergence_info())
+        gHandler.measure_relations(batched=True)
+        graph_scores = get_ortho_set_PTCIs(gHandler,gene_list)
+        engine_scores = ortho_set_ptcis(sets.expression,sets.ortho_index,sets.weights)
+        max_diff = max([abs(graph_scores[key]-score) for key,score in zip(sets.set_names,engine_scores)])
+
+        t0 = time.time()
+        for rep in range(args.reps):
+            reset_random_edges(gHandler,gBuilder,n_way_ortho_table,ortho_parser)
+            gHandler.measure_relations(batched=True)
+            get_ortho_set_PTCIs(gHandler,gene_list)
+        graph_secs = (time.time() - t0) / args.reps
+
+        t0 = time.time()
+        ptci_null(sets.expression,sets.ortho_index,sets.weights,reps=args.engine_reps,seed=0)
+        serial_secs = (time.time() - t0) / args.engine_reps
+
+        t0 = time.time()
+        ptci_null(sets.expression,sets.ortho_index,sets.weights,reps=args.engine_reps,seed=0,
+                  processes=args.processes)
+        parallel_secs = (time.time() - t0) / args.engine_reps
+    finally:
+        os.remove(path)
+
+    print "method\tsecs_per_rep"
+    print "reset_random_edges loop\t%.4f" % (graph_secs)
+    print "ptci_null (1 process)\t%.4f" % (serial_secs)
+    print "ptci_null (%d processes)\t%.4f" % (args.processes,parallel_secs)
+    print
+    print "max |graph - engine| observed set PTCI: %.3g" % (max_diff)
+
+if __name__ == '__main__':
+    main()
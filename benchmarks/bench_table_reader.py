@@ -0,0 +1,122 @@
+"""
+####################
+bench_table_reader.py
+####################
+Compares run time and peak memory of ``fileIO.tableFile2namedTuple`` with the streaming
+``iter_table_rows`` and the column loading ``tableFile2arrays`` readers on a synthetic
+cuffdiff FPKM tracking table.
+
+Each reader runs in its own process so the peak memory numbers do not mix::
+
+    python benchmarks/bench_table_reader.py --rows 2000000
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+
+from gfunc.fileIO import tableFile2namedTuple
+from gfunc.fileIO import iter_table_rows
+from gfunc.fileIO import tableFile2arrays
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process in MB (Linux reports KB).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def write_synthetic_tracking_table(path,rows,conditions,seed=0):
+    """
+    *GIVEN:*
+        * ``path``: file to write
+        * ``rows``: number of transcript rows
+        * ``conditions``: number of FPKM/conf_lo/conf_hi column triplets
+    *DOES:*
+        * writes a table laid out like a cuffdiff ``isoforms.fpkm_tracking`` file.
+    """
+    rand = np.random.RandomState(seed)
+    headers = ['tracking_id','class_code','nearest_ref_id','gene_id','gene_short_name',
+               'tss_id','locus','length','coverage','status']
+    for c in range(conditions):
+        headers.extend(['q%s_FPKM' % (c),'q%s_conf_lo' % (c),'q%s_conf_hi' % (c)])
+
+    out_file = open(path,'w')
+    out_file.write('%s\n' % ('\t'.join(headers)))
+    block = 100000
+    for start in xrange(0,rows,block):
+        stop = min(start+block,rows)
+        fpkm = rand.gamma(2,3,size=(stop-start,conditions))
+        lines = []
+        for i,row_fpkm in zip(xrange(start,stop),fpkm):
+            fields = ['TCONS_%08d' % (i),'=','GENE%07d-RA' % (i//3),'XLOC_%07d' % (i//3),'-',
+                      'TSS%d' % (i//3),'chr1:%d-%d' % (i*10,i*10+500),'500','10.5','OK']
+            for value in row_fpkm:
+                fields.extend(['%.6g' % (value),'%.6g' % (value*0.8),'%.6g' % (value*1.2)])
+            lines.append('\t'.join(fields))
+        out_file.write('%s\n' % ('\n'.join(lines)))
+    out_file.close()
+
+def run_reader(path,reader,chunk_size,results):
+    """
+    Runs one reader over ``path`` and puts its measurements in ``results``.
+    """
+    rss_before = peak_rss_mb()
+    t0 = time.time()
+    if reader == 'tableFile2namedTuple':
+        rows = tableFile2namedTuple(path)
+        count = len(rows)
+    elif reader == 'iter_table_rows':
+        count = 0
+        for row in iter_table_rows(path,chunk_size=chunk_size):
+            count += 1
+    else:
+        arrays = tableFile2arrays(path,columns=['gene_id','q0_FPKM','q1_FPKM','q2_FPKM'],
+                                  dtypes={'q0_FPKM':float,'q1_FPKM':float,'q2_FPKM':float},
+                                  chunk_size=chunk_size)
+        count = len(arrays.gene_id)
+    secs = time.time() - t0
+    results.put((reader,count,secs,peak_rss_mb()-rss_before))
+
+def main():
+    """
+    Writes the synthetic table, runs every reader and prints a comparison table.
+    """
+    desc = """Benchmark: tableFile2namedTuple vs iter_table_rows vs tableFile2arrays."""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--rows', type=int, default=2000000,
+                        help="""Number of table rows. (default = %(default)s)""")
+    parser.add_argument('--conditions', type=int, default=3,
+                        help="""Number of FPKM column triplets. (default = %(default)s)""")
+    parser.add_argument('--chunk-size', type=int, default=50000,
+                        help="""chunk_size passed to the streaming readers. (default = %(default)s)""")
+    parser.add_argument('--table', type=str, default=None,
+                        help="""Use this existing table instead of writing a synthetic one.""")
+    args = parser.parse_args()
+
+    path = args.table
+    if path is None:
+        handle,path = tempfile.mkstemp(suffix='.fpkm_tracking')
+        os.close(handle)
+        write_synthetic_tracking_table(path,args.rows,max(args.conditions,3))
+
+    try:
+        results = multiprocessing.Queue()
+        print "reader\trows\tsecs\tpeak_rss_MB"
+        for reader in ('tableFile2namedTuple','iter_table_rows','tableFile2arrays'):
+            proc = multiprocessing.Process(target=run_reader,args=(path,reader,args.chunk_size,results))
+            proc.start()
+            row = results.get()
+            proc.join()
+            print "%s\t%d\t%.2f\t%.1f" % row
+    finally:
+        if args.table is None:
+            os.remove(path)
+
+if __name__ == '__main__':
+    main()
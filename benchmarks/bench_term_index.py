@@ -0,0 +1,83 @@
+"""
+####################
+bench_term_index.py
+####################
+Compares ``enrichment_of_terms`` run term by term over the graph with the same call
+using a ``TermIndex`` on a synthetic GO-slim annotated population, and checks that
+both give the same results::
+
+    python benchmarks/bench_term_index.py --genes 50000 --terms 150
+"""
+import argparse
+import time
+
+import networkx as nx
+import numpy as np
+
+from gfunc.scripts.gfunc_build_n_way_one2one import TermIndex
+from gfunc.scripts.gfunc_build_n_way_one2one import enrichment_of_terms
+
+
+class Gene(object):
+    """
+    Stand-in for a GFuncNode: only ``name`` is needed by the GO-slim term functions.
+    """
+    def __init__(self,name):
+        self.name = name
+
+def synthetic_go_slims(genes,term_count,seed=0):
+    """
+    Returns a ``load_go_slims()`` style tree with 0-5 random terms per gene.
+    """
+    rand = np.random.RandomState(seed)
+    go_slim_terms = {}
+    for gene in genes:
+        go_slim_terms[gene.name] = dict(('GO:%07d' % (t),'term %s' % (t))
+                                        for t in rand.randint(0,term_count,size=rand.randint(0,6)))
+    return go_slim_terms
+
+def main():
+    """
+    Prints timings of both paths and whether their results agree.
+    """
+    desc = """Benchmark: per-term enrichment_of_terms vs the TermIndex path."""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--genes', type=int, default=50000,
+                        help="""Population size. (default = %(default)s)""")
+    parser.add_argument('--terms', type=int, default=150,
+                        help="""Number of distinct GO-slim terms. (default = %(default)s)""")
+    parser.add_argument('--positives', type=int, default=2000,
+                        help="""Size of the positive gene set. (default = %(default)s)""")
+    args = parser.parse_args()
+
+    genes = [Gene('GENE%07d' % (g)) for g in range(args.genes)]
+    go_slim_terms = synthetic_go_slims(genes,args.terms)
+    graph = nx.Graph()
+    graph.add_nodes_from(genes)
+    positives = set(np.random.RandomState(1).choice(genes,args.positives,replace=False))
+
+    term_fuction = lambda node: frozenset(go_slim_terms[node.name].keys())
+
+    t0 = time.time()
+    per_term = enrichment_of_terms(graph,positives,term_fuction=term_fuction)
+    per_term_secs = time.time() - t0
+
+    t0 = time.time()
+    term_index = TermIndex.from_go_slims(graph.nodes(),go_slim_terms)
+    build_secs = time.time() - t0
+
+    t0 = time.time()
+    indexed = enrichment_of_terms(graph,positives,term_index=term_index)
+    indexed_secs = time.time() - t0
+
+    print "method\tterms\tsecs"
+    print "per-term scan\t%d\t%.3f" % (len(per_term),per_term_secs)
+    print "TermIndex build\t%d\t%.3f" % (len(term_index.terms),build_secs)
+    print "TermIndex query\t%d\t%.3f" % (len(indexed),indexed_secs)
+    print
+    by_term = lambda table: dict((tuple(row[0]),row[1:]) for row in table)
+    print "identical results: %s" % (by_term(per_term) == by_term(indexed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+####################
+bench_tree_distances.py
+####################
+Compares ete2's per pair ``get_distance`` with the Euler tour/sparse table
+``CompactTree.pairwise_leaf_distances()`` on a random tree, timing ete2 on a sample
+of the pairs and checking that both agree::
+
+    python benchmarks/bench_tree_distances.py --leaves 3000 --sample 2000
+"""
+import argparse
+import random
+import time
+from itertools import islice
+
+import ete2
+import numpy as np
+
+from gfunc.parsers.ETE import CompactTree
+from gfunc.xpermutations import xuniqueCombinations
+
+
+def random_tree(leaf_count,seed=0):
+    """
+    Returns a random ete2 tree with ``leaf_count`` leaves and random branch lengths.
+    """
+    random.seed(seed)
+    tree = ete2.Tree()
+    tree.populate(leaf_count,random_branches=True)
+    return tree
+
+def main():
+    """
+    Prints timings of both methods and the largest relative difference between them.
+    """
+    desc = """Benchmark: ete2 get_distance vs CompactTree.pairwise_leaf_distances()."""
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--leaves', type=int, default=3000,
+                        help="""Number of leaves in the tree. (default = %(default)s)""")
+    parser.add_argument('--sample', type=int, default=2000,
+                        help="""Number of leaf pairs timed with ete2. (default = %(default)s)""")
+    args = parser.parse_args()
+
+    tree = random_tree(args.leaves)
+    leaves = tree.get_leaves()
+
+    t0 = time.time()
+    compact = CompactTree.from_ete2(tree,get_species=lambda leaf: None)
+    leaf_i,leaf_j,distances = compact.pairwise_leaf_distances()
+    engine_secs = time.time() - t0
+
+    t0 = time.time()
+    sampled = [float(leaf1.get_distance(leaf1,leaf2))
+               for leaf1,leaf2 in islice(xuniqueCombinations(leaves,2),args.sample)]
+    ete2_secs = (time.time() - t0) / len(sampled) * len(distances)
+
+    sampled = np.array(sampled)
+    rel_err = np.abs(distances[:len(sampled)]-sampled) / np.maximum(np.abs(sampled),1e-300)
+
+    print "method\tpairs\tsecs"
+    print "CompactTree.pairwise_leaf_distances\t%d\t%.3f" % (len(distances),engine_secs)
+    print "ete2 get_distance (extrapolated)\t%d\t%.1f" % (len(distances),ete2_secs)
+    print
+    print "max relative difference on the sampled pairs: %.3g" % (rel_err.max())
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ analysis_classes.py
 Code defining controller classes for supported analysis types.
 """
 import pdb
+from itertools import izip
 
 import numpy as np
 #np.seterr(divide='raise')
@@ -12,8 +13,13 @@ import numpy as np
 from scipy import stats as sp_stats
 
 from gfunc.data_classes import Bunch
+from gfunc.data_classes import GFuncEdge
+from gfunc.graphTools import CSRAdjacency
 from gfunc.maths import bayesian_score
 from gfunc.maths import weight_d_for_ptci
+from gfunc.maths import pearsonr_rows
+from gfunc.maths import pearsonr_matrix
+from gfunc.stats import bootstrap_est
 
 ######################
 # Metrics Handlers
@@ -55,16 +61,41 @@ class RelationsHandler(MetricHandler):
                 take_votes_for.append(metric)
         return take_votes_for
     
-    def measure_relations(self,edge_dict):
+    def measure_relations(self,edge_dict,batched=False):
         """
         | For each *gfunc_edge* in ``edge_dict``:
         |     iterates through *metrics*:
         |        calculates & stores result in *gfunc_edge* and *metric_handler*
+        
+        If ``batched`` is ``True``, each metric measures all edges at once using
+        ``Metric.measure_relations_batch()`` instead of one edge at a time.
         """
+        if batched:
+            gfunc_edges = list(edge_dict.itervalues())
+            for metric in self.metrics.itervalues():
+                metric.measure_relations_batch(gfunc_edges)
+            return
+        
         for gfunc_edge in edge_dict.itervalues():
             for metric in self.metrics.itervalues():
                 metric.measure_relation(gfunc_edge)
     
+    def measure_target_relations(self,target_nodes,gfunc_nodes):
+        """
+        *GIVEN:*
+            * ``target_nodes``: list of GFuncNodes to treat as targets
+            * ``gfunc_nodes``: list of GFuncNodes to relate each target to
+        *DOES:*
+            * measures every metric with ``poll_me == True`` between each target and
+              each node without creating edges or recording values in the metrics.
+        *RETURNS:*
+            * Bunch keyed by metric of 2D arrays (targets x nodes)
+        """
+        relations = Bunch()
+        for metric in self.get_vote_types():
+            relations[metric] = self.metrics[metric].measure_target_relations(target_nodes,gfunc_nodes)
+        return relations
+    
 
 
 class VoteHandler(MetricHandler):
@@ -112,9 +143,15 @@ class VoteHandler(MetricHandler):
         self.vote_types = vote_types
         self.weight_by = weight_by
     
-    def take_votes(self, node_list, poll_func=None):
+    def take_votes(self, node_list, poll_func=None, csr=None):
         """
-        TODO: Doc
+        Polls the neighbors of each node in ``node_list`` about the installed target
+        node and stores the weighted results in ``node.poll_results``.
+        
+        All nodes are polled at once by ``poll_target_values()`` over a ``CSRAdjacency``
+        snapshot of the graph.  Without ``csr`` a snapshot is built for this call only:
+        ``GraphHandler.take_votes()`` passes its stored one instead.
+        The voting neighbors are only listed in ``node.voters_per_metric`` when it is read.
         """
         if type(node_list) is not type([]):
             raise TypeError("node_list must be type([]).")
@@ -126,44 +163,262 @@ class VoteHandler(MetricHandler):
             poll_func(node_list)
         
         else:
-            for node in node_list:
-                # set up which metrics will be polled for each neighbor edge
-                node_polls = Bunch()
-                for vote_type in self.vote_types:
-                    node_polls[vote_type] = []
+            if csr is None:
+                csr = CSRAdjacency(graph)
+            self._take_votes_csr(node_list,csr)
+    
+    def _take_votes_csr(self, node_list, csr):
+        """
+        Same polling as ``take_votes()`` but reads neighborhoods and edge data from
+        the integer arrays of a ``CSRAdjacency`` snapshot.
+        """
+        target_id = csr.node_ids[self.target_node]
+        edge_to_target = csr.edge_ids_to(target_id)
+        has_edge = edge_to_target >= 0
+        
+        target_values = {}
+        for metric in self.vote_types:
+            values = np.empty(len(csr))
+            values.fill(np.nan)
+            values[has_edge] = csr.edge_values(metric)[edge_to_target[has_edge]]
+            target_values[metric] = values
+        
+        node_ids = np.array([csr.node_ids[node] for node in node_list],dtype=int)
+        offsets,neighbors,neighbor_edges = csr.gather(node_ids)
+        if not has_edge[neighbors[neighbors != target_id]].all():
+            raise KeyError("Some polled nodes have neighbors without an edge to the target node.")
+        
+        polls,voters = self.poll_target_values(node_ids,target_values,csr,skip_id=target_id)
+        
+        for i,node in enumerate(node_list):
+            node_polls = Bunch()
+            for metric in self.vote_types:
+                node_polls[metric] = polls[metric][i]
+                if voters[metric].count(i) > 0:
+                    node.add_voters(metric,voters[metric][i],csr.nodes)
+            node.poll_results = node_polls
+    
+    def poll_virtual_target(self, node_list, target, weights_by_edge=None):
+        """
+        *GIVEN:*
+            * ``node_list``: list of GFuncNodes to poll
+            * ``target``: a ``VirtualTarget`` (see ``GraphHandler.virtual_target()``)
+            * ``weights_by_edge``: optional pre-computed ``target.csr.edge_values(self.weight_by)``
+        *DOES:*
+            * polls each node's neighbors about ``target`` reading the target relations from
+              its dense arrays.  Neither the graph nor the nodes are modified.
+        *RETURNS:*
+            * Bunch with:
+                * ``node_ids``: csr ids of ``node_list``
+                * ``polls``, ``voters``: see ``poll_target_values()``
+                * ``direct``: dict keyed by metric of each node's own relation to ``target``
+        """
+        csr = target.csr
+        node_ids = np.array([csr.node_ids[node] for node in node_list],dtype=int)
+        polls,voters = self.poll_target_values(node_ids,target.relations,csr,
+                                               weights_by_edge=weights_by_edge)
+        direct = {}
+        for metric in self.vote_types:
+            direct[metric] = target.relations[metric][node_ids]
+        
+        return Bunch(node_ids=node_ids,polls=polls,voters=voters,direct=direct)
+    
+    def poll_target_values(self, node_ids, target_values, csr, skip_id=None, weights_by_edge=None):
+        """
+        *GIVEN:*
+            * ``node_ids``: ``csr`` node ids of the nodes to poll
+            * ``target_values``: dict keyed by each metric in ``self.vote_types`` of float arrays
+              holding every ``csr`` node's relation to the target (``nan`` if unknown)
+            * ``csr``: ``CSRAdjacency`` snapshot of the graph
+            * ``skip_id``: ``csr`` node id that never votes (exp: an installed target node)
+            * ``weights_by_edge``: optional pre-computed ``csr.edge_values(self.weight_by)``
+        *DOES:*
+            * polls each node's neighbors about the target the same way ``take_votes()`` does
+              but without reading from or writing to the graph or its nodes.
+        *RETURNS:*
+            * ``(polls,voters)``: dicts keyed by metric of a float array of poll results and a
+              ``VoterIds`` of the voting neighbors' ids, both aligned with ``node_ids``
+        
+        Every neighborhood is gathered into flat arrays and reduced per node with
+        ``_segment_sums()``, which adds each node's ``vote * (weight+1)`` values in the
+        same order as ``(scores*weights).sum()`` did in the old per-node loop.
+        """
+        if self.weight_by is not None and weights_by_edge is None:
+            weights_by_edge = csr.edge_values(self.weight_by)
+        
+        offsets,neighbors,neighbor_edges = csr.gather(node_ids)
+        owners = np.repeat(np.arange(len(node_ids)),np.diff(offsets))
+        if skip_id is not None:
+            keep = neighbors != skip_id
+            neighbors,neighbor_edges,owners = neighbors[keep],neighbor_edges[keep],owners[keep]
+        
+        if self.weight_by is not None:
+            weights = weights_by_edge[neighbor_edges] + 1
+        else:
+            weights = np.ones(len(neighbors)) + 1
+        
+        polls = {}
+        voters = {}
+        for metric in self.vote_types:
+            vote_values = target_values[metric][neighbors]
+            voted = ~np.isnan(vote_values)
+            vote_offsets = _offsets_from_owners(owners[voted],len(node_ids))
+            polls[metric] = _segment_sums(vote_values[voted] * weights[voted],vote_offsets)
+            voters[metric] = VoterIds(neighbors[voted],vote_offsets)
+        
+        return polls,voters
 
-                
-                # poll neighbors for what they think about the target w.r.t each metric in node_polls
-                # but weight it by that neighbors relation to node
-                for neighbor in graph[node]:
-                    if neighbor.name == 'target':
-                        continue
-                    neighbor_edge = graph[node][neighbor]['edge']
-                    neighbor2target = graph[neighbor][self.target_node]['edge']
 
-                    
-                    if self.weight_by is not None:
-                        weight = neighbor_edge.data[self.weight_by]
-                    else:
-                        weight = 1
-                    for metric in node_polls:
-                        # Check to make sure that the metric is a useful number (not NaN)
-                        vote_value = neighbor2target.data[metric]
-                        if not np.isnan(vote_value):
-                            node_polls[metric].append([vote_value,weight])
-                            node.voters_per_metric[metric].append(neighbor)
-                        
-                
-                # convert results lists to weighted mean for each metric type
-                for metric in node_polls:
-                    node_polls[metric] = self._weighted_mean(node_polls[metric])
-                node.poll_results = node_polls
+class VoterIds(object):
+    """
+    The ids of the voting neighbors of many polled nodes kept as one flat array:
+    ``voter_ids[i]`` is the array of ids that voted for the i-th polled node.
+    """
+    def __init__(self,ids,offsets):
+        """
+        *GIVEN:*
+            * ``ids``: int array of the ``CSRAdjacency`` node ids of every voter, grouped by
+              polled node
+            * ``offsets``: int array of length ``polled nodes + 1``; the voters of the i-th
+              polled node are ``ids[offsets[i]:offsets[i+1]]``
+        """
+        self.ids = ids
+        self.offsets = offsets
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __getitem__(self,i):
+        return self.ids[self.offsets[i]:self.offsets[i+1]]
+    
+    def count(self,i):
+        """
+        Returns the number of voters of the i-th polled node.
+        """
+        return self.offsets[i+1] - self.offsets[i]
+    
+    def counts(self):
+        """
+        Returns array with the number of voters of every polled node.
+        """
+        return np.diff(self.offsets)
+
+def _offsets_from_owners(owners,owner_count):
+    """
+    Returns the segment offsets of a sorted array of ``owners`` indexes.
+    """
+    offsets = np.zeros(owner_count+1,dtype=int)
+    np.cumsum(np.bincount(owners,minlength=owner_count),out=offsets[1:])
+    return offsets
+
+def _segment_sums(values,offsets):
+    """
+    Returns array holding the sum of each segment ``values[offsets[i]:offsets[i+1]]``
+    (``nan`` for empty segments).
+    
+    Segments of the same length are stacked as rows of one matrix and summed with
+    ``sum(axis=1)``, which adds each row in the same (pairwise) order as calling ``.sum()``
+    on that segment alone, so the sums match a per-segment loop bit for bit.
+    """
+    lengths = np.diff(offsets)
+    sums = np.empty(len(lengths))
+    sums.fill(np.nan)
+    for length in np.unique(lengths[lengths > 0]):
+        segments = np.flatnonzero(lengths == length)
+        rows = offsets[segments][:,np.newaxis] + np.arange(length)
+        sums[segments] = values[rows].sum(axis=1)
+    return sums
                 
 
 ######################
 # Core Metrics 
 ######################
 
+def _node_vector_matrix(gfunc_nodes,data_type):
+    """
+    Returns 2D array with the ``data_type`` vector of each node in ``gfunc_nodes`` as
+    its rows.  Nodes without ``data_type`` data get a row of ``nan``.
+    """
+    vectors = []
+    for node in gfunc_nodes:
+        try:
+            vectors.append(getattr(node.data,data_type))
+        except AttributeError:
+            vectors.append(None)
+    
+    lengths = set([len(v) for v in vectors if v is not None])
+    if len(lengths) > 1:
+        raise ValueError("All '%s' vectors must be the same length to be measured in batch." % (data_type))
+    
+    matrix = np.empty((len(vectors),lengths.pop() if lengths else 0))
+    matrix.fill(np.nan)
+    for i,vector in enumerate(vectors):
+        if vector is not None:
+            matrix[i] = vector
+    return matrix
+
+def _pearsonr_for_node_pairs(target_nodes,gfunc_nodes,data_type):
+    """
+    Returns 2D array (targets x nodes) of the pearson r between the ``data_type`` vectors
+    of each target and each node; ``nan`` where either one lacks ``data_type`` data.
+    """
+    r_vals,p_vals = pearsonr_matrix(_node_vector_matrix(target_nodes,data_type),
+                                    _node_vector_matrix(gfunc_nodes,data_type))
+    return r_vals
+
+def _stack_node_vectors(gfunc_edges,data_type):
+    """
+    *GIVEN:*
+        * ``gfunc_edges``: list of GFuncEdge objects
+        * ``data_type``: name of a vector type data attribute of the nodes (exp: 'expression_vector')
+    *DOES:*
+        * stacks the ``data_type`` vector of every node touched by ``gfunc_edges`` into one matrix
+          with one row per node.
+    *RETURNS:*
+        * ``(matrix,rows)``: ``rows`` is an int array of shape (len(gfunc_edges),2) holding the
+          ``matrix`` row of each edge's nodes or -1 if the node has no ``data_type`` data.
+    """
+    row_of_node = {}
+    vectors = []
+    rows = np.empty((len(gfunc_edges),2),dtype=int)
+    
+    for e_i,gfunc_edge in enumerate(gfunc_edges):
+        for n_i,node in enumerate(gfunc_edge.nodes):
+            try:
+                rows[e_i,n_i] = row_of_node[node]
+                continue
+            except KeyError:
+                pass
+            try:
+                vectors.append(getattr(node.data,data_type))
+                row_of_node[node] = len(vectors) - 1
+            except AttributeError:
+                row_of_node[node] = -1
+            rows[e_i,n_i] = row_of_node[node]
+    
+    if len(set([len(v) for v in vectors])) > 1:
+        raise ValueError("All '%s' vectors must be the same length to be measured in batch." % (data_type))
+    
+    return np.array(vectors,dtype=float),rows
+
+def _pearsonr_for_edges(gfunc_edges,data_type):
+    """
+    Returns arrays ``(r_vals,p_vals,has_data)`` of the pearson correlation between the ``data_type``
+    vectors of each edge's nodes.  Edges where either node lacks ``data_type`` data are ``False`` in
+    ``has_data`` and get ``nan``.
+    """
+    matrix,rows = _stack_node_vectors(gfunc_edges,data_type)
+    
+    r_vals = np.empty(len(gfunc_edges))
+    r_vals.fill(np.nan)
+    p_vals = r_vals.copy()
+    
+    has_data = (rows >= 0).all(axis=1)
+    if has_data.any():
+        r_vals[has_data],p_vals[has_data] = pearsonr_rows(matrix[rows[has_data,0]],
+                                                          matrix[rows[has_data,1]])
+    return r_vals,p_vals,has_data
+
 class Metric(object):
     """
     TODO: doc
@@ -174,17 +429,34 @@ class Metric(object):
         """
         raise NotImplementedError('You must override this method in subclass.')
     
-    def _bootstrap_the_distribution(self):
+    def _bootstrap_the_distribution(self,reducer=np.median,reps=1000,seed=None,greater_than=None,processes=1):
         """
         Estimate some qualities of the distribution of encountered values.  
-        """
-        raise NotImplementedError('TODO: You still need to write this.')    
+        
+        Bootstraps ``reducer`` (median by default) of the non-NaN ``recorded_values``
+        (only those greater than ``greater_than`` if given) with ``gfunc.stats.bootstrap_est()``.
+        
+        *RETURNS:*
+            * tuple([*median of resampled statistics*, *SE est*, *loBound*, *hiBound*])
+        """
+        values = np.asarray(self.recorded_values,dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if greater_than is not None:
+            values = values[values > greater_than]
+        return bootstrap_est(values,reducer=reducer,reps=reps,seed=seed,processes=processes)
     
     def _calc_metric(self,node1,node2):
         """
         Does this metric's specific calculations.
         """
         raise NotImplementedError('You must override this method in subclass.')
+    
+    def _calc_metric_batch(self,gfunc_edges):
+        """
+        Does this metric's specific calculations for a list of edges at once and
+        returns the results as an array.
+        """
+        raise NotImplementedError('Override this method in subclass to support batched measuring.')
         
     def measure_relation(self,gfunc_edge):
         """
@@ -196,6 +468,42 @@ class Metric(object):
         gfunc_edge.set_data(data,data_type)
         self.recorded_values.append(data)
     
+    def measure_relations_batch(self,gfunc_edges):
+        """
+        Same as calling ``measure_relation()`` on each edge in ``gfunc_edges`` but
+        lets subclasses that define ``_calc_metric_batch()`` do the math for all edges
+        at once.
+        """
+        try:
+            values = self._calc_metric_batch(gfunc_edges)
+        except NotImplementedError:
+            for gfunc_edge in gfunc_edges:
+                self.measure_relation(gfunc_edge)
+            return
+        
+        data_type = self.relation_metric
+        values = list(values)
+        for gfunc_edge,data in izip(gfunc_edges,values):
+            gfunc_edge.set_data(data,data_type)
+        self.recorded_values.extend(values)
+    
+    def measure_target_relations(self,target_nodes,gfunc_nodes):
+        """
+        Returns 2D array of this metric between each of ``target_nodes`` (rows) and each
+        of ``gfunc_nodes`` (columns).  Nothing is recorded and no edges are registered.
+        
+        The (target,node) edges are built once and measured together by
+        ``_calc_metric_batch()`` when the subclass has one, else one by one with
+        ``_calc_metric()``.  Subclasses that can work on node vectors directly should
+        override this with something faster.
+        """
+        gfunc_edges = [GFuncEdge(node1=target,node2=node) for target in target_nodes for node in gfunc_nodes]
+        try:
+            values = self._calc_metric_batch(gfunc_edges)
+        except NotImplementedError:
+            values = [self._calc_metric(gfunc_edge) for gfunc_edge in gfunc_edges]
+        return np.asarray(values,dtype=np.float64).reshape((len(target_nodes),len(gfunc_nodes)))
+    
     def mean(self,greater_than=0):
         """
         Returns the mean of the encountered values greater than the value provided.  
@@ -239,10 +547,31 @@ class PhyloExpnCorrelationIndex(Metric):
             
             return ptci
         except AttributeError as err:
-            if """'Bunch' object has no attribute""" in err.message:
+            if """object has no attribute""" in err.message:
                 return float('nan')
             else:
                 raise err
+    
+    def _calc_metric_batch(self,gfunc_edges):
+        """
+        Vectorized version of ``_calc_metric()`` for a list of edges.
+        """
+        r_vals,p_vals,has_data = _pearsonr_for_edges(gfunc_edges,'expression_vector')
+        
+        divergence = np.empty((len(gfunc_edges),3))
+        divergence.fill(np.nan)
+        for i in np.flatnonzero(has_data):
+            gfunc_edge = gfunc_edges[i]
+            try:
+                divergence[i] = gfunc_edge.data.divergence
+            except AttributeError:
+                r_vals[i] = np.nan
+        
+        d_val,d_min,d_max = divergence.T
+        with np.errstate(invalid='ignore'):
+            ptci = r_vals * (1-p_vals) * weight_d_for_ptci(d_val,d_min,d_max)
+        
+        return ptci
 
 class ExpressionSimilarity(Metric):
     """
@@ -272,7 +601,7 @@ class ExpressionSimilarity(Metric):
             #scaled_rVal = (r_val+1)/2
             return r_val     
         except AttributeError as err:
-            if """'Bunch' object has no attribute""" in err.message:
+            if """object has no attribute""" in err.message:
                 # TODO: Should I return these or just leave the value unset?
                 # for now its left unset.
                 r_val = float('nan')
@@ -280,6 +609,19 @@ class ExpressionSimilarity(Metric):
                 return r_val
             else:
                 raise err
+    
+    def _calc_metric_batch(self,gfunc_edges):
+        """
+        Vectorized version of ``_calc_metric()`` for a list of edges.
+        """
+        r_vals,p_vals,has_data = _pearsonr_for_edges(gfunc_edges,'expression_vector')
+        return r_vals
+    
+    def measure_target_relations(self,target_nodes,gfunc_nodes):
+        """
+        Vectorized version of ``Metric.measure_target_relations()``.
+        """
+        return _pearsonr_for_node_pairs(target_nodes,gfunc_nodes,'expression_vector')
         
         
 class TFBSSimilarity(Metric):
@@ -309,13 +651,26 @@ class TFBSSimilarity(Metric):
             scaled_rVal = (r_val+1)/2
             return r_val
         except AttributeError as err:
-            if """'Bunch' object has no attribute""" in err.message:
+            if """object has no attribute""" in err.message:
                 # TODO: Should I return these or just leave the value unset?
                 r_val = float('nan')
                 p_val = float('nan')
                 return r_val
             else:
                 raise err
+    
+    def _calc_metric_batch(self,gfunc_edges):
+        """
+        Vectorized version of ``_calc_metric()`` for a list of edges.
+        """
+        r_vals,p_vals,has_data = _pearsonr_for_edges(gfunc_edges,'tfbs_vector')
+        return r_vals
+    
+    def measure_target_relations(self,target_nodes,gfunc_nodes):
+        """
+        Vectorized version of ``Metric.measure_target_relations()``.
+        """
+        return _pearsonr_for_node_pairs(target_nodes,gfunc_nodes,'tfbs_vector')
         
 
 
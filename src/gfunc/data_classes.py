@@ -9,6 +9,14 @@ class Bunch(dict):
     def __init__(self, *args, **kwds):
         super(Bunch,self).__init__(*args,**kwds)
         self.__dict__ = self
+    
+    # copy/pickle would otherwise restore __dict__ as a separate dict, so that
+    # attribute access no longer sees the items (or sees none at all after deepcopy)
+    def __getstate__(self):
+        return True
+    
+    def __setstate__(self,state):
+        self.__dict__ = self
 
 def bunchify(dict_tree):
     """
@@ -25,9 +33,12 @@ class GFuncNode(object):
     TODO: Doc
     """
     
-    def __init__(self,name,species,graph,is_target=False,debug=False):
+    def __init__(self,name,species,graph,is_target=False,debug=False,store=None,row=None):
         """
         TODO: Doc
+        
+        If a ``ColumnStore`` is given as ``store``, ``self.data`` is a view of a new
+        row in it (or of the existing ``row``) instead of a ``Bunch``.
         """
         self._is_target = is_target
         self._graph = graph # provide reference to graph
@@ -36,10 +47,8 @@ class GFuncNode(object):
         #self.edges        = Bunch()
         self.name         = name
         self.species      = species
-        self.data         = Bunch()
-        self.poll_results = Bunch()
-        self.voters_per_metric = defaultdict(list)
-        self.combo_score  = None
+        self.data         = Bunch() if store is None else store.view(store.add_row() if row is None else row)
+        # poll_results, voters_per_metric and combo_score are only allocated once used
         
         if debug:
             self._debug()
@@ -50,11 +59,51 @@ class GFuncNode(object):
         """
         return "GFuncNode(%r)" % (self.name)
     
+    combo_score = None
+    
+    @property
+    def poll_results(self):
+        """
+        Bunch of poll results keyed by metric (created on first access).
+        """
+        try:
+            return self.__dict__['poll_results']
+        except KeyError:
+            return self.__dict__.setdefault('poll_results',Bunch())
+    
+    @poll_results.setter
+    def poll_results(self,value):
+        self.__dict__['poll_results'] = value
+    
+    @property
+    def voters_per_metric(self):
+        """
+        ``defaultdict(list)`` of voting neighbors keyed by metric (created on first access).
+        Voters recorded with ``add_voters()`` are turned into GFuncNodes here.
+        """
+        try:
+            voters = self.__dict__['voters_per_metric']
+        except KeyError:
+            voters = self.__dict__.setdefault('voters_per_metric',defaultdict(list))
+        
+        for metric,voter_ids,id_to_node in self.__dict__.pop('_pending_voters',()):
+            voters[metric].extend([id_to_node[i] for i in voter_ids])
+        return voters
+    
+    @voters_per_metric.setter
+    def voters_per_metric(self,value):
+        self.__dict__['voters_per_metric'] = value
+    
     def get_copy(self):
         """
-        Returns a deep copy of the node.
+        Returns a deep copy of the node.  The copy shares the original's graph
+        reference instead of copying the whole graph, and data kept in a
+        ``ColumnStore`` is copied into a plain ``Bunch``.
         """
-        return deepcopy(self)
+        memo = {id(self._graph):self._graph}
+        if isinstance(self.data,ColumnView):
+            memo[id(self.data)] = Bunch(deepcopy(dict(self.data.items())))
+        return deepcopy(self,memo)
         
     def set_data(self,data,data_type):
         """
@@ -62,12 +111,22 @@ class GFuncNode(object):
         """
         self.data[data_type] = data
     
+    def add_voters(self,metric,voter_ids,id_to_node):
+        """
+        Records the integer ``voter_ids`` as voters on ``metric`` without looking up
+        their GFuncNodes in ``id_to_node`` (exp: ``CSRAdjacency.nodes``) until
+        ``voters_per_metric`` is read.
+        """
+        self.__dict__.setdefault('_pending_voters',[]).append((metric,voter_ids,id_to_node))
+    
     def total_votes(self):
         """
         """
         total = 0
-        for voters in self.voters_per_metric.values():
+        for voters in self.__dict__.get('voters_per_metric',{}).values():
             total += len(voters)
+        for metric,voter_ids,id_to_node in self.__dict__.get('_pending_voters',()):
+            total += len(voter_ids)
         return total
     
     def get_sub_scores(self,target_node,graph):
@@ -102,13 +161,16 @@ class GFuncEdge(object):
     TODO: Doc
     """
     
-    def __init__(self,node1,node2):
+    def __init__(self,node1,node2,store=None,row=None):
         """
         TODO: Doc
+        
+        If a ``ColumnStore`` is given as ``store``, ``self.data`` is a view of a new
+        row in it (or of the existing ``row``) instead of a ``Bunch``.
         """
         self.nodes = (node1,node2)
         self.key = tuple(sorted([node1.name,node2.name]))
-        self.data = Bunch()
+        self.data = Bunch() if store is None else store.view(store.add_row() if row is None else row)
     
     def __repr__(self):
         """
@@ -122,3 +184,360 @@ class GFuncEdge(object):
         TODO: Doc
         """
         self.data[data_type] = data
+
+
+######################
+# Columnar backend
+######################
+
+class ColumnStore(object):
+    """
+    Columnar, array-backed storage for the ``data`` of many GFuncNode or GFuncEdge
+    objects.  Each data type is kept in one contiguous numpy array indexed by an
+    integer row id and each object's ``data`` becomes a ``ColumnView`` of its row.
+    
+    Column types are chosen from the first value stored:
+        * bool/int/float scalars --> 1D typed array (ints become floats if needed)
+        * numeric vectors (``np.ndarray``) or tuples of a fixed length --> 2D float array
+        * anything else --> 1D object array
+    
+    A value that does not fit an existing column turns that column into an object column.
+    """
+    
+    def __init__(self,capacity=1024):
+        """
+        Makes an empty store.
+        
+        *GIVEN:*
+            * ``capacity``: number of rows to allocate up front; the columns double in size
+              whenever ``add_row()`` needs more room
+        """
+        self._size = 0
+        self._capacity = max(int(capacity),1)
+        self._columns = {}
+        self._present = {}
+        self._kinds   = {}
+        
+    @classmethod
+    def from_arrays(cls,size,columns,present,kinds):
+        """
+        Returns a ``ColumnStore`` of ``size`` rows that uses the given arrays (exp: numpy
+        memmaps of a saved snapshot) as its columns without copying them.
+        
+        *GIVEN:*
+            * ``columns``: dict of data type --> values array (first axis ``size``)
+            * ``present``: dict of data type --> bool array marking rows that have the data
+            * ``kinds``: dict of data type --> ``'scalar'``, ``'vector'``, ``'tuple'`` or ``'object'``
+        """
+        store = cls(capacity=size)
+        store._size = size
+        store._columns = dict(columns)
+        store._present = dict(present)
+        store._kinds = dict(kinds)
+        return store
+    
+    def __len__(self):
+        """
+        Returns the number of rows in the store.
+        """
+        return self._size
+    
+    def __getstate__(self):
+        """
+        Trims unused capacity before pickling.
+        """
+        self.compact()
+        return self.__dict__
+    
+    def _resize(self,capacity):
+        """
+        Reallocates every column to hold ``capacity`` rows.
+        """
+        for name,col in self._columns.items():
+            new_col = np.empty((capacity,)+col.shape[1:],dtype=col.dtype)
+            new_col[:self._size] = col[:self._size]
+            if col.dtype == object:
+                new_col[self._size:] = None
+            self._columns[name] = new_col
+            
+            new_present = np.zeros(capacity,dtype=np.bool_)
+            new_present[:self._size] = self._present[name][:self._size]
+            self._present[name] = new_present
+        self._capacity = capacity
+    
+    def compact(self):
+        """
+        Shrinks every column to the current number of rows.
+        """
+        if self._capacity != self._size:
+            self._resize(max(self._size,1))
+    
+    def add_row(self):
+        """
+        Adds an empty row and returns its integer id.
+        """
+        if self._size == self._capacity:
+            self._resize(self._capacity * 2)
+        row = self._size
+        self._size += 1
+        return row
+    
+    def view(self,row):
+        """
+        Returns a ``ColumnView`` of ``row``.
+        """
+        return ColumnView(self,row)
+    
+    def _new_column(self,name,value):
+        """
+        Creates the column ``name`` using ``value`` to decide its type.
+        """
+        if isinstance(value,(bool,np.bool_)):
+            kind,shape,dtype = 'scalar',(),np.bool_
+        elif isinstance(value,(int,long,np.integer)):
+            kind,shape,dtype = 'scalar',(),np.int64
+        elif isinstance(value,(float,np.floating)):
+            kind,shape,dtype = 'scalar',(),np.float64
+        elif isinstance(value,(np.ndarray,tuple)) and _is_numeric_vector(value):
+            kind = 'vector' if isinstance(value,np.ndarray) else 'tuple'
+            shape,dtype = (len(value),),np.float64
+        else:
+            kind,shape,dtype = 'object',(),object
+        
+        col = np.empty((self._capacity,)+shape,dtype=dtype)
+        if dtype is object:
+            col[:] = None
+        self._columns[name] = col
+        self._present[name] = np.zeros(self._capacity,dtype=np.bool_)
+        self._kinds[name] = kind
+    
+    def _fits(self,name,value):
+        """
+        Returns ``True`` if ``value`` can be stored in column ``name`` as it is typed now.
+        Upgrades int columns to float columns when a float arrives.
+        """
+        kind = self._kinds[name]
+        col = self._columns[name]
+        if kind == 'object':
+            return True
+        if kind == 'scalar':
+            if col.dtype == np.bool_:
+                return isinstance(value,(bool,np.bool_))
+            if isinstance(value,(bool,np.bool_)):
+                return False
+            if isinstance(value,(int,long,np.integer)):
+                return True
+            if isinstance(value,(float,np.floating)):
+                if col.dtype != np.float64:
+                    self._columns[name] = col.astype(np.float64)
+                return True
+            return False
+        if kind == 'vector':
+            return isinstance(value,np.ndarray) and _is_numeric_vector(value) and len(value) == col.shape[1]
+        if kind == 'tuple':
+            return isinstance(value,tuple) and _is_numeric_vector(value) and len(value) == col.shape[1]
+    
+    def _to_object_column(self,name):
+        """
+        Converts column ``name`` into an object column keeping its values.
+        """
+        col = np.empty(self._capacity,dtype=object)
+        col[:] = None
+        for row in np.flatnonzero(self._present[name][:self._size]):
+            col[row] = self.get(row,name)
+        self._columns[name] = col
+        self._kinds[name] = 'object'
+    
+    def set(self,row,name,value):
+        """
+        Stores ``value`` as data type ``name`` of ``row``.
+        """
+        if name not in self._columns:
+            self._new_column(name,value)
+        elif not self._fits(name,value):
+            self._to_object_column(name)
+        self._columns[name][row] = value
+        self._present[name][row] = True
+    
+    def get(self,row,name):
+        """
+        Returns the ``name`` data of ``row``.  Raises ``KeyError`` if it was never set.
+        
+        Vector data is returned as a copy of the row, so writing to it does not change the
+        store and it stays valid after the store is resized.  Use ``column()`` to work on
+        the store's arrays directly.
+        """
+        try:
+            if not self._present[name][row]:
+                raise KeyError(name)
+        except KeyError:
+            raise KeyError(name)
+        value = self._columns[name][row]
+        kind = self._kinds[name]
+        if kind == 'tuple':
+            return tuple(value.tolist())
+        if kind == 'vector':
+            return value.copy()
+        return value
+    
+    def has(self,row,name):
+        """
+        Returns ``True`` if ``row`` has ``name`` data.
+        """
+        return name in self._present and bool(self._present[name][row])
+    
+    def delete(self,row,name):
+        """
+        Removes the ``name`` data of ``row``.
+        """
+        if not self.has(row,name):
+            raise KeyError(name)
+        self._present[name][row] = False
+        if self._kinds[name] == 'object':
+            self._columns[name][row] = None
+    
+    def names(self,row):
+        """
+        Returns the list of data types set for ``row``.
+        """
+        return [name for name in self._columns if self._present[name][row]]
+    
+    def column(self,name):
+        """
+        Returns ``(values,present)`` arrays of column ``name`` for all rows.  ``values``
+        is a view into the store: do not resize it.
+        """
+        if name not in self._columns:
+            values = np.empty(self._size)
+            values.fill(np.nan)
+            return values,np.zeros(self._size,dtype=np.bool_)
+        return self._columns[name][:self._size],self._present[name][:self._size]
+
+
+def _is_numeric_vector(value):
+    """
+    Returns ``True`` if ``value`` is a flat sequence of numbers.
+    """
+    if isinstance(value,np.ndarray):
+        return value.ndim == 1 and value.dtype.kind in 'biuf'
+    for x in value:
+        if isinstance(x,(bool,np.bool_)) or not isinstance(x,(int,long,float,np.integer,np.floating)):
+            return False
+    return True
+
+
+class ColumnView(object):
+    """
+    A ``Bunch`` look-alike that reads and writes one row of a ``ColumnStore``.
+    Supports ``view.PTCI``, ``view['PTCI']``, ``'PTCI' in view``, ``get()``, ``keys()``, etc.
+    
+    Vector data read through a view is a copy (see ``ColumnStore.get()``): assign the
+    changed vector back to store it.
+    """
+    __slots__ = ('_store','_row')
+    
+    def __init__(self,store,row):
+        """
+        *GIVEN:*
+            * ``store``: the ``ColumnStore`` holding the data
+            * ``row``: integer id of the row this view reads and writes
+        """
+        object.__setattr__(self,'_store',store)
+        object.__setattr__(self,'_row',row)
+    
+    def __getstate__(self):
+        return (self._store,self._row)
+    
+    def __setstate__(self,state):
+        object.__setattr__(self,'_store',state[0])
+        object.__setattr__(self,'_row',state[1])
+    
+    def __getattr__(self,name):
+        try:
+            return self._store.get(self._row,name)
+        except KeyError:
+            raise AttributeError("'ColumnView' object has no attribute '%s'" % (name))
+    
+    def __setattr__(self,name,value):
+        self._store.set(self._row,name,value)
+        
+    def __delattr__(self,name):
+        try:
+            self._store.delete(self._row,name)
+        except KeyError:
+            raise AttributeError("'ColumnView' object has no attribute '%s'" % (name))
+    
+    def __getitem__(self,name):
+        return self._store.get(self._row,name)
+    
+    def __setitem__(self,name,value):
+        self._store.set(self._row,name,value)
+    
+    def __delitem__(self,name):
+        self._store.delete(self._row,name)
+    
+    def __contains__(self,name):
+        return self._store.has(self._row,name)
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self):
+        return len(self.keys())
+    
+    def __repr__(self):
+        return "ColumnView(%r)" % (dict(self.items()))
+    
+    def get(self,name,default=None):
+        try:
+            return self._store.get(self._row,name)
+        except KeyError:
+            return default
+    
+    def keys(self):
+        return self._store.names(self._row)
+    
+    def items(self):
+        return [(name,self._store.get(self._row,name)) for name in self.keys()]
+    
+    def iteritems(self):
+        return iter(self.items())
+    
+    def values(self):
+        return [value for name,value in self.items()]
+    
+    def itervalues(self):
+        return iter(self.values())
+    
+    def update(self,other):
+        for name,value in other.items():
+            self._store.set(self._row,name,value)
+    
+    @property
+    def row(self):
+        """
+        The integer id of this view's row in its ``ColumnStore``.
+        """
+        return self._row
+
+
+def columnarize(gfunc_objs,store=None):
+    """
+    *GIVEN:*
+        * ``gfunc_objs``: iterable of GFuncNode or GFuncEdge objects
+        * ``store``: ``ColumnStore`` to fill (a new one is made if ``None``)
+    *DOES:*
+        * copies each object's ``data`` into a new row of ``store`` in iteration order
+          and replaces ``data`` with a ``ColumnView`` of that row.
+    *RETURNS:*
+        * ``store``
+    """
+    if store is None:
+        store = ColumnStore()
+    for obj in gfunc_objs:
+        view = store.view(store.add_row())
+        for data_type,data in obj.data.items():
+            view[data_type] = data
+        obj.data = view
+    store.compact()
+    return store
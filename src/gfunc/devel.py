@@ -50,7 +50,7 @@ def edge_correlation(gFunc_edge):
             return r_val,p_val
     
     except AttributeError as err:
-        if """'Bunch' object has no attribute""" in err.message:
+        if """object has no attribute""" in err.message:
             # if this executes then one of the nodes did not have an expression_vector which means no r is possible
             # in this case return None
             gFunc_edge.data.r_val = None
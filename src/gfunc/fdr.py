@@ -7,6 +7,13 @@ Code supporting easy generation of emprical FDR for results.
 
 import random 
 
+import numpy as np
+
+from gfunc.data_classes import Bunch
+from gfunc.maths import pearsonr_rows
+from gfunc.maths import weight_d_for_ptci
+from gfunc.xpermutations import xuniqueCombinations
+
 def shuffle_dict(original_dict,shuffle_count):
     """
     
@@ -26,9 +33,250 @@ def shuffle_dict(original_dict,shuffle_count):
         
         yield new_dict
 
+
+def shuffle_indexes(n,shuffle_count,seed=None,rng='numpy',chunk_size=None):
+    """
+    Array companion of ``shuffle_dict()``: permutations as integer index arrays instead of dicts.
+    
+    *GIVEN:*
+        * ``n``: length of each permutation (exp: ``len(original_dict)``)
+        * ``shuffle_count``: number of permutations
+        * ``seed``: int seed (``None`` for a fresh random seed) or a ``numpy.random.RandomState``
+        * ``rng``: ``'numpy'`` (``RandomState.permutation``) or ``'python'`` (``random.shuffle``
+          like ``shuffle_dict()``; slower)
+        * ``chunk_size``: if given, yield blocks of at most this many permutations instead
+          of returning them all at once
+    *RETURNS:*
+        * ``(shuffle_count, n)`` int array with one permutation per row, or a generator of
+          such blocks if ``chunk_size`` is given.  Both give the same rows for the same ``seed``.
+    
+    With ``keys,values`` arrays of a dict, ``values[perm]`` is the shuffled dict's values
+    in ``keys`` order.
+    """
+    blocks = _iter_shuffle_blocks(n,shuffle_count,seed,rng,chunk_size or max(1,shuffle_count))
+    if chunk_size is not None:
+        return blocks
+    
+    blocks = list(blocks)
+    if not blocks:
+        return np.empty((0,n),dtype=np.intp)
+    return blocks[0]
+
+def _iter_shuffle_blocks(n,shuffle_count,seed,rng,chunk_size):
+    """
+    Yields the ``shuffle_indexes()`` blocks.
+    """
+    if rng == 'numpy':
+        rand = seed if isinstance(seed,np.random.RandomState) else np.random.RandomState(seed)
+        shuffle_row = lambda row: rand.shuffle(row)
+    elif rng == 'python':
+        rand = random.Random(seed)
+        def shuffle_row(row):
+            perm = range(n)
+            rand.shuffle(perm)
+            row[:] = perm
+    else:
+        raise ValueError("rng must be 'numpy' or 'python' not '%s'." % (rng))
+    
+    for start in xrange(0,shuffle_count,chunk_size):
+        block = np.empty((min(chunk_size,shuffle_count-start),n),dtype=np.intp)
+        block[:] = np.arange(n)
+        for row in block:
+            shuffle_row(row)
+        yield block
+
+def get_fdr_full(original_dict,positive_keys,score_thresholds,scoring_func=None,fdr_reps=1000,
+                 seed=None,rng='numpy',chunk_size=1000):
+    """
+    *GIVEN:*
+        * ``original_dict``: dict of key --> value
+        * ``positive_keys``: keys of interest (exp: genes of an ortholog set or GO term)
+        * ``score_thresholds``: list of score thresholds to build the curve at
+        * ``scoring_func``: function taking the array of values and returning an array of
+          scores (``None`` uses the values themselves)
+        * ``fdr_reps``: number of permutations
+        * ``seed``, ``rng``, ``chunk_size``: see ``shuffle_indexes()``
+    *DOES:*
+        * counts the ``positive_keys`` scoring ``>=`` each threshold, then does the same on
+          ``fdr_reps`` shufflings of the values among the keys (``shuffle_dict()`` without the
+          dicts), ``chunk_size`` permutations at a time.
+    *RETURNS:*
+        * Bunch(thresholds, observed, null_mean, fdr) of arrays where ``fdr`` is
+          ``null_mean / observed`` capped at 1 (``nan`` where nothing was observed)
+    """
+    keys = original_dict.keys()
+    values = [original_dict[key] for key in keys]
+    if scoring_func is None:
+        scores = np.asarray(values,dtype=float)
+    else:
+        scores = np.asarray(scoring_func(values),dtype=float)
+    
+    positive_keys = set(positive_keys)
+    positions = np.array([i for i,key in enumerate(keys) if key in positive_keys],dtype=np.intp)
+    
+    thresholds = np.asarray(score_thresholds,dtype=float)
+    order = np.argsort(thresholds,kind='mergesort')
+    
+    def count_passing(positive_scores):
+        # number of non-nan scores >= each threshold in each row of the 2D positive_scores
+        ranks = np.searchsorted(thresholds[order],positive_scores,side='right')
+        ranks[np.isnan(positive_scores)] = 0
+        ranks += (len(thresholds)+1) * np.arange(len(ranks))[:,np.newaxis]
+        counts = np.bincount(ranks.ravel(),minlength=len(ranks)*(len(thresholds)+1))
+        counts = counts.reshape(len(ranks),len(thresholds)+1)
+        passing = np.empty((len(ranks),len(thresholds)),dtype=int)
+        passing[:,order] = np.cumsum(counts[:,:0:-1],axis=1)[:,::-1]
+        return passing
+    
+    observed = count_passing(scores[positions][np.newaxis,:])[0]
+    
+    null_total = np.zeros(len(thresholds))
+    for block in shuffle_indexes(len(keys),fdr_reps,seed=seed,rng=rng,chunk_size=chunk_size):
+        null_total += count_passing(scores[block[:,positions]]).sum(axis=0)
+    null_mean = null_total / max(1,fdr_reps)
+    
+    with np.errstate(divide='ignore',invalid='ignore'):
+        fdr = np.minimum(null_mean / observed,1.0)
+    fdr[observed == 0] = np.nan
+    
+    return Bunch({'thresholds':thresholds,
+                  'observed':observed,
+                  'null_mean':null_mean,
+                  'fdr':fdr})
+
+# module level so that forked ``ptci_null()`` workers share it instead of pickling it
+_ptci_null_job = {}
+
+def species_pair_weights(species,divergence_info):
+    """
+    *GIVEN:*
+        * ``species``: list of the species of each column of an N-way 1:1 ortholog table
+        * ``divergence_info``: ``(div_map,div_min,div_max)`` (see ``get_div_info()`` in ``gfunc_build_n_way_one2one``)
+    *RETURNS:*
+        * 2D array with the ``weight_d_for_ptci()`` weight of every pair of species columns
+    """
+    div_map,div_min,div_max = divergence_info
+    weights = np.ones((len(species),len(species)))
+    for a,b in xuniqueCombinations(range(len(species)),2):
+        weights[a,b] = weights[b,a] = weight_d_for_ptci(div_map[species[a]][species[b]],div_min,div_max)
+    return weights
+
+def ortho_set_ptcis(expression,ortho_index,weights):
+    """
+    *GIVEN:*
+        * ``expression``: 2D array with one expression vector per row
+        * ``ortho_index``: 2D int array (ortholog sets x species) of rows of ``expression``;
+          ``-1`` marks genes without expression data
+        * ``weights``: output of ``species_pair_weights()``
+    *DOES:*
+        * scores every pair of genes in each set as ``r * (1-p) * weight`` (the PTCI) and
+          averages the non-``nan`` pairs of each set like ``get_ortho_set_PTCIs()``.
+    *RETURNS:*
+        * array of the mean PTCI of each ortholog set (``nan`` if no pair could be scored)
+    """
+    ortho_index = np.asarray(ortho_index)
+    score_sum = np.zeros(len(ortho_index))
+    score_count = np.zeros(len(ortho_index),dtype=int)
+    for a,b in xuniqueCombinations(range(ortho_index.shape[1]),2):
+        has_data = (ortho_index[:,a] >= 0) & (ortho_index[:,b] >= 0)
+        r_vals,p_vals = pearsonr_rows(expression[ortho_index[has_data,a]],
+                                      expression[ortho_index[has_data,b]])
+        ptci = r_vals * (1-p_vals) * weights[a,b]
+        scored = ~np.isnan(ptci)
+        rows = np.flatnonzero(has_data)[scored]
+        score_sum[rows] += ptci[scored]
+        score_count[rows] += 1
+    
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return score_sum / score_count
+
+def permute_ortho_index(ortho_index,rand):
+    """
+    Returns a copy of ``ortho_index`` with each species column shuffled on its own by the
+    ``numpy.random.RandomState`` ``rand`` so that orthology is lost but every set still
+    holds one gene from each species (the array version of ``reset_random_edges()``).
+    """
+    ortho_index = np.asarray(ortho_index)
+    columns = [ortho_index[rand.permutation(len(ortho_index)),s] for s in range(ortho_index.shape[1])]
+    return np.column_stack(columns)
+
+def ptci_null(expression,ortho_index,weights,reps=100,seed=None,processes=1):
+    """
+    *GIVEN:*
+        * ``expression``, ``ortho_index``, ``weights``: see ``ortho_set_ptcis()``
+        * ``reps``: number of shuffled replicates
+        * ``seed``: int seed of the shuffles (``None`` for a fresh random seed)
+        * ``processes``: number of worker processes the replicates are spread over
+          (``None`` uses every CPU)
+    *DOES:*
+        * scores ``reps`` independent ``permute_ortho_index()`` shuffles of the ortholog sets
+          with ``ortho_set_ptcis()``.  Nothing in the graph is touched.
+        * Each replicate gets its own seed drawn from ``seed``, so the same ``seed`` gives the
+          same null whatever ``processes`` is.
+    *RETURNS:*
+        * 2D array (reps x ortholog sets) of null PTCI scores
+    """
+    rep_seeds = np.random.RandomState(seed).randint(0,2**31-1,size=reps).tolist()
+    
+    _ptci_null_job['expression'] = np.asarray(expression,dtype=float)
+    _ptci_null_job['ortho_index'] = np.asarray(ortho_index)
+    _ptci_null_job['weights'] = weights
+    try:
+        if (processes is None or processes > 1) and reps > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_ptci_null_rep,rep_seeds)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_ptci_null_rep(rep_seed) for rep_seed in rep_seeds]
+    finally:
+        _ptci_null_job.clear()
+    
+    if not results:
+        return np.empty((0,len(ortho_index)))
+    return np.vstack(results)
+
+def _ptci_null_rep(rep_seed):
+    """
+    Shuffles and scores one ``ptci_null()`` replicate.
+    """
+    permuted = permute_ortho_index(_ptci_null_job['ortho_index'],np.random.RandomState(rep_seed))
+    return ortho_set_ptcis(_ptci_null_job['expression'],permuted,_ptci_null_job['weights'])
+
+def empirical_fdr(observed,null):
+    """
+    *GIVEN:*
+        * ``observed``: array of observed scores (higher is better)
+        * ``null``: 2D array (reps x tests) of scores from shuffled data (exp: ``ptci_null()``)
+    *DOES:*
+        * for each observed score ``s``: the mean number of null scores per replicate ``>= s``
+          divided by the number of observed scores ``>= s``, capped at 1 and made monotone
+          (no score gets a lower FDR than a higher score).  ``nan`` scores are ignored.
+    *RETURNS:*
+        * array of the empirical FDR of each observed score (``nan`` where ``observed`` is ``nan``)
+    """
+    observed = np.asarray(observed,dtype=float)
+    null = np.atleast_2d(np.asarray(null,dtype=float))
+    
+    fdr = np.empty(len(observed))
+    fdr.fill(np.nan)
+    scored = np.flatnonzero(~np.isnan(observed))
+    if len(scored) == 0:
+        return fdr
+    
+    null_sorted = np.sort(null[~np.isnan(null)])
+    obs_sorted = np.sort(observed[scored])
+    scores = observed[scored]
+    
+    null_hits = (len(null_sorted) - np.searchsorted(null_sorted,scores,side='left')) / float(len(null))
+    obs_hits = len(obs_sorted) - np.searchsorted(obs_sorted,scores,side='left')
+    raw = np.minimum(null_hits / obs_hits,1.0)
     
-#def get_fdr_full(original_dict,positive_keys,score_threshold,scoring_func,fdr_reps):
-    #"""
-    #RETURNS:
-        #- 
-    #"""
\ No newline at end of file
+    # running minimum from the highest score down
+    order = np.argsort(-scores,kind='mergesort')
+    raw[order] = np.minimum.accumulate(raw[order][::-1])[::-1]
+    fdr[scored] = raw
+    return fdr
@@ -9,28 +9,145 @@ import sys
 import os
 import fnmatch
 import csv
+from itertools import islice
 from collections import namedtuple
 
+import numpy as np
+
+from gfunc.data_classes import Bunch
+
+
+# rows parsed per batch by the streaming/array readers below
+DEFAULT_CHUNK_SIZE = 50000
+
+def sanitize_headers(headers):
+    """
+    Returns ``headers`` with the characters namedtuple fields can not hold
+    (space . ( ) - :) replaced by '_'.
+    """
+    return [x.replace(' ','_').replace('.','_').replace('(','_').replace(')','_').replace('-','_').replace(':','_') for x in headers]
+
+def _table_row_class(headers):
+    """
+    Returns the ``Table`` namedtuple class (with its ``get()`` helper) for ``headers``.
+    """
+    Table   = namedtuple('Table', headers)
+    # wrap Table.__getattribute__() for less typing
+    def get(self,colName):
+        return self.__getattribute__(colName)
+    Table.get = get
+    return Table
+
+def _open_table(tablePath,sep,headers):
+    """
+    Returns ``(file_obj,reader,headers)`` with the first row consumed as headers
+    unless ``headers`` are supplied, and the headers sanitized.
+    """
+    table_file = open(tablePath,'rU')
+    reader  = csv.reader(table_file, delimiter=sep)
+    if not headers:
+        headers = reader.next()
+    return table_file,reader,sanitize_headers(headers)
+
+def read_table_headers(tablePath,sep='\t'):
+    """
+    Returns the sanitized column headers from the first row of a table file.
+    """
+    table_file,reader,headers = _open_table(tablePath,sep,None)
+    table_file.close()
+    return headers
 
 def tableFile2namedTuple(tablePath,sep='\t',headers=None):
     """
     Returns namedTuple from table file using first row fields as
     col headers or a list supplied by user.
+    
+    Holds the whole table in memory: use ``iter_table_rows()`` or
+    ``tableFile2arrays()`` for large files.
     """
 
     reader  = csv.reader(open(tablePath,'rU'), delimiter=sep)
     if not headers:
         headers = reader.next()
-    headers = [x.replace(' ','_').replace('.','_').replace('(','_').replace(')','_').replace('-','_').replace(':','_') for x in headers]
-    Table   = namedtuple('Table', headers)
-    # wrap Table.__getattribute__() for less typing
-    def get(self,colName):
-        return self.__getattribute__(colName)
-    Table.get = get
+    headers = sanitize_headers(headers)
+    Table   = _table_row_class(headers)
     
     data    = [Table._make(x) for x in reader if x!=[]] # reader kept feeding an empty list at the end that botched everything!  wtf?!
     return data
 
+def iter_table_rows(tablePath,sep='\t',headers=None,chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    *GIVEN:*
+        * same arguments as ``tableFile2namedTuple()``
+        * ``chunk_size``: number of rows read and converted per batch; only one
+          batch of rows is held in memory at a time.
+    *RETURNS:*
+        * generator of the same ``Table`` namedtuples ``tableFile2namedTuple()`` would
+          return, read lazily from the file.
+    """
+    table_file,reader,headers = _open_table(tablePath,sep,headers)
+    make = _table_row_class(headers)._make
+    try:
+        for chunk in _iter_chunks(reader,chunk_size):
+            for x in chunk:
+                yield make(x)
+    finally:
+        table_file.close()
+
+def tableFile2arrays(tablePath,columns=None,dtypes=None,sep='\t',headers=None,chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    *GIVEN:*
+        * ``tablePath``, ``sep``, ``headers``: as for ``tableFile2namedTuple()``
+        * ``columns``: list of (sanitized) column names to load; all columns if ``None``
+        * ``dtypes``: dict of column name --> numpy dtype (exp: ``{'q_value':float}``);
+          columns not listed are loaded as fixed width strings
+        * ``chunk_size``: number of rows read per batch; only one batch of rows is held
+          as Python objects at a time, everything else is already in typed arrays.
+    *RETURNS:*
+        * Bunch of column name --> 1D numpy array with one entry per non-empty row
+    """
+    if dtypes is None:
+        dtypes = {}
+    table_file,reader,headers = _open_table(tablePath,sep,headers)
+    try:
+        if columns is None:
+            columns = headers
+        for name in columns:
+            if name not in headers:
+                raise KeyError("Column '%s' is not in %s (columns: %s)." % (name,tablePath,headers))
+        col_indexes = [headers.index(name) for name in columns]
+        
+        pieces = [[] for name in columns]
+        for chunk in _iter_chunks(reader,chunk_size):
+            for x in chunk:
+                if len(x) != len(headers):
+                    raise ValueError("Row %s of %s has %s fields instead of %s." % (x,tablePath,len(x),len(headers)))
+            for name,i,col_pieces in zip(columns,col_indexes,pieces):
+                col_pieces.append(np.array([x[i] for x in chunk],dtype=dtypes.get(name,str)))
+    finally:
+        table_file.close()
+    
+    arrays = Bunch()
+    for name,col_pieces in zip(columns,pieces):
+        if col_pieces:
+            arrays[name] = np.concatenate(col_pieces)
+        else:
+            arrays[name] = np.array([],dtype=dtypes.get(name,str))
+    return arrays
+
+def _iter_chunks(reader,chunk_size):
+    """
+    Yields lists of up to ``chunk_size`` non-empty rows from a csv ``reader``.
+    """
+    chunk_size = max(int(chunk_size),1)
+    while True:
+        raw_rows = list(islice(reader,chunk_size))
+        if not raw_rows:
+            return
+        chunk = [x for x in raw_rows if x!=[]]
+        if chunk:
+            yield chunk
+
 def walk_dirs_for_fileName(dir_path,pattern="*.xml"):
     """
     Recursively collects file paths in a dir and subdirs.
@@ -5,23 +5,31 @@ graphTools.py
 Code supporting building and querying the graphs.
 """
 
+import numpy as np
 import networkx as nx
 
 from gfunc.data_classes import Bunch
 from gfunc.data_classes import GFuncEdge
 from gfunc.data_classes import GFuncNode
+from gfunc.data_classes import columnarize
+from gfunc.data_classes import ColumnView
 
 class GraphBuilder(object):
     """
     """
-    def __init__(self,parsers):
+    def __init__(self,parsers,columnar=False):
         """
+        If ``columnar`` is ``True``, node and edge ``data`` are moved into array-backed
+        ``ColumnStore`` objects when the registries are mapped to the graph.
         """
         
         self.node_dict = {}
         self.edge_dict = {}
         self.parsers   = parsers
         self.graph     = nx.Graph()
+        self.columnar  = columnar
+        self.node_store = None
+        self.edge_store = None
         
     def populate_registries(self):
         """
@@ -37,29 +45,239 @@ class GraphBuilder(object):
     def map_registries_to_graph(self,nodes=True,edges=True):
         """
         Iterates through each registry creating graph nodes and edges.  Returns GraphHandler.
+        
+        When ``self.columnar`` is set, the mapped registry's data is (re)packed into a
+        fresh ``ColumnStore`` so that row ids follow the registry's iteration order.
         """
         if nodes == True:
+            if self.columnar:
+                self.node_store = columnarize(self.node_dict.itervalues())
             for node in self.node_dict.itervalues():
                 self.graph.add_node(node)
         
         if edges == True:
+            if self.columnar:
+                self.edge_store = columnarize(self.edge_dict.itervalues())
             for edge in self.edge_dict.itervalues():
                 self.graph.add_edge(edge.nodes[0],edge.nodes[1], Bunch({'edge':edge}))
             
-        return GraphHandler(self.node_dict,self.edge_dict,self.graph)
+        return GraphHandler(self.node_dict,self.edge_dict,self.graph,
+                            node_store=self.node_store,edge_store=self.edge_store)
+
+class CSRAdjacency(object):
+    """
+    Compressed sparse row (CSR) snapshot of a networkx graph of GFuncNodes so that
+    neighborhoods can be walked with integer ids instead of nested dict lookups.
+    
+    Attributes:
+        | ``nodes`` -- list of GFuncNodes; position is the node id
+        | ``node_ids`` -- dict mapping GFuncNode --> node id
+        | ``name_ids`` -- dict mapping node name --> node id
+        | ``edges`` -- list of GFuncEdges; position is the edge id
+        | ``indptr`` -- neighbors of node ``i`` are at ``indptr[i]:indptr[i+1]`` of:
+        | ``indices`` -- neighbor node ids
+        | ``edge_ids`` -- edge id connecting the node to each neighbor
+    
+    Neighbors are kept in the same order networkx iterates them, so results computed
+    from the snapshot match the ones computed by walking the graph.
+    
+    The snapshot does NOT follow later changes to the graph: rebuild it after edges are added
+    or removed.
+    """
+    def __init__(self,graph):
+        """
+        Takes the snapshot of ``graph`` (a networkx graph of GFuncNodes whose edges carry
+        their GFuncEdge as ``'edge'`` data).  Node ids follow ``graph.nodes()`` order and edge
+        ids the order in which each edge is first met while walking the neighborhoods.
+        """
+        self.nodes = graph.nodes()
+        self.node_ids = dict((node,i) for i,node in enumerate(self.nodes))
+        self.name_ids = dict((node.name,i) for i,node in enumerate(self.nodes))
+        
+        self.edges = []
+        edge_id_of = {}
+        counts  = np.zeros(len(self.nodes),dtype=int)
+        indices = []
+        edge_ids = []
+        for i,node in enumerate(self.nodes):
+            for neighbor,attrs in graph.adj[node].iteritems():
+                edge = attrs['edge']
+                try:
+                    e_id = edge_id_of[edge]
+                except KeyError:
+                    e_id = len(self.edges)
+                    edge_id_of[edge] = e_id
+                    self.edges.append(edge)
+                indices.append(self.node_ids[neighbor])
+                edge_ids.append(e_id)
+                counts[i] += 1
+        
+        self.indptr = np.zeros(len(self.nodes)+1,dtype=int)
+        np.cumsum(counts,out=self.indptr[1:])
+        self.indices  = np.array(indices,dtype=int)
+        self.edge_ids = np.array(edge_ids,dtype=int)
+        
+    @classmethod
+    def from_arrays(cls,nodes,edges,indptr,indices,edge_ids):
+        """
+        Returns a ``CSRAdjacency`` made from already built arrays (exp: the adjacency
+        of a saved graph snapshot) instead of walking a graph.
+        """
+        csr = cls.__new__(cls)
+        csr.nodes = list(nodes)
+        csr.node_ids = dict((node,i) for i,node in enumerate(csr.nodes))
+        csr.name_ids = dict((node.name,i) for i,node in enumerate(csr.nodes))
+        csr.edges = list(edges)
+        csr.indptr = indptr
+        csr.indices = indices
+        csr.edge_ids = edge_ids
+        return csr
+    
+    def __len__(self):
+        """
+        Returns the number of nodes in the snapshot.
+        """
+        return len(self.nodes)
+    
+    def neighbors(self,node_id):
+        """
+        Returns array of the node ids adjacent to ``node_id``.
+        """
+        return self.indices[self.indptr[node_id]:self.indptr[node_id+1]]
+    
+    def neighbor_edges(self,node_id):
+        """
+        Returns array of the edge ids connecting ``node_id`` to each of ``neighbors(node_id)``.
+        """
+        return self.edge_ids[self.indptr[node_id]:self.indptr[node_id+1]]
+    
+    def gather(self,node_ids):
+        """
+        Returns ``(offsets,neighbors,edge_ids)`` with the neighborhoods of ``node_ids`` laid
+        end to end: the neighbors of ``node_ids[i]`` are ``neighbors[offsets[i]:offsets[i+1]]``.
+        """
+        node_ids = np.asarray(node_ids,dtype=int)
+        starts = self.indptr[node_ids]
+        counts = self.indptr[node_ids+1] - starts
+        offsets = np.zeros(len(node_ids)+1,dtype=int)
+        np.cumsum(counts,out=offsets[1:])
+        
+        positions = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1],counts)
+        return offsets,self.indices[positions],self.edge_ids[positions]
+    
+    def edge_id(self,node_id1,node_id2):
+        """
+        Returns the edge id connecting two node ids.  Raises ``KeyError`` if they are not adjacent.
+        """
+        hits = np.flatnonzero(self.neighbors(node_id1) == node_id2)
+        if len(hits) == 0:
+            raise KeyError((node_id1,node_id2))
+        return self.neighbor_edges(node_id1)[hits[0]]
+    
+    def edge_ids_to(self,node_id):
+        """
+        Returns array with one entry per node id holding the edge id that connects that node
+        to ``node_id`` (-1 where there is no such edge).
+        """
+        edge_of = np.empty(len(self.nodes),dtype=int)
+        edge_of.fill(-1)
+        edge_of[self.neighbors(node_id)] = self.neighbor_edges(node_id)
+        return edge_of
+    
+    def edge_values(self,data_type):
+        """
+        Returns float array with the ``data_type`` value of every edge id (``nan`` where missing).
+        Reads straight from the ``ColumnStore`` when all edges share one.
+        """
+        values = np.empty(len(self.edges))
+        values.fill(np.nan)
+        if len(self.edges) == 0:
+            return values
+        
+        stores = set([edge.data._store if isinstance(edge.data,ColumnView) else None for edge in self.edges])
+        store = stores.pop()
+        if store is not None and len(stores) == 0:
+            rows = np.array([edge.data.row for edge in self.edges],dtype=int)
+            column,present = store.column(data_type)
+            if column.ndim == 1:
+                has = present[rows]
+                values[has] = column[rows[has]]
+                return values
+        
+        for e_id,edge in enumerate(self.edges):
+            try:
+                values[e_id] = getattr(edge.data,data_type)
+            except AttributeError:
+                pass
+        return values
+        
+
+class VirtualTarget(object):
+    """
+    A target node that is never installed in the graph.
+    
+    Instead of edges from the target to every node, it keeps one dense array per polled
+    metric holding the target's relation to each node of a ``CSRAdjacency`` snapshot
+    (indexed by node id).  Many virtual targets can be polled against one loaded graph,
+    even concurrently, since nothing in the graph or its nodes is changed.
+    """
+    def __init__(self,source_node,relations,csr,name='target'):
+        """
+        *GIVEN:*
+            * ``source_node``: the GFuncNode whose data the target copies
+            * ``relations``: Bunch keyed by metric of float arrays of length ``len(csr)``
+            * ``csr``: the ``CSRAdjacency`` snapshot the arrays are indexed by
+        """
+        self.name = name
+        self.source_node = source_node
+        self.relations = relations
+        self.csr = csr
+    
+    def __repr__(self):
+        """
+        Returns ``VirtualTarget('<source node name>')``.
+        """
+        return "VirtualTarget(%r)" % (self.source_node.name)
+    
+    def relation_to(self,node,metric):
+        """
+        Returns the ``metric`` relation between the target and ``node``.
+        """
+        return self.relations[metric][self.csr.node_ids[node]]
 
 class GraphHandler(object):
     """
     TODO: Doc
     """
-    def __init__(self,node_dict,edge_dict,graph):
+    csr = None
+    
+    def __init__(self,node_dict,edge_dict,graph,node_store=None,edge_store=None):
         """
         TODO: Doc
+        
+        ``node_store``/``edge_store`` are the ``ColumnStore`` objects backing node and
+        edge data when the graph was built with ``GraphBuilder(columnar=True)``.
         """
         self.node_dict = node_dict
         self.edge_dict = edge_dict
         self.target_node = None
         self.graph = graph
+        self.node_store = node_store
+        self.edge_store = edge_store
+        self.csr = None
+    
+    def build_csr(self):
+        """
+        Builds, stores and returns a ``CSRAdjacency`` snapshot of ``self.graph``.
+        """
+        self.csr = CSRAdjacency(self.graph)
+        return self.csr
+    
+    def invalidate_csr(self):
+        """
+        Drops the ``CSRAdjacency`` snapshot.  Call whenever edges are added or removed.
+        """
+        self.csr = None
     
     def install_metric_handlers(self,rel_hndler,vote_hndlr):
         """
@@ -69,23 +287,57 @@ class GraphHandler(object):
         self.vote_handler = vote_hndlr
         #self.vote_handler.set_vote_types(self.relation_handler.get_vote_types())
         
-    def measure_relations(self):
+    def measure_relations(self,batched=False):
         """
         Cues RelationsHandler to do its thing after pasing it self.edge_dict.
+        
+        ``batched=True`` measures all edges at once for metrics that support it.
         """
-        self.relation_handler.measure_relations(self.edge_dict)
+        self.relation_handler.measure_relations(self.edge_dict,batched=batched)
         
     def take_votes(self,node_list,poll_func=None):
         """
         Cues VoteHandler to do its thing after pasing it a list of specific
         GFuncNode objects.
         
+        Polling runs on the stored ``CSRAdjacency`` snapshot, which is built on the first
+        call and reused until ``invalidate_csr()`` (exp: by ``install_target()``).
+        
         Example:
         >>> node_list = [node for node in node_dict.itervalues() if node.species == 'Anopheles gambie'].
         """
-        self.vote_handler.take_votes(node_list,poll_func)
+        csr = None
+        if poll_func is None:
+            csr = self.csr if self.csr is not None else self.build_csr()
+        self.vote_handler.take_votes(node_list,poll_func,csr=csr)
         
     
+    def virtual_targets(self,node_names):
+        """
+        Returns a list of ``VirtualTarget`` objects, one per name in ``node_names``.
+        The relations of all targets to all nodes are measured at once and nothing
+        is added to the graph.
+        """
+        csr = self.csr if self.csr is not None else self.build_csr()
+        sources = [self.node_dict[name] for name in node_names]
+        relations = self.relation_handler.measure_target_relations(sources,csr.nodes)
+        
+        targets = []
+        for t_i,source in enumerate(sources):
+            target_relations = Bunch()
+            for metric,matrix in relations.iteritems():
+                target_relations[metric] = matrix[t_i]
+            targets.append(VirtualTarget(source,target_relations,csr))
+        return targets
+    
+    def virtual_target(self,node_name):
+        """
+        Non-mutating alternative to ``clone_node_as_target()`` + ``install_target()``:
+        returns a ``VirtualTarget`` for ``node_name`` to use with
+        ``VoteHandler.poll_virtual_target()``.
+        """
+        return self.virtual_targets([node_name])[0]
+    
     def clone_node_as_target(self,node_name):
         """
         TODO: Doc
@@ -119,3 +371,6 @@ class GraphHandler(object):
         
         # register node with node_dict after setting up edges so there is no edge(target,target)
         self.node_dict[target.name] = target
+        
+        # the target's edges are not in any existing CSR snapshot
+        self.invalidate_csr()
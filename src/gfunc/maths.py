@@ -8,6 +8,8 @@ Code supporting specialized calculations for gfunc.
 import numpy as np
 #np.seterr(divide='raise')
 
+from scipy import special
+
 def bayesian_score(c,m,n,scores,scale_mod=1):
     """
     | BS = ((c * m) + sum([x for x in scores])) / (n + c)
@@ -34,12 +36,63 @@ def weight_d_for_ptci(d_i,d_min,d_max,w_min=1.0,w_max=1.1):
     
     Default weight scale is no change for the shortest distance (return 1.0) to
     a 10% reward for the longest distance (return 1.1).
+    
+    Works element-wise if ``d_i``, ``d_min`` and ``d_max`` are arrays.
     """
-    if (d_i < d_min) or (d_i > d_max):
+    if np.any(d_i < d_min) or np.any(d_i > d_max):
         raise ValueError("d_i (%s) is outside of range (%s to %s)" % (d_i,d_min,d_max))
     
     return ((d_i-d_min)*(w_max-w_min))/(d_max-d_min) + w_min
 
+def pearsonr_rows(x,y):
+    """
+    Row-wise version of ``scipy.stats.pearsonr``: returns arrays ``(r_vals,p_vals)``
+    for each pair of rows ``x[k]``, ``y[k]`` of two equally shaped 2D arrays.  Leading
+    dimensions are broadcast, so ``x[:,np.newaxis,:]`` and ``y[np.newaxis,:,:]`` give every
+    row of ``x`` against every row of ``y``.
+    
+    Follows the same arithmetic as ``scipy.stats.pearsonr`` so that results match
+    the scalar calls exactly.  Rows without variance give ``nan`` for both values.
+    """
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    if x.shape[-1] != y.shape[-1]:
+        raise ValueError("x and y rows must have the same length: %s != %s" % (x.shape[-1],y.shape[-1]))
+    
+    df = x.shape[-1] - 2
+    with np.errstate(divide='ignore',invalid='ignore'):
+        xm = x - x.mean(axis=-1)[...,np.newaxis]
+        ym = y - y.mean(axis=-1)[...,np.newaxis]
+        r_num = np.add.reduce(xm * ym, axis=-1)
+        r_den = np.sqrt(np.sum(xm * xm, axis=-1) * np.sum(ym * ym, axis=-1))
+        r_vals = np.clip(r_num / r_den, -1.0, 1.0)
+        
+        t_squared = r_vals**2 * (df / ((1.0 - r_vals) * (1.0 + r_vals)))
+        p_vals = special.betainc(0.5*df, 0.5, np.fmin(df / (df + t_squared), 1.0))
+        p_vals[np.abs(r_vals) == 1.0] = 0.0
+    
+    return r_vals,p_vals
+
+def pearsonr_matrix(x,y,chunk_elements=2**22):
+    """
+    Returns arrays ``(r_vals,p_vals)`` of shape ``(len(x),len(y))`` holding the pearson
+    correlation of every row of ``x`` with every row of ``y`` (see ``pearsonr_rows()``).
+    
+    Rows of ``x`` are processed in chunks so that the temporary arrays hold about
+    ``chunk_elements`` values.
+    """
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    r_vals = np.empty((len(x),len(y)))
+    p_vals = np.empty((len(x),len(y)))
+    
+    rows_per_chunk = max(1,chunk_elements // max(1,y.size))
+    for start in range(0,len(x),rows_per_chunk):
+        stop = start + rows_per_chunk
+        r_vals[start:stop],p_vals[start:stop] = pearsonr_rows(x[start:stop,np.newaxis,:],
+                                                              y[np.newaxis,:,:])
+    return r_vals,p_vals
+
 def convert_to_z_scores(data_vector):
     vec_mean = np.mean(data_vector)
     vec_median = np.median(data_vector)
@@ -5,9 +5,13 @@ motifs.py
 Code supporting the searching, recording, and analysis of sequence motifs for gFunc.
 """
 
+import os
 import cPickle
+import multiprocessing
 
 from collections import defaultdict
+from collections import deque
+from itertools import islice
 
 import numpy as np
 from scipy import stats
@@ -16,6 +20,7 @@ import pandas
 
 import MOODS
 
+from gfunc.data_classes import Bunch
 from gfunc.parsers.JASPAR import ParseJasparMatrixOnly
 from gfunc.fileIO import tableFile2namedTuple
 
@@ -35,6 +40,194 @@ from rSeq.utils.files import ParseFastA
 
 
 
+# number of sequences sent to a scanning worker at a time
+SCAN_BATCH_SIZE = 50
+
+# motif matrices and settings of the scanning worker processes (see ``_init_scan_worker()``)
+_scan_job = {}
+
+def moods_scan(sequence,matrices,thresh,both_strands=False):
+    """
+    *GIVEN:*
+        * ``sequence``: a single sequence to be scanned.
+        * ``matrices``: list of motif matrices
+        * ``thresh``: threshold cut-off for MOODS to report a 'hit' location.
+        * ``both_strands``: search both strands of the sequence.
+    *DOES:*
+        * Scans ``sequence`` for each motif with ``MOODS.search``.
+    *RETURNS:*
+        * nested tuples of (location,score) hits: one tuple per motif in ``matrices``
+    """
+    hits = MOODS.search(sequence=sequence, matrices=matrices, thresholds=thresh, both_strands=both_strands)
+    
+    # when both_strands=True, MOODS seems to output one empty list for every motif. Remove these
+    if both_strands == True:
+        hits = hits[:len(matrices)]
+    
+    return tuple([tuple(x) for x in hits])
+
+def _init_scan_worker(matrices,thresh,both_strands):
+    """
+    Stores the motif matrices and settings once in each scanning worker process.
+    """
+    _scan_job['matrices'] = matrices
+    _scan_job['thresh'] = thresh
+    _scan_job['both_strands'] = both_strands
+
+def _scan_batch(batch):
+    """
+    Scans one batch of ``(name,sequence)`` pairs in a worker and returns ``[(name,hits),...]``.
+    """
+    return [(name,moods_scan(seq,_scan_job['matrices'],_scan_job['thresh'],_scan_job['both_strands']))
+            for name,seq in batch]
+
+def iter_MOODS_scans(seq_items,matrices,thresh,both_strands=False,processes=1,batch_size=SCAN_BATCH_SIZE):
+    """
+    *GIVEN:*
+        * ``seq_items``: iterable of ``(name,sequence)`` pairs (exp: a ``ParseFastA`` object)
+        * ``matrices``,``thresh``,``both_strands``: see ``moods_scan()``
+        * ``processes``: number of worker processes (``None`` = one per cpu; 1 scans in this process)
+        * ``batch_size``: number of sequences sent to a worker at a time
+    *DOES:*
+        * Scans every sequence with ``moods_scan()``.  The matrices are handed to each worker once
+          and the sequences are sent in batches.  Only a few batches per worker are read ahead
+          of the results, so memory stays bounded however long ``seq_items`` is.
+    *RETURNS:*
+        * generator of ``(name,hits)`` in the order of ``seq_items``
+    """
+    if processes == 1:
+        for name,seq in seq_items:
+            yield name,moods_scan(seq,matrices,thresh,both_strands)
+        return
+    
+    max_pending = 2 * (processes or multiprocessing.cpu_count())
+    seq_items = iter(seq_items)
+    
+    pool = multiprocessing.Pool(processes,initializer=_init_scan_worker,
+                                initargs=(matrices,thresh,both_strands))
+    try:
+        pending = deque()
+        while True:
+            batch = list(islice(seq_items,batch_size))
+            if batch:
+                pending.append(pool.apply_async(_scan_batch,(batch,)))
+            if pending and (not batch or len(pending) >= max_pending):
+                for result in pending.popleft().get():
+                    yield result
+            if not batch and not pending:
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+
+HIT_TABLE_COLUMNS = ('seq_names','motif_names','seq_ids','motif_ids','positions','strands','scores')
+
+def build_hit_table(scan_items,motif_names):
+    """
+    *GIVEN:*
+        * ``scan_items``: iterable of ``(seqName,moods_hits_for_seq)`` (exp: ``Motifs.iter_scan()``
+          or ``moods_result_dict.iteritems()``)
+        * ``motif_names``: correctly ordered motif names (Motifs.motifs.keys())
+    *DOES:*
+        * packs the hits into parallel arrays instead of the dict tree of ``process_MOODS_results()``
+          one sequence at a time, so ``scan_items`` can be streamed.
+    *RETURNS:*
+        * Bunch with:
+            * ``seq_names``, ``motif_names``: string arrays; ids index into these
+            * ``seq_ids``, ``motif_ids``: int32 arrays, one entry per hit
+            * ``positions``: int64 array of the hit locations as reported by MOODS
+            * ``strands``: int8 array: -1 for the negative locations MOODS gives reverse strand hits, else 1
+            * ``scores``: float64 array of the hit scores
+    """
+    seq_names = []
+    chunks = defaultdict(list)
+    for seq_id,(seq,motif_data) in enumerate(scan_items):
+        seq_names.append(seq)
+        for motif_id,hits in enumerate(motif_data):
+            if len(hits) == 0:
+                continue
+            hits = np.array(hits,dtype=np.float64).reshape(-1,2)
+            chunks['seq_ids'].append(np.repeat(np.int32(seq_id),len(hits)))
+            chunks['motif_ids'].append(np.repeat(np.int32(motif_id),len(hits)))
+            chunks['positions'].append(hits[:,0].astype(np.int64))
+            chunks['scores'].append(hits[:,1])
+    
+    dtypes = {'seq_ids':np.int32,'motif_ids':np.int32,'positions':np.int64,'scores':np.float64}
+    table = Bunch()
+    for name,dtype in dtypes.iteritems():
+        table[name] = np.concatenate(chunks[name]) if chunks[name] else np.array([],dtype=dtype)
+    table.strands = np.where(table.positions < 0,-1,1).astype(np.int8)
+    table.seq_names = np.array(seq_names,dtype=str)
+    table.motif_names = np.array(list(motif_names),dtype=str)
+    return table
+
+def save_hit_table(hit_table,out_path):
+    """
+    *GIVEN:*
+        * ``hit_table``: output of ``build_hit_table()``
+        * ``out_path``: ending in '.npz': one numpy archive; otherwise a directory of one
+          ``.npy`` file per column that ``load_hit_table()`` can memory map
+    *RETURNS:*
+        * ``None``
+    """
+    if out_path.endswith('.npz'):
+        np.savez(out_path,**dict((name,hit_table[name]) for name in HIT_TABLE_COLUMNS))
+        return
+    
+    if not os.path.isdir(out_path):
+        os.makedirs(out_path)
+    for name in HIT_TABLE_COLUMNS:
+        np.save(os.path.join(out_path,'%s.npy' % (name)),np.ascontiguousarray(hit_table[name]))
+
+def load_hit_table(in_path,mmap_mode='r'):
+    """
+    *GIVEN:*
+        * ``in_path``: written by ``save_hit_table()``
+        * ``mmap_mode``: ``numpy.load`` mmap_mode of the columns of a directory table
+          (``None`` reads them into memory); '.npz' tables are always read into memory
+    *RETURNS:*
+        * Bunch laid out like the output of ``build_hit_table()``
+    """
+    if in_path.endswith('.npz'):
+        archive = np.load(in_path)
+        try:
+            return Bunch((name,archive[name]) for name in HIT_TABLE_COLUMNS)
+        finally:
+            archive.close()
+    
+    return Bunch((name,np.load(os.path.join(in_path,'%s.npy' % (name)),mmap_mode=mmap_mode))
+                 for name in HIT_TABLE_COLUMNS)
+
+def motif_presence_scores(hit_table):
+    """
+    *GIVEN:*
+        * ``hit_table``: output of ``build_hit_table()`` or ``load_hit_table()``
+    *DOES:*
+        * same motif presence scores as ``motif_profiles_weighted_by_score()``: sum of the positive
+          scores of each motifName:seqName pair with at least one hit, in one grouped reduction.
+    *RETURNS:*
+        * mps_table: ``pandas.DataFrame`` laid out like ``motif_profiles_weighted_by_score()``'s
+          (index = motifName, columns = seqName, ``nan`` where a motif has no hit in a seq)
+    """
+    motif_count = len(hit_table.motif_names)
+    pair_count = len(hit_table.seq_names) * motif_count
+    pairs = np.asarray(hit_table.seq_ids,dtype=np.int64) * motif_count + hit_table.motif_ids
+    scores = np.asarray(hit_table.scores)
+    
+    hits_per_pair = np.bincount(pairs,minlength=pair_count)
+    summed = np.bincount(pairs,weights=np.where(scores > 0,scores,0),minlength=pair_count).astype(np.float64)
+    summed[hits_per_pair == 0] = np.nan
+    summed = summed.reshape(len(hit_table.seq_names),motif_count)
+    
+    # like the dict tree, only seqs and motifs with hits get a column/row
+    seq_has_hits = (hits_per_pair.reshape(summed.shape) > 0).any(axis=1)
+    motif_has_hits = (hits_per_pair.reshape(summed.shape) > 0).any(axis=0)
+    
+    mps_table = pandas.DataFrame(summed[seq_has_hits][:,motif_has_hits].T,
+                                 index=hit_table.motif_names[motif_has_hits],
+                                 columns=hit_table.seq_names[seq_has_hits])
+    return mps_table.sort_index(axis=0).sort_index(axis=1)
+
 def motif_profiles_weighted_by_score(processed_moods_result_dict):
     """
     *GIVEN:*
@@ -176,25 +369,14 @@ class Motifs(object):
         *RETURNS:*
             * ``moods_hits_for_seq``: nested tuples
         """
-        # set up recorded options
-        motifs = self.motifs.values()
-        thresh = self._settings['thresh']
-        both_strands = self._settings['both_strands']       
-        
-        # search
-        moods_hits_for_seq = MOODS.search(sequence=sequence, matrices=motifs, thresholds=thresh, both_strands=both_strands)
-        
-        # when both_strands=True, MOODS seems to output one empty list for every motif. Remove these
-        if both_strands == True:
-            moods_hits_for_seq = moods_hits_for_seq[:len(motifs)]
-            
-        
-        return tuple([tuple(x) for x in moods_hits_for_seq])
+        return moods_scan(sequence,self.motifs.values(),self._settings['thresh'],self._settings['both_strands'])
         
-    def scan_seqDict(self,seq_dict):
+    def scan_seqDict(self,seq_dict,processes=1,batch_size=SCAN_BATCH_SIZE):
         """
         *GIVEN:*
             * ``seq_dict``: dict of sequences (key=rec_name,value=rec_sequence).
+            * ``processes``: number of worker processes to scan with (see ``iter_MOODS_scans()``)
+            * ``batch_size``: number of sequences sent to a worker at a time
         *DOES:*
             * Scans each seq in ``seq_dict`` for each motif in ``self``.
             * Reports the location AND score for each 'hit' in each sequence.
@@ -204,8 +386,20 @@ class Motifs(object):
 
         moods_hits_for_seqDict = defaultdict(tuple)
 
-        for name,seq in seq_dict.iteritems():
-            moods_hits_for_seq = self.scan_seq(sequence=seq)
+        for name,moods_hits_for_seq in self.iter_scan(seq_dict.iteritems(),processes=processes,batch_size=batch_size):
             moods_hits_for_seqDict[name] = moods_hits_for_seq
             
-        return moods_hits_for_seqDict
\ No newline at end of file
+        return moods_hits_for_seqDict
+    
+    def iter_scan(self,seq_items,processes=1,batch_size=SCAN_BATCH_SIZE):
+        """
+        *GIVEN:*
+            * ``seq_items``: iterable of ``(name,sequence)`` pairs (exp: a ``ParseFastA`` object)
+            * ``processes``,``batch_size``: see ``iter_MOODS_scans()``
+        *DOES:*
+            * Streams the sequences through ``iter_MOODS_scans()`` with the motifs and settings of ``self``.
+        *RETURNS:*
+            * generator of ``(name,moods_hits_for_seq)`` in the order of ``seq_items``
+        """
+        return iter_MOODS_scans(seq_items,self.motifs.values(),self._settings['thresh'],
+                                self._settings['both_strands'],processes=processes,batch_size=batch_size)
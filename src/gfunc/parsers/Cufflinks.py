@@ -5,6 +5,7 @@ Cufflinks.py
 Code supporting parsing of Cufflinks type raw data files.
 """
 from collections import defaultdict
+from itertools import izip
 
 import numpy as np
 
@@ -17,15 +18,21 @@ from gfunc.parsers.base import GFuncParserBase
 from gfunc.data_classes import GFuncNode
 from gfunc.data_classes import Bunch
 from gfunc.fileIO import tableFile2namedTuple
+from gfunc.fileIO import iter_table_rows
+from gfunc.fileIO import tableFile2arrays
+from gfunc.fileIO import read_table_headers
 
 class CDiffFpkmTrackerParser(GFuncParserBase):
     """
     Class to accept CuffDiff FKPM data table and init/update the relevant gFuncNode Objects.
     """
     
-    def __init__(self, cuffdiff_fpkm_path, species, cuffdiff_exp_path=None, name_col='nearest_ref_id',combine_transcripts=True,tx_2_gene=None):
+    def __init__(self, cuffdiff_fpkm_path, species, cuffdiff_exp_path=None, name_col='nearest_ref_id',combine_transcripts=True,tx_2_gene=None,q_thresh=0.05):
         """
         Test doc for init'ing CuffDiff parser.
+        
+        ``q_thresh`` is the q-value at or below which a node's XLOC is flagged as
+        ``_sigDiff``; nodes can be re-flagged later with ``flag_sigDiff()``.
         """
         # everything after rows[9] is FPKM data
         
@@ -33,7 +40,9 @@ class CDiffFpkmTrackerParser(GFuncParserBase):
         self.data_type = 'expression_vector'
         self._name_col = name_col
         self._expDiff  = cuffdiff_exp_path
-        self._tableFile = tableFile2namedTuple(tablePath=cuffdiff_fpkm_path,sep='\t')
+        self.q_thresh  = q_thresh
+        self._node_xlocs = {}
+        self._fpkm_table = self._load_fpkm_table(cuffdiff_fpkm_path)
         self._combine_tx = combine_transcripts
         if combine_transcripts:
             if tx_2_gene is None:
@@ -43,39 +52,67 @@ class CDiffFpkmTrackerParser(GFuncParserBase):
             self.gene_vectors = self._sum_transcripts()
             
         if self._expDiff is not None:
-            self._expDiff = build_expDiffTable_dict(self._expDiff)
+            self._expDiff = ExpDiffQIndex(self._expDiff)
+    
+    def _load_fpkm_table(self, cuffdiff_fpkm_path):
+        """
+        *RETURNS:*
+            * Bunch with ``names`` (``name_col``) and ``xlocs`` (``gene_id``) lists and
+              ``fpkm``: 2D float array of the FPKM columns (every 3rd column from
+              column 10 on) with one row per tracking row.
+        """
+        headers = read_table_headers(cuffdiff_fpkm_path)
+        fpkm_cols = headers[10::3]
+        
+        columns = tableFile2arrays(cuffdiff_fpkm_path,columns=[self._name_col,'gene_id']+fpkm_cols,
+                                   dtypes=dict((col,float) for col in fpkm_cols))
+        fpkm = np.empty((len(columns.gene_id),len(fpkm_cols)))
+        for i,col in enumerate(fpkm_cols):
+            fpkm[:,i] = columns[col]
+        
+        return Bunch(names=columns[self._name_col].tolist(),
+                     xlocs=columns.gene_id.tolist(),
+                     fpkm=fpkm)
     
-    def _setup_expn_vector(self, table_row):
+    def _setup_expn_vector(self, record):
         """
         TODO: Doc
         """
-        if not self._combine_tx:
-            name = table_row.get(self._name_col)
-            xloc = table_row.gene_id
-            vector = np.array([float(table_row[x]) for x in range(10,len(table_row),3)])
-            return name,xloc,vector
-        else:
-            gene_rec = table_row # for clairity that this is different process
-            name_xloc,vector = gene_rec
-            name,xloc = name_xloc     # name_xloc = (name,xloc)
-            return name,xloc,vector
+        name_xloc,vector = record
+        name,xloc = name_xloc     # name_xloc = (name,xloc)
+        return name,xloc,vector
         
     def _sum_transcripts(self):
         """
-        TODO: doc
+        Sums the FPKM vectors of all tracking rows sharing the same
+        ``(tx2gene(name),gene_id)`` key.
+        
+        *RETURNS:*
+            * defaultdict of ``(gene_name,xloc)`` --> summed FPKM vector
         """
-        # TODO: comment this
+        table = self._fpkm_table
+        n_conditions = table.fpkm.shape[1]
         def zeros():
-            return np.zeros(len(self._tableFile[0][10::3]))
+            return np.zeros(n_conditions)
         
-        gene_vectors = defaultdict(zeros)
+        # factorize keys in order of first appearance
+        key_ids = {}
+        keys = []
+        inverse = np.empty(len(table.names),dtype=int)
+        for i,name_xloc in enumerate(izip([self._tx2gene_func(name) for name in table.names],table.xlocs)): # Converts Tx symbol into Gene Symbol
+            try:
+                inverse[i] = key_ids[name_xloc]
+            except KeyError:
+                inverse[i] = key_ids[name_xloc] = len(keys)
+                keys.append(name_xloc)
         
-        for row in self._tableFile:
-            name = self._tx2gene_func(row.get(self._name_col)) # Converts Tx symbol into Gene Symbol
-            xloc = row.gene_id
-            vector = np.array([float(row[x]) for x in range(10,len(row),3)])
-            name_xloc = (name,xloc)
-            gene_vectors[name_xloc] = gene_vectors[name_xloc] + vector
+        # unbuffered scatter-add: rows are summed in file order like the old per row loop
+        sums = np.zeros((len(keys),n_conditions))
+        np.add.at(sums,inverse,table.fpkm)
+        
+        gene_vectors = defaultdict(zeros)
+        for name_xloc,vector in izip(keys,sums):
+            gene_vectors[name_xloc] = vector
             
         return gene_vectors
              
@@ -86,7 +123,8 @@ class CDiffFpkmTrackerParser(GFuncParserBase):
         GFuncNode in node_dict or creates one and adds it to that then registers it in node_dict.
         """
         if not self._combine_tx:
-            data = self._tableFile
+            table = self._fpkm_table
+            data = izip(izip(table.names,table.xlocs),table.fpkm)
         else:
             data = self.gene_vectors.iteritems()
         for record in data: # may want to close this out
@@ -97,14 +135,31 @@ class CDiffFpkmTrackerParser(GFuncParserBase):
                 node = GFuncNode(name=name, species=self.species, graph=graph, is_target=False, debug=False)
                 node.set_data(data=vector,data_type=self.data_type)
                 node_dict[name] = node
-                
-            node_dict[name]._sigDiff = am_i_sigDiff(xloc_number=xloc, expDiffTable_dict=self._expDiff, q_thresh=0.05)
+            
+            # last XLOC seen for a name wins, as it did when flagging row by row
+            self._node_xlocs[name] = xloc
+        
+        if self._expDiff is not None:
+            self.flag_sigDiff(node_dict)
+    
+    def flag_sigDiff(self, node_dict, q_thresh=None):
+        """
+        Sets ``_sigDiff`` on every node registered by this parser using the
+        pre-computed min q-value per XLOC, so that ``q_thresh`` can be changed
+        without re-reading the exp-diff table.  ``q_thresh=None`` uses ``self.q_thresh``.
+        """
+        if q_thresh is None:
+            q_thresh = self.q_thresh
+        names = self._node_xlocs.keys()
+        flags = self._expDiff.sigDiff_flags([self._node_xlocs[name] for name in names],q_thresh)
+        for name,flag in izip(names,flags):
+            node_dict[name]._sigDiff = bool(flag)
 
 def transfer_nearestRefgeneSymbol_from_isoform_to_gene_tracking(isoform_fpkm_path,gene_fpkm_path):
     """
     TODO: doc
     """
-    iso_table = tableFile2namedTuple(isoform_fpkm_path)
+    iso_table = iter_table_rows(isoform_fpkm_path)
     gene_table = tableFile2namedTuple(gene_fpkm_path)
     
     gene_id_2_nearest_ref = defaultdict(set)
@@ -169,7 +224,7 @@ def build_expDiffTable_dict(expDiffTable_path):
         namedtuple-ified rows with same XLOC_xxxxx
     """
     
-    rows = tableFile2namedTuple(expDiffTable_path)
+    rows = iter_table_rows(expDiffTable_path)
     expDiffTable_dict = defaultdict(list)
     
     for row in rows:
@@ -177,14 +232,81 @@ def build_expDiffTable_dict(expDiffTable_path):
     
     return expDiffTable_dict
     
+class ExpDiffQIndex(object):
+    """
+    Minimum q-value of each XLOC_xxxxx in a cuffdiff exp-diff table, read once so
+    that significance lookups at any threshold are O(1) and whole lists of XLOCs
+    can be flagged at once.
+    
+    Attributes:
+        | ``xlocs`` -- sorted array of the XLOC_xxxxx names
+        | ``min_q`` -- float array with the smallest q_value of each of ``xlocs``
+    """
+    def __init__(self, expDiffTable_path):
+        """
+        *GIVEN:*
+            * ``expDiffTable_path``: path to a cuffdiff exp-diff table (needs its
+              ``gene_id`` and ``q_value`` columns)
+        *DOES:*
+            * reads the two columns and keeps the minimum ``q_value`` of each XLOC.
+        """
+        table = tableFile2arrays(expDiffTable_path,columns=['gene_id','q_value'],dtypes={'q_value':float})
+        self.xlocs,inverse = np.unique(table.gene_id,return_inverse=True)
+        self.min_q = np.empty(len(self.xlocs))
+        self.min_q.fill(np.inf)
+        np.minimum.at(self.min_q,inverse,table.q_value)
+        self._ids = dict((xloc,i) for i,xloc in enumerate(self.xlocs.tolist()))
+    
+    def __len__(self):
+        """
+        Returns the number of XLOCs in the index.
+        """
+        return len(self.xlocs)
+    
+    def __contains__(self, xloc_number):
+        return xloc_number in self._ids
+    
+    def _id(self, xloc_number):
+        """
+        Returns the index of ``xloc_number``.  Raises ``ValueError`` if it has no tests,
+        like ``am_i_sigDiff()`` did with an empty list of rows.
+        """
+        try:
+            return self._ids[xloc_number]
+        except KeyError:
+            raise ValueError('%s has no tests in the exp-diff table.' % (xloc_number))
+    
+    def min_q_value(self, xloc_number):
+        """
+        Returns the smallest q_value of ``xloc_number``'s tests.
+        """
+        return self.min_q[self._id(xloc_number)]
+    
+    def is_sigDiff(self, xloc_number, q_thresh):
+        """
+        Returns ``True`` if at least one test of ``xloc_number`` has q_value <= ``q_thresh``.
+        """
+        return bool(self.min_q[self._id(xloc_number)] <= q_thresh)
+    
+    def sigDiff_flags(self, xloc_numbers, q_thresh):
+        """
+        Returns bool array: ``is_sigDiff()`` for each of ``xloc_numbers``.
+        """
+        ids = np.array([self._id(xloc) for xloc in xloc_numbers],dtype=int)
+        return self.min_q[ids] <= q_thresh
+
 def am_i_sigDiff(xloc_number, expDiffTable_dict, q_thresh):
     """
     | for lines in cuffdiff_fpkm_table:
     |     Return ``True`` if:
     |         at least one of current line's XLOC_xxxx pair tests in ``expDiffTable_dict`` has *q_val* <= ``q_thresh``
     |     Else Return ``False``
-        
+    
+    ``expDiffTable_dict`` may also be an ``ExpDiffQIndex``.
     """
+    if isinstance(expDiffTable_dict,ExpDiffQIndex):
+        return expDiffTable_dict.is_sigDiff(xloc_number,q_thresh)
+    
     q_vals = [float(x.q_value) for x in expDiffTable_dict[xloc_number]]
     
     if min(q_vals) <= q_thresh:
@@ -6,85 +6,425 @@ Code supporting parsing phyloXML files using the ETE2 package.
 """
 import sys,os
 import cPickle
+import hashlib
+import multiprocessing
+import tempfile
+
+import numpy as np
 
 import ete2
 
 from gfunc.parsers.base import GFuncParserBase
-from gfunc.xpermutations import xuniqueCombinations
 from gfunc.fileIO import walk_dirs_for_fileName
 from gfunc.data_classes import GFuncEdge
 from gfunc.data_classes import GFuncNode
+from gfunc.data_classes import Bunch
+
+def prune_trees_by_species(ete2_tree_list,species_list):
+    """
+    *GIVEN:*
+        * ``ete2_tree_list``: list of phyloXML ete2 trees
+        * ``species_list``: list of scientific species names to keep
+    *DOES:*
+        * drops the trees with leaves from fewer than two of ``species_list`` (see
+          ``species_code_index()``) and prunes the others in place to the leaves of ``species_list``.
+    *RETURNS:*
+        * list of the pruned trees
+    """
+    leaves = [tree.get_leaves() for tree in ete2_tree_list]
+    codes = species_code_index([[leaf_species(l) for l in tree_leaves] for tree_leaves in leaves],species_list)
+    
+    pruned = []
+    for i in np.flatnonzero(codes.species_per_tree >= 2):
+        tree_codes = codes.codes[codes.offsets[i]:codes.offsets[i+1]]
+        tree = ete2_tree_list[i]
+        tree.prune([l.name for l,code in zip(leaves[i],tree_codes) if code >= 0])
+        pruned.append(tree)
+    return pruned
 
-def load_phyloXMLs(path,species=None,pickle_path=None):
+def species_code_index(leaf_species_lists,species_list):
     """
-    Loads at least one phyloXML file and returns a Phyloxml() project containing at least one phyloXML tree.
-    If path is a directory, all subdirectories are scrubed for xml files too.
+    *GIVEN:*
+        * ``leaf_species_lists``: list with the list of leaf species of each tree of a collection
+        * ``species_list``: wanted species
+    *DOES:*
+        * codes every leaf of the collection once as its index in ``species_list`` (-1 if unwanted)
+          and counts the distinct wanted species of each tree.
+    *RETURNS:*
+        * Bunch with:
+            * ``codes``: int array of the codes of all leaves, tree after tree
+            * ``offsets``: int array; the codes of tree ``i`` are ``codes[offsets[i]:offsets[i+1]]``
+            * ``species_per_tree``: int array of the number of distinct wanted species in each tree
+    """
+    code_of = dict((species,code) for code,species in enumerate(species_list))
+    sizes = [len(leaves) for leaves in leaf_species_lists]
+    offsets = np.zeros(len(sizes)+1,dtype=np.int64)
+    offsets[1:] = np.cumsum(sizes)
+    codes = np.array([code_of.get(species,-1) for leaves in leaf_species_lists for species in leaves],dtype=np.int64)
     
-    If species!=None, prunes trees to leaves that are of the supplied scientific species names (can save a LOT
-    of memory if the number of trees is large).
+    tree_of_leaf = np.repeat(np.arange(len(sizes)),sizes)
+    wanted = codes >= 0
+    tree_species = np.unique(tree_of_leaf[wanted] * max(1,len(species_list)) + codes[wanted])
+    species_per_tree = np.bincount(tree_species // max(1,len(species_list)),minlength=len(sizes))
     
-    path = str()
-    species = list()
+    return Bunch(codes=codes,offsets=offsets,species_per_tree=species_per_tree)
+
+def prune_compact_trees_by_species(compact_trees,species_list):
     """
-    #if pickle_path is not None:
-        #try:
-            #pickle_file = cPickle.load(open(pickle_path,'rb'))
-        #except IOError:
-            #pass
-        
-    trees = []
+    Same as ``prune_trees_by_species()`` for ``CompactTree`` objects: the trees are filtered with
+    one ``species_code_index()`` of the whole collection and the survivors pruned in parent array form.
     
+    *RETURNS:*
+        * list of new pruned ``CompactTree`` objects
+    """
+    codes = species_code_index([tree.leaf_species for tree in compact_trees],species_list)
     
-    if os.path.isdir(path):
-        # Extract all trees from all xml in recursive subfolders
-        for xml_file in walk_dirs_for_fileName(path,"*.xml"):
-            try:
-                project = ete2.Phyloxml()
-                project.build_from_file(xml_file)
-                for tree in project.get_phylogeny():
-                    if species is not None:    
-                        trees.extend(prune_trees_by_species([tree],species))
-                    else:
-                        trees.append(tree)
-            except TypeError as err:
-                if "cannot parse from 'list'" in err:
-                    pass
-                else:
-                    raise err
-    else:
-        # Extract all trees from single xml file
-        project = ete2.Phyloxml()
-        project.build_from_file(path)
-        for tree in project.get_phylogeny():
-            if species is not None:    
-                trees.extend(prune_trees_by_species([tree],species))
-            else:
-                trees.append(tree)
-                
-    return trees
+    pruned = []
+    for i in np.flatnonzero(codes.species_per_tree >= 2):
+        pruned.append(compact_trees[i].prune(codes.codes[codes.offsets[i]:codes.offsets[i+1]] >= 0))
+    return pruned
 
-def prune_trees_by_species(ete2_tree_list,species_list):
+def leaf_species(leaf):
+    """
+    Returns the species scientific name of a phyloXML leaf obj.
     """
-    XXXX
+    return leaf.phyloxml_clade.taxonomy[0].scientific_name
+
+class CompactTree(object):
     """
-    for i,tree in enumerate(ete2_tree_list):
+    Parent array form of a tree: nodes are numbered in preorder so that each node's parent
+    comes before it.
+    
+    Attributes:
+        | ``parents`` -- int array: parent id of each node (-1 for the root)
+        | ``branch_lengths`` -- float array: each node's branch length to its parent (``node.dist``)
+        | ``leaf_ids`` -- int array: node id of each leaf in ``tree.get_leaves()`` order
+        | ``leaf_names`` -- list of the leaf names
+        | ``leaf_species`` -- list of the leaf species
+    """
+    def __init__(self,parents,branch_lengths,leaf_ids,leaf_names,leaf_species):
+        """
+        *GIVEN:*
+            * ``parents``: int array of parent ids in preorder (-1 for the root)
+            * ``branch_lengths``: float array of each node's branch length to its parent
+            * ``leaf_ids``: int array of the node id of each leaf
+            * ``leaf_names``, ``leaf_species``: name and species of each leaf, aligned with ``leaf_ids``
+        """
+        self.parents = np.asarray(parents,dtype=np.int64)
+        self.branch_lengths = np.asarray(branch_lengths,dtype=np.float64)
+        self.leaf_ids = np.asarray(leaf_ids,dtype=np.int64)
+        self.leaf_names = list(leaf_names)
+        self.leaf_species = list(leaf_species)
+        self._lca = None
+    
+    @classmethod
+    def from_ete2(cls,tree,get_species=leaf_species):
+        """
+        Returns the ``CompactTree`` of an ete2 tree; ``get_species(leaf)`` gives each leaf's species.
+        """
+        ids = {}
+        parents = []
+        branch_lengths = []
+        leaf_ids = []
         leaf_names = []
-        for l in tree.get_leaves():
-            if l.phyloxml_clade.taxonomy[0].scientific_name in species_list:
-                leaf_names.append(l.name)
+        species = []
+        for node in tree.traverse('preorder'):
+            ids[node] = len(parents)
+            parents.append(ids[node.up] if node is not tree else -1)
+            branch_lengths.append(node.dist)
+            if node.is_leaf():
+                leaf_ids.append(ids[node])
+                leaf_names.append(node.name)
+                species.append(get_species(node))
+        return cls(parents,branch_lengths,leaf_ids,leaf_names,species)
+    
+    def __len__(self):
+        """
+        Returns the number of nodes.
+        """
+        return len(self.parents)
+    
+    def __getstate__(self):
+        # the LCA tables are rebuilt on demand
+        state = self.__dict__.copy()
+        state['_lca'] = None
+        return state
+    
+    def prune(self,keep_leaves):
+        """
+        *GIVEN:*
+            * ``keep_leaves``: bool array aligned with ``leaf_ids`` of the leaves to keep (at least one)
+        *DOES:*
+            * keeps the root, the wanted leaves and the internal nodes where their paths branch,
+              linking each kept node to its nearest kept ancestor.  Like ete2's ``prune()``, the
+              branch lengths of the removed nodes are dropped.
+        *RETURNS:*
+            * new ``CompactTree`` with the same preorder node and leaf order
+        """
+        keep_leaves = np.asarray(keep_leaves,dtype=bool)
+        node_count = len(self.parents)
+        kept_leaf_ids = self.leaf_ids[keep_leaves]
         
-        try:
-            tree.prune(leaf_names)
-        except ValueError as err:
-            if 'Nodes are not connected!' in err:
-                ete2_tree_list[i] = False
+        # ancestors of the kept leaves: one vectorized step per tree level
+        on_path = np.zeros(node_count,dtype=bool)
+        frontier = kept_leaf_ids
+        while len(frontier):
+            on_path[frontier] = True
+            frontier = np.unique(self.parents[frontier])
+            frontier = frontier[frontier >= 0]
+            frontier = frontier[~on_path[frontier]]
+        
+        path_children = np.bincount(self.parents[on_path & (self.parents >= 0)],minlength=node_count)
+        kept = path_children >= 2
+        kept[kept_leaf_ids] = True
+        kept[0] = True
+        
+        # nearest kept ancestor by pointer jumping
+        up = self.parents.copy()
+        up[0] = 0
+        while True:
+            skip = ~kept[up]
+            if not skip.any():
+                break
+            up[skip] = up[up[skip]]
+        
+        kept_ids = np.flatnonzero(kept)
+        new_ids = np.empty(node_count,dtype=np.int64)
+        new_ids.fill(-1)
+        new_ids[kept_ids] = np.arange(len(kept_ids))
+        parents = new_ids[up[kept_ids]]
+        parents[0] = -1
+        
+        leaf_positions = np.flatnonzero(keep_leaves)
+        return CompactTree(parents,self.branch_lengths[kept_ids],new_ids[kept_leaf_ids],
+                           [self.leaf_names[i] for i in leaf_positions],
+                           [self.leaf_species[i] for i in leaf_positions])
+    
+    def lca_index(self):
+        """
+        Returns the ``LCAIndex`` of the tree (built once).
+        """
+        if self._lca is None:
+            self._lca = LCAIndex(self.parents,self.branch_lengths)
+        return self._lca
+    
+    def pairwise_leaf_distances(self):
+        """
+        *RETURNS:*
+            * ``(leaf_i,leaf_j,distances)`` arrays for every leaf pair in ``xuniqueCombinations(leaves,2)``
+              order, where ``leaf_i``/``leaf_j`` index into ``leaf_names`` and ``distances``
+              are the branch lengths separating the two leaves.
+        """
+        leaf_i,leaf_j = np.triu_indices(len(self.leaf_ids),1)
+        distances = self.lca_index().distances(self.leaf_ids[leaf_i],self.leaf_ids[leaf_j])
+        return leaf_i,leaf_j,distances
+
+class LCAIndex(object):
+    """
+    Lowest common ancestor structure of a tree in parent array form: an Euler tour of the
+    tree plus a sparse table of range minimums over it, so that every LCA query is O(1)
+    and can be done for arrays of node pairs at once.
+    
+    Attributes:
+        | ``depths`` -- float array: root-to-node sum of branch lengths
+        | ``levels`` -- int array: number of edges from the root to each node
+        | ``euler`` -- int array: node ids in Euler tour order
+        | ``first`` -- int array: first position of each node in ``euler``
+        | ``table`` -- list of int arrays: ``table[k][i]`` is the shallowest node of ``euler[i:i+2**k]``
+    """
+    def __init__(self,parents,branch_lengths):
+        """
+        *GIVEN:*
+            * ``parents``: int array of parent ids in preorder (-1 for the root)
+            * ``branch_lengths``: float array of each node's branch length to its parent
+        """
+        parents = np.asarray(parents,dtype=np.int64)
+        node_count = len(parents)
+        
+        # preorder lets depths be filled top-down in one pass
+        self.depths = np.zeros(node_count)
+        self.levels = np.zeros(node_count,dtype=np.int64)
+        for node in xrange(1,node_count):
+            parent = parents[node]
+            self.depths[node] = self.depths[parent] + branch_lengths[node]
+            self.levels[node] = self.levels[parent] + 1
+        
+        self.euler,self.first = self._euler_tour(parents)
+        self.table = self._sparse_table(self.euler,self.levels)
+    
+    @staticmethod
+    def _euler_tour(parents):
+        """
+        Returns ``(euler,first)`` arrays of the tree rooted at node 0.
+        """
+        node_count = len(parents)
+        # children of each node, in id order
+        order = np.argsort(parents[1:],kind='mergesort') + 1
+        starts = np.searchsorted(parents[order],np.arange(node_count))
+        stops = np.searchsorted(parents[order],np.arange(node_count),side='right')
+        
+        euler = np.empty(2*node_count-1,dtype=np.int64)
+        first = np.empty(node_count,dtype=np.int64)
+        stack = [(0,starts[0])]
+        first[0] = 0
+        euler[0] = 0
+        pos = 1
+        while stack:
+            node,child_pos = stack[-1]
+            if child_pos < stops[node]:
+                child = order[child_pos]
+                stack[-1] = (node,child_pos+1)
+                first[child] = pos
+                euler[pos] = child
+                pos += 1
+                stack.append((child,starts[child]))
             else:
-                raise err
-            
-    return filter(None,ete2_tree_list)
+                stack.pop()
+                if stack:
+                    euler[pos] = stack[-1][0]
+                    pos += 1
+        return euler,first
+    
+    @staticmethod
+    def _sparse_table(euler,levels):
+        """
+        Returns the range minimum (by ``levels``) sparse table of ``euler``.
+        """
+        table = [euler]
+        span = 1
+        while 2*span <= len(euler):
+            prev = table[-1]
+            left = prev[:len(prev)-span]
+            right = prev[span:]
+            table.append(np.where(levels[left] <= levels[right],left,right))
+            span *= 2
+        return table
+    
+    def lca(self,nodes1,nodes2):
+        """
+        Returns array of the lowest common ancestor of each pair of node ids in ``nodes1``, ``nodes2``.
+        """
+        lo = np.minimum(self.first[nodes1],self.first[nodes2])
+        hi = np.maximum(self.first[nodes1],self.first[nodes2]) + 1
+        k = np.floor(np.log2(hi - lo)).astype(np.int64)
+        ancestors = np.empty(len(lo),dtype=np.int64)
+        for level in np.unique(k):
+            rows = np.flatnonzero(k == level)
+            left = self.table[level][lo[rows]]
+            right = self.table[level][hi[rows] - 2**level]
+            ancestors[rows] = np.where(self.levels[left] <= self.levels[right],left,right)
+        return ancestors
+    
+    def distances(self,nodes1,nodes2):
+        """
+        Returns array of the branch length separating each pair of node ids in ``nodes1``, ``nodes2``.
+        """
+        nodes1 = np.asarray(nodes1,dtype=np.int64)
+        nodes2 = np.asarray(nodes2,dtype=np.int64)
+        ancestors = self.lca(nodes1,nodes2)
+        return self.depths[nodes1] + self.depths[nodes2] - 2*self.depths[ancestors]
 
+# bump when the cached CompactTree records change layout
+PHYLOXML_CACHE_VERSION = 2
+
+def phyloXML_cache_key(xml_file,species=None):
+    """
+    Returns the cache key of ``xml_file`` pruned to ``species``: a sha1 hash of the file's
+    content, the species and ``PHYLOXML_CACHE_VERSION``.
+    """
+    digest = hashlib.sha1()
+    xml = open(xml_file,'rb')
+    try:
+        for block in iter(lambda: xml.read(2**20),''):
+            digest.update(block)
+    finally:
+        xml.close()
+    digest.update(repr((PHYLOXML_CACHE_VERSION,None if species is None else sorted(species))))
+    return digest.hexdigest()
+
+def load_compact_phyloXML(xml_file,species=None,cache_dir=None):
+    """
+    *GIVEN:*
+        * ``xml_file``: path to one phyloXML file
+        * ``species``: list of species to prune the trees to (``None`` keeps every leaf)
+        * ``cache_dir``: optional directory of cached results keyed by ``phyloXML_cache_key()``
+    *DOES:*
+        * parses ``xml_file`` with ete2, converts its trees to ``CompactTree`` records and prunes
+          them with ``prune_compact_trees_by_species()``; unchanged files are read from ``cache_dir`` instead.
+    *RETURNS:*
+        * list of ``CompactTree`` objects
+    """
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir,'%s.pickle' % (phyloXML_cache_key(xml_file,species)))
+        if os.path.exists(cache_path):
+            return cPickle.load(open(cache_path,'rb'))
+    
+    compact_trees = []
+    try:
+        project = ete2.Phyloxml()
+        project.build_from_file(xml_file)
+        compact_trees = [CompactTree.from_ete2(tree) for tree in project.get_phylogeny()]
+    except TypeError as err:
+        if "cannot parse from 'list'" not in str(err):
+            raise err
+    if species is not None:
+        compact_trees = prune_compact_trees_by_species(compact_trees,species)
+    
+    if cache_path is not None:
+        # write then rename so that concurrent runs never read a partial file
+        handle,tmp_path = tempfile.mkstemp(dir=cache_dir,suffix='.tmp')
+        tmp_file = os.fdopen(handle,'wb')
+        try:
+            cPickle.dump(compact_trees,tmp_file,protocol=2)
+        finally:
+            tmp_file.close()
+        os.rename(tmp_path,cache_path)
+    
+    return compact_trees
+
+def _load_compact_phyloXML_job(job):
+    """
+    Unpacks a ``load_compact_phyloXML()`` call for ``multiprocessing.Pool.imap``.
+    """
+    return load_compact_phyloXML(*job)
+
+def iter_compact_phyloXMLs(path,species=None,processes=1,cache_dir=None):
+    """
+    *GIVEN:*
+        * ``path``: phyloXML file or directory (all subdirectories are scrubed for xml files too)
+        * ``species``: list of species to prune the trees to (``None`` keeps every leaf)
+        * ``processes``: number of worker processes parsing files (``None`` = one per cpu)
+        * ``cache_dir``: optional parse cache directory (see ``load_compact_phyloXML()``)
+    *DOES:*
+        * parses and prunes each file in the workers so only compact records come back.
+    *RETURNS:*
+        * generator of ``CompactTree`` objects, file by file in ``walk_dirs_for_fileName()`` order
+    """
+    if os.path.isdir(path):
+        xml_files = walk_dirs_for_fileName(path,"*.xml")
+    else:
+        xml_files = [path]
+    
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    
+    jobs = [(xml_file,species,cache_dir) for xml_file in xml_files]
+    if processes == 1 or len(jobs) < 2:
+        for job in jobs:
+            for tree in _load_compact_phyloXML_job(job):
+                yield tree
+        return
+    
+    pool = multiprocessing.Pool(processes)
+    try:
+        for trees in pool.imap(_load_compact_phyloXML_job,jobs):
+            for tree in trees:
+                yield tree
+    finally:
+        pool.terminate()
+        pool.join()
 
-        
 class PhyloXMLParser(GFuncParserBase):
     """
     Class to accept PhyloXML files or directories and init the relevant gFuncNode/gFuncEdges Objects.
@@ -92,56 +432,65 @@ class PhyloXMLParser(GFuncParserBase):
     RIGHT NOW: only used for branch_length
     """
     
-    def __init__(self, phyloXML_path='', species=[], pickle_path=None):
+    def __init__(self, phyloXML_path='', species=[], pickle_path=None, processes=1):
         """
         Test doc for init'ing.
+        
+        ``pickle_path``: optional directory caching the parsed trees (see ``iter_compact_phyloXMLs()``).
+        ``processes``: number of worker processes parsing the phyloXML files.
         """
         # everything after rows[9] is FPKM data
         
         self.data_type = 'branch_length'
         self.species = species
-        self.trees   = load_phyloXMLs(phyloXML_path,species)
         self.pickle_path = pickle_path
+        self.trees   = list(iter_compact_phyloXMLs(phyloXML_path,species,processes=processes,cache_dir=pickle_path))
 
-    def get_distance(self,leaf1,leaf2):
+    def get_distance(self,tree,leaf1,leaf2):
         """
-        For two leaf objs in a common tree, returns the branch length that
-        separates them.
+        For two leaves of a ``CompactTree`` in self.trees, given as indexes into
+        ``tree.leaf_names``, returns the branch length that separates them.
         """
-        return float(leaf1.get_distance(leaf1,leaf2))
+        distances = tree.lca_index().distances(tree.leaf_ids[[leaf1]],tree.leaf_ids[[leaf2]])
+        return float(distances[0])
 
     
     def get_species(self,leaf):
         """
         Returns the species scientific name of a leaf obj.
         """
-        return leaf.phyloxml_clade.taxonomy[0].scientific_name
+        return leaf_species(leaf)
     
     def resgister_nodes_and_edges(self,node_dict,edge_dict,graph):
         """
-        Iterates through every leaf in every tree in self.trees ensuring that
+        Iterates through every leaf in every tree (``CompactTree`` or ete2) in self.trees ensuring that
         a GFuncNode exists for each leaf and is registered.  GFuncNodes are
         initialized with basic info (name,species) if it doesnt already exist.
         Then GFuncEdge objects are registered/initialized for leaf combinations
         in each tree while setting 'branch_length' data for each edge.
         """
         for tree in self.trees:
-            leaves = tree.get_leaves()
+            if isinstance(tree,CompactTree):
+                compact = tree
+            else:
+                compact = CompactTree.from_ete2(tree,get_species=self.get_species)
+            names = compact.leaf_names
             
             # Register any unregistered nodes
-            for leaf in leaves:
-                if leaf.name not in node_dict:
-                    node_dict[leaf.name] = GFuncNode(name=leaf.name,species=self.get_species(leaf),graph=graph)
+            for name,species in zip(names,compact.leaf_species):
+                if name not in node_dict:
+                    node_dict[name] = GFuncNode(name=name,species=species,graph=graph)
             
-            # Get leaf pair branch lengths and register them in new or existing GFuncEdge objs
-            for leaf1,leaf2 in xuniqueCombinations(leaves,2):
-                edge_key = tuple(sorted([leaf1.name,leaf2.name]))
+            # Get all leaf pair branch lengths at once and register them in new or existing GFuncEdge objs
+            leaf_i,leaf_j,distances = compact.pairwise_leaf_distances()
+            for i,j,distance in zip(leaf_i.tolist(),leaf_j.tolist(),distances.tolist()):
+                edge_key = tuple(sorted([names[i],names[j]]))
                 try:
-                    edge_dict[edge_key].data[self.data_type] = self.get_distance(leaf1,leaf2)
+                    edge_dict[edge_key].data[self.data_type] = distance
                 except KeyError:
                     edge = GFuncEdge(node1=node_dict[edge_key[0]],
                                      node2=node_dict[edge_key[1]])
-                    edge.data[self.data_type] = self.get_distance(leaf1,leaf2)
+                    edge.data[self.data_type] = distance
                     edge_dict[edge_key] = edge
             # AM I DONE HERE?
                 
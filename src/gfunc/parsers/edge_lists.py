@@ -5,8 +5,6 @@ edge_lists.py
 Code supporting parsing of lists into edge connections.
 """
 
-from collections import defaultdict
-
 import numpy as np
 
 from gfunc.xpermutations import xuniqueCombinations
@@ -15,6 +13,7 @@ from gfunc.data_classes import GFuncNode
 from gfunc.parsers.base import GFuncParserBase
 from gfunc.data_classes import Bunch
 from gfunc.fileIO import tableFile2namedTuple
+from gfunc.fileIO import tableFile2arrays
 
 
 def follow_all_links(graph,node):
@@ -28,46 +27,94 @@ def follow_all_links(graph,node):
         
     return nodes_in_connected_subgraph
 
-def combine_multiple_one2one_tables(path_list,species_prefixes=['AGAP','AAEL','CPIJ']):
+def union_find_components(ids1,ids2,node_count):
     """
-    Builds a set of linked dicts with:
-    
-    Keys:
-        GeneName
-    
-    Values:
-        Link to other GeneName keys that are supossed one2one orthologs
+    *GIVEN:*
+        * ``ids1``, ``ids2``: int arrays; each ``(ids1[k],ids2[k])`` pair links two nodes
+        * ``node_count``: number of nodes (ids are ``0`` to ``node_count-1``)
+    *DOES:*
+        * array based union-find: every round hooks the larger root of each linked pair onto the
+          smaller one and then compresses all paths by pointer jumping, until no pair spans
+          two roots.  Components of any size or shape are found.
+    *RETURNS:*
+        * int array with the component label (its smallest node id) of each node
     """
-        
-    ortho_graph = defaultdict(set)
+    ids1 = np.asarray(ids1,dtype=np.int64)
+    ids2 = np.asarray(ids2,dtype=np.int64)
+    roots = np.arange(node_count,dtype=np.int64)
     
+    while True:
+        roots1 = roots[ids1]
+        roots2 = roots[ids2]
+        spanning = roots1 != roots2
+        if not spanning.any():
+            return roots
+        np.minimum.at(roots,np.maximum(roots1[spanning],roots2[spanning]),
+                      np.minimum(roots1[spanning],roots2[spanning]))
+        # path compression
+        while True:
+            jumped = roots[roots]
+            if (jumped == roots).all():
+                break
+            roots = jumped
+
+def species_codes_by_prefix(gene_names,species_prefixes):
+    """
+    Returns int array with the index of the prefix in ``species_prefixes`` that starts each
+    gene name (-1 if none does).
+    """
+    gene_names = np.asarray(gene_names,dtype=str)
+    codes = np.empty(len(gene_names),dtype=np.int64)
+    codes.fill(-1)
+    for code,prefix in enumerate(species_prefixes):
+        codes[(codes < 0) & np.char.startswith(gene_names,prefix)] = code
+    return codes
+
+def combine_multiple_one2one_tables(path_list,species_prefixes=['AGAP','AAEL','CPIJ']):
+    """
+    *GIVEN:*
+        * ``path_list``: list of two column tables of pairwise one2one orthologs
+        * ``species_prefixes``: gene name prefix of each species
+    *DOES:*
+        * joins the genes of all pairwise rows into connected components with
+          ``union_find_components()`` over integer gene ids
+        * keeps the components holding exactly one gene of every species in ``species_prefixes``
+    *RETURNS:*
+        * list of frozensets: the N-way 1-to-1 ortholog sets
+    """
+    name_columns = []
     for path in path_list:
-        rows = tableFile2namedTuple(path)
-        for row in rows:
-            name1,name2 = row
-            ortho_graph[name1].update(row)
-            ortho_graph[name2].update(row)
+        table = tableFile2arrays(path)
+        if len(table) != 2:
+            raise ValueError("%s must have exactly two columns, not %s." % (path,len(table)))
+        # links are undirected so the column order does not matter
+        name_columns.append(np.column_stack(table.values()))
     
-    combo_set = set()
-    for gene in ortho_graph:
-        combo_set.add(frozenset(follow_all_links(ortho_graph,gene)))
+    if not name_columns:
+        return []
+    pairs = np.concatenate(name_columns)
+    gene_names,gene_ids = np.unique(pairs.ravel(),return_inverse=True)
+    gene_ids = gene_ids.reshape(pairs.shape)
     
-    all_v_all = [x for x in combo_set if len(x) == len(species_prefixes)]
+    components = union_find_components(gene_ids[:,0],gene_ids[:,1],len(gene_names))
+    codes = species_codes_by_prefix(gene_names,species_prefixes)
     
-    check_for_repeat_genes = []
-    for each in all_v_all:
-        check_for_repeat_genes.extend(sorted(list(each)))
-        
-    if not len(check_for_repeat_genes) == len(set(check_for_repeat_genes)):
-        raise ValueError('It seems that one of your genes occurs in more than one N-way 1-to-1 ortholog set.')
+    # per component checks: N genes, all of a known species, no species twice
+    species_count = len(species_prefixes)
+    sizes = np.bincount(components,minlength=len(gene_names))
+    known = np.bincount(components,weights=codes >= 0,minlength=len(gene_names))
+    distinct = np.zeros(len(gene_names),dtype=np.int64)
+    component_species = np.unique(components[codes >= 0] * species_count + codes[codes >= 0])
+    np.add.at(distinct,component_species // species_count,1)
+    complete = (sizes == species_count) & (known == species_count) & (distinct == species_count)
+    
+    order = np.argsort(components,kind='mergesort')
+    starts = np.searchsorted(components[order],np.arange(len(gene_names)))
+    all_v_all = []
+    for label in np.flatnonzero(complete):
+        members = order[starts[label]:starts[label]+species_count]
+        all_v_all.append(frozenset(gene_names[members].tolist()))
     
-    for ortho_set in all_v_all:
-        ortho_set_str = str(ortho_set)
-        for prefix in species_prefixes:
-            if prefix not in ortho_set_str:
-                all_v_all.remove(ortho_set)
-                continue
-            
     return all_v_all
     
 
@@ -126,6 +173,92 @@ class OneToOneOrthoListParser(GFuncParserBase):
                     div = div_map[node_dict[node1].species][node_dict[node2].species]
                     edge_dict[edge_key].data[self.data_type2] = (div,div_min,div_max)
                     
+    def node_id_matrix(self,rows,node_dict):
+        """
+        *GIVEN:*
+            * ``rows``: sequence of equal length rows of registered node names (exp: the
+              values of an N-way ortholog table)
+            * ``node_dict``: node registry
+        *RETURNS:*
+            * ``(id_matrix,nodes)``: int array shaped like ``rows`` holding node ids, and the
+              list of GFuncNodes indexed by those ids
+        """
+        names = np.asarray(rows,dtype=str)
+        unique_names,ids = np.unique(names.ravel(),return_inverse=True)
+        nodes = [node_dict[name] for name in unique_names.tolist()]
+        return ids.reshape(names.shape),nodes
+    
+    def _divergence_matrix(self,species,codes1,codes2):
+        """
+        Returns object array ``div[a,b]`` with the ``divergence_info`` divergence between
+        ``species[a]`` and ``species[b]``, filled only for the species pairs that occur in
+        ``zip(codes1,codes2)`` (``None`` elsewhere).  Only those pairs are read from the
+        caller's ``div_map`` so that no other entries are added to its ``defaultdict``.
+        """
+        div_map = self.divergence_info[0]
+        div = np.empty((len(species),len(species)),dtype=object)
+        pair_codes = np.unique(np.asarray(codes1) * len(species) + np.asarray(codes2))
+        for a,b in zip(*np.divmod(pair_codes,len(species))):
+            div[a,b] = div_map[species[a]][species[b]]
+        return div
+    
+    def register_edges_bulk(self,id_matrix,nodes,edge_dict,graph=None):
+        """
+        Bulk version of ``_resgister_edge()`` for a whole table of rows at once.
+        
+        *GIVEN:*
+            * ``id_matrix``, ``nodes``: output of ``self.node_id_matrix()``
+            * ``edge_dict``: edge registry
+            * ``graph``: if given, the touched edges are also added to it in one
+              ``add_edges_from()`` call (as ``GraphBuilder.map_registries_to_graph()`` does)
+        *DOES:*
+            * builds the node id pairs of all within-row combinations with numpy, drops
+              repeated pairs and looks up every pair's divergence in a species by species matrix
+            * registers a GFuncEdge for each new pair and sets ``<relation_type>`` (and
+              ``divergence``) data on new and existing edges, like ``_resgister_edge()``
+        *RETURNS:*
+            * list of the touched GFuncEdges
+        """
+        id_matrix = np.asarray(id_matrix,dtype=np.int64)
+        col1,col2 = np.triu_indices(id_matrix.shape[1],1)
+        ids1 = id_matrix[:,col1].ravel()
+        ids2 = id_matrix[:,col2].ravel()
+        
+        # order each pair like the sorted name edge keys
+        names = np.array([node.name for node in nodes],dtype=str)
+        name_rank = np.empty(len(nodes),dtype=np.int64)
+        name_rank[np.argsort(names,kind='mergesort')] = np.arange(len(nodes))
+        swap = name_rank[ids1] > name_rank[ids2]
+        ids1[swap],ids2[swap] = ids2[swap],ids1[swap]
+        
+        # keep the first occurrence of each pair, in table order
+        pair_codes = ids1 * len(nodes) + ids2
+        first = np.sort(np.unique(pair_codes,return_index=True)[1])
+        ids1 = ids1[first]
+        ids2 = ids2[first]
+        
+        if self.divergence_info != None:
+            div_min,div_max = self.divergence_info[1:]
+            species,species_codes = np.unique([node.species for node in nodes],return_inverse=True)
+            codes1,codes2 = species_codes[ids1],species_codes[ids2]
+            div = self._divergence_matrix(species.tolist(),codes1,codes2)[codes1,codes2]
+        
+        touched = []
+        for k,(id1,id2) in enumerate(zip(ids1.tolist(),ids2.tolist())):
+            edge_key = (nodes[id1].name,nodes[id2].name)
+            edge = edge_dict.get(edge_key)
+            if edge is None:
+                edge = GFuncEdge(node1=nodes[id1],node2=nodes[id2])
+                edge_dict[edge_key] = edge
+            edge.data[self.data_type] = True
+            if self.divergence_info != None:
+                edge.data[self.data_type2] = (div[k],div_min,div_max)
+            touched.append(edge)
+        
+        if graph is not None:
+            graph.add_edges_from([(e.nodes[0],e.nodes[1],{'edge':e}) for e in touched])
+        return touched
+                    
     def resgister_nodes_and_edges(self,node_dict,edge_dict,graph):
         """
         Iterates through every row in list_path ensuring that
@@ -138,6 +271,11 @@ class OneToOneOrthoListParser(GFuncParserBase):
             
             # Register any unregistered nodes
             self._resgister_node(row,node_dict,graph)
-            
-            # Get leaf pair branch lengths and register them in new or existing GFuncEdge objs
-            self._resgister_edge(row,node_dict,edge_dict,graph)
\ No newline at end of file
+        
+        if len(self.table) == 0:
+            return
+        
+        # Register all row combinations at once; edges reach the graph through
+        # GraphBuilder.map_registries_to_graph()
+        id_matrix,nodes = self.node_id_matrix([list(row) for row in self.table],node_dict)
+        self.register_edges_bulk(id_matrix,nodes,edge_dict)
\ No newline at end of file
@@ -14,10 +14,9 @@ except ImportError:
 import numpy as np
 from scipy import stats
 
-import MOODS
-
 from gfunc.parsers.JASPAR import ParseJasparMatrixOnly
 from gfunc.fileIO import tableFile2namedTuple
+from gfunc.motifs import iter_MOODS_scans
 
 from rSeq.utils.files import ParseFastA
 
@@ -104,6 +103,15 @@ def main():
     parser.add_argument('--to-norm', type=str, required=False, default=False,
                             help="""Optional path to outfile of previous run that needs to be normalized. (default = %(default)s)""")
     
+    parser.add_argument('--processes', type=int, required=False, default=1,
+                        help="""Number of worker processes scanning the sequences. (default = %(default)s)""")
+    
+    parser.add_argument('--both-strands', dest='both_strands', action='store_true', default=True,
+                        help="""Count hits on both strands of each sequence, like MOODS.search's own default. (default = %(default)s)""")
+    
+    parser.add_argument('--one-strand', dest='both_strands', action='store_false',
+                        help="""Only count hits on the given strand of each sequence.""")
+    
 
     
     args = parser.parse_args()
@@ -131,8 +139,8 @@ def main():
         write_normalized_table(headers,args.norm,norm_dict)
         exit(0)
         
-    for name,seq in seqs:
-        hits = MOODS.search(seq,motifs.values(),args.thresh)
+    for name,hits in iter_MOODS_scans(seqs,motifs.values(),args.thresh,both_strands=args.both_strands,
+                                      processes=args.processes):
         counts = [len(x) for x in hits]
         out_file.write('%s\t%s\t%s\n' % (name,args.species,'\t'.join([str(x) for x in counts])))
         if args.norm:
@@ -17,6 +17,7 @@ from gfunc.analysis_classes import VoteHandler
 from gfunc.analysis_classes import ExpressionSimilarity,TFBSSimilarity,BranchLength
 from gfunc.graphTools import GraphBuilder
 from gfunc.graphTools import GraphHandler
+from gfunc.snapshot import save_snapshot
 from gfunc.parsers.Cufflinks import CDiffFpkmTrackerParser
 from gfunc.parsers.ETE import PhyloXMLParser
 from gfunc.parsers.JASPAR import BasicTFBSParser
@@ -49,7 +50,9 @@ def setup_parsers(yopts):
     parser_list.append(BasicTFBSParser(tfbs_path=y.species_info.Culex_quinquefasciatus.tfbs_data))
     
     species = [y.species_info.Anopheles_gambiae.name,y.species_info.Culex_quinquefasciatus.name]
-    parser_list.append(PhyloXMLParser(phyloXML_path=y.edge_data.branch_length_data,species=species))
+    parser_list.append(PhyloXMLParser(phyloXML_path=y.edge_data.branch_length_data,species=species,
+                                      pickle_path=y.edge_data.get('branch_length_cache'),
+                                      processes=y.edge_data.get('branch_length_processes',1)))
     
     return parser_list
 
@@ -95,8 +98,11 @@ def main():
     gHandler.install_metric_handlers(rel_hndler=relHandler,vote_hndlr=voteHandler)
     gHandler.measure_relations()
     
-    # dump built construct as pickle
-    cPickle.dump(gHandler,open(yopts.outputs.graph_pickle,'w'))
+    # dump built construct as pickle and/or memory mappable snapshot
+    if 'graph_pickle' in yopts.outputs:
+        cPickle.dump(gHandler,open(yopts.outputs.graph_pickle,'w'))
+    if 'graph_snapshot' in yopts.outputs:
+        save_snapshot(gHandler,yopts.outputs.graph_snapshot)
 
 if __name__ == '__main__':
     main()
@@ -11,6 +11,7 @@ from collections import defaultdict
 
 from numpy import isnan
 import numpy as np
+from scipy import sparse as sp_sparse
 
 from matplotlib import pylab as plb
 import matplotlib.lines as mlines
@@ -19,11 +20,17 @@ import pandas
 
 import yaml
 
-from gfunc.stats import cumHypergeoP
+from gfunc.stats import hypergeo_sf
+from gfunc.stats import HYPERGEO_EXACT_BELOW
 from gfunc.stats import benjHochFDR
 from gfunc.xpermutations import xuniqueCombinations
-from gfunc.fileIO import tableFile2namedTuple
+from gfunc.fdr import species_pair_weights
+from gfunc.fdr import ortho_set_ptcis
+from gfunc.fdr import ptci_null
+from gfunc.fdr import empirical_fdr
+from gfunc.fileIO import iter_table_rows
 from gfunc.data_classes import Bunch,bunchify
+from gfunc.data_classes import columnarize
 from gfunc.analysis_classes import RelationsHandler
 from gfunc.analysis_classes import VoteHandler
 from gfunc.analysis_classes import PhyloExpnCorrelationIndex
@@ -42,7 +49,118 @@ def print_LoL_to_file(list_of_lists,path):
         out.write("%s\n" % (','.join([str(x) for x in row])))
     out.close()
 
-def count_terms_for_hypergeo(graph,positive_node_set,terms_of_enrichment,term_fuction=None):
+class TermIndex(object):
+    """
+    Inverted annotation index of a node population, built once and reused for the
+    hypergeometric counts of every term.
+    
+    Attributes:
+        | ``nodes`` -- list of GFuncNodes; position is the node id
+        | ``node_ids`` -- dict mapping GFuncNode --> node id
+        | ``terms`` -- list of terms; position is the term id
+        | ``term_ids`` -- dict mapping term --> term id
+        | ``node_terms`` -- list with the frozenset of terms of each node
+        | ``matrix`` -- ``scipy.sparse`` CSC matrix (nodes x terms) with 1 where the node has the term
+        | ``term_sizes`` -- int array: number of nodes annotated with each term
+    """
+    def __init__(self,nodes,term_fuction):
+        """
+        *GIVEN:*
+            * nodes: the population (exp: ``graph.nodes()`` or ``CSRAdjacency.nodes``)
+            * term_fuction: function that takes a GFuncNode as input and returns the SET of terms
+              of a specific type associated with the node (called once per node)
+        """
+        self.nodes = list(nodes)
+        self.node_ids = dict((node,i) for i,node in enumerate(self.nodes))
+        self.node_terms = [frozenset(term_fuction(node)) for node in self.nodes]
+        
+        self.terms = []
+        self.term_ids = {}
+        rows = []
+        cols = []
+        for node_id,terms in enumerate(self.node_terms):
+            for term in terms:
+                try:
+                    term_id = self.term_ids[term]
+                except KeyError:
+                    term_id = self.term_ids[term] = len(self.terms)
+                    self.terms.append(term)
+                rows.append(node_id)
+                cols.append(term_id)
+        
+        self.matrix = sp_sparse.csc_matrix((np.ones(len(rows),dtype=np.int32),(rows,cols)),
+                                           shape=(len(self.nodes),len(self.terms)))
+        self.term_sizes = np.diff(self.matrix.indptr)
+    
+    @classmethod
+    def from_go_slims(cls,nodes,go_slim_terms):
+        """
+        Returns a ``TermIndex`` of the GO-slim accessions of each node from the tree built by
+        ``load_go_slims()``.
+        """
+        return cls(nodes,lambda node: go_slim_terms[node.name].keys() if node.name in go_slim_terms else ())
+    
+    @classmethod
+    def from_prot_domains(cls,nodes,prot_domains,domain_type='pfam'):
+        """
+        Returns a ``TermIndex`` of the ``domain_type`` domains (exp: 'pfam', 'superfamily') of
+        each node from the tree built by ``load_prot_domains()``.
+        """
+        return cls(nodes,lambda node: prot_domains[node.name][domain_type] if node.name in prot_domains else ())
+    
+    def __len__(self):
+        """
+        Returns the number of nodes in the population.
+        """
+        return len(self.nodes)
+    
+    def term_nodes(self,term):
+        """
+        Returns sorted array of the ids of the nodes annotated with ``term``.
+        """
+        term_id = self.term_ids[term]
+        return self.matrix.indices[self.matrix.indptr[term_id]:self.matrix.indptr[term_id+1]]
+    
+    def positive_terms(self,positive_node_set):
+        """
+        Returns the set of terms found in at least one of the positive nodes that are in the index.
+        """
+        terms = set()
+        for node in positive_node_set:
+            node_id = self.node_ids.get(node)
+            if node_id is not None:
+                terms.update(self.node_terms[node_id])
+        return terms
+    
+    def counts(self,positive_node_set,terms):
+        """
+        *GIVEN:*
+            * positive_node_set: collection of GFuncNodes that are the "positive" group
+            * terms: list of terms
+        *RETURNS:*
+            * tuple of int arrays ``(n,i,m,N)`` with one entry per term (see ``count_terms_for_hypergeo()``)
+        """
+        is_positive = np.zeros(len(self.nodes),dtype=np.int32)
+        for node in positive_node_set:
+            node_id = self.node_ids.get(node)
+            if node_id is not None:
+                is_positive[node_id] = 1
+        
+        # positives per term with one sparse product
+        positives_per_term = self.matrix.T.dot(is_positive)
+        
+        term_ids = np.array([self.term_ids.get(term,-1) for term in terms],dtype=int)
+        known = term_ids >= 0
+        n = np.zeros(len(term_ids),dtype=int)
+        i = np.zeros(len(term_ids),dtype=int)
+        n[known] = self.term_sizes[term_ids[known]]
+        i[known] = positives_per_term[term_ids[known]]
+        m = len(self.nodes) - n
+        N = np.empty(len(term_ids),dtype=int)
+        N.fill(len(positive_node_set))
+        return n,i,m,N
+
+def count_terms_for_hypergeo(graph,positive_node_set,terms_of_enrichment,term_fuction=None,csr=None,term_index=None):
     """
     TAKES:
         * graph: gfunc graph obj
@@ -50,6 +168,10 @@ def count_terms_for_hypergeo(graph,positive_node_set,terms_of_enrichment,term_fu
         * terms_of_enrichment: set of terms present in at least one of the positive nodes
         * term_fuction: function that takes a GFuncNode as input and returns the SET of terms
           of a specific type associated with the node
+        * csr: optional ``CSRAdjacency`` snapshot of graph; if given, the nodes are read from it
+          and ``term_fuction`` is called only once per node
+        * term_index: optional ``TermIndex`` of the graph's nodes; if given, all counts come
+          from it and ``term_fuction`` is not needed
         
     *DOES:*
         * uses "positive_node_set" and "term_fuction" to count positives and negatives and
@@ -65,8 +187,32 @@ def count_terms_for_hypergeo(graph,positive_node_set,terms_of_enrichment,term_fu
           N = sample size
 
     """
+    if term_index is not None:
+        terms_of_enrichment = list(terms_of_enrichment)
+        n,i,m,N = term_index.counts(positive_node_set,terms_of_enrichment)
+        for term,n_t,i_t,m_t,N_t in zip(terms_of_enrichment,n.tolist(),i.tolist(),m.tolist(),N.tolist()):
+            yield (set([term]),n_t,i_t,m_t,N_t)
+        return
+    
     if term_fuction is None:
             raise ValueError("You MUST provide your own value for 'term_fuction'.")    
+    
+    if csr is not None:
+        node_terms = [term_fuction(node) for node in csr.nodes]
+        is_positive = [node in positive_node_set for node in csr.nodes]
+        N = len(positive_node_set)
+        
+        for term in terms_of_enrichment:
+            n = 0
+            i = 0
+            for terms,positive in zip(node_terms,is_positive):
+                if term in terms:
+                    n += 1
+                    i += positive
+            m = len(node_terms) - n
+            
+            yield (set([term]),n,i,m,N)
+        return
 
     for term in terms_of_enrichment:
         term = set([term])
@@ -86,12 +232,16 @@ def count_terms_for_hypergeo(graph,positive_node_set,terms_of_enrichment,term_fu
         
         yield (term,n,i,m,N)
     
-def enrichment_of_terms(graph,positive_node_set,term_fuction=None):
+def enrichment_of_terms(graph,positive_node_set,term_fuction=None,csr=None,exact_below=HYPERGEO_EXACT_BELOW,term_index=None):
     """
     *GIVEN:*
         * graph: gfunc graph obj
         * positive_node_set: set of GFuncNodes that are the "positive" group
         * term_fuction: function that takes a GFuncNode as input and returns the SET of terms of a specific type associated with the node.
+        * csr: optional ``CSRAdjacency`` snapshot of graph passed on to ``count_terms_for_hypergeo()``.
+        * exact_below: p-values below this are recomputed with exact integer arithmetic (see ``gfunc.stats.hypergeo_sf()``).
+        * term_index: optional ``TermIndex`` of the graph's nodes (exp: ``TermIndex.from_go_slims()``) to take
+          the terms and counts from; ``term_fuction`` is then only used for positive nodes missing from the index.
         
     *DOES:*
         * uses "positive_node_set" and "term_fuction" to compile a set of terms present in at least one of the positive nodes.
@@ -102,14 +252,19 @@ def enrichment_of_terms(graph,positive_node_set,term_fuction=None):
         * table of results as list of lists
     """
     
-    if term_fuction is None:
+    if term_fuction is None and term_index is None:
         raise ValueError("You MUST provide your own value for 'term_fuction'.")
     
     # compile a set of terms present in at least one of the positive nodes
     terms_of_enrichment = set()
+    if term_index is not None:
+        terms_of_enrichment.update(term_index.positive_terms(positive_node_set))
     for node in positive_node_set:
-        node_terms = term_fuction(node)
-        terms_of_enrichment.update(node_terms)
+        if term_index is not None and node in term_index.node_ids:
+            continue
+        if term_fuction is not None:
+            node_terms = term_fuction(node)
+            terms_of_enrichment.update(node_terms)
     
     # remove 'blank' terms
     terms_of_enrichment.discard('')
@@ -118,10 +273,16 @@ def enrichment_of_terms(graph,positive_node_set,term_fuction=None):
     results_table = []
     
     # Build results table before multiple hypothesis testing correction
-    count_iter = count_terms_for_hypergeo(graph,positive_node_set,terms_of_enrichment,term_fuction=term_fuction)
+    count_iter = count_terms_for_hypergeo(graph,positive_node_set,terms_of_enrichment,term_fuction=term_fuction,csr=csr,term_index=term_index)
     for term,n,i,m,N in count_iter:
-        p = cumHypergeoP(n,i,m,N)
-        results_table.append([term,n,i,m,N,p])
+        results_table.append([term,n,i,m,N])
+    
+    # all terms' p-values in one vectorized call
+    if results_table:
+        counts = np.array([row[1:5] for row in results_table],dtype=np.int64)
+        p_vals = hypergeo_sf(counts[:,0],counts[:,1],counts[:,2],counts[:,3],exact_below=exact_below)
+        for row,p in zip(results_table,p_vals):
+            row.append(float(p))
     
     # Perform multiple hypothesis testing correction
     results_table = benjHochFDR(table=results_table,pValColumn=5)
@@ -153,11 +314,11 @@ def load_prot_domains(graph,tsv_paths):
     *RETURNS:*
         * prot_domains tree
     """
-    # open and convert tsv_paths to namedtuple tables
+    # stream tsv_paths as namedtuple rows
     data_tables = []
     table_headers = ["ensembl_gene_id","ensembl_transcript_id","superfamily","pfam","transmembrane_domain","signal_domain","ncoils"]
     for tsv_path in tsv_paths:
-        data_tables.append(tableFile2namedTuple(tsv_path,headers=table_headers))
+        data_tables.append(iter_table_rows(tsv_path,headers=table_headers))
     
     # initialize and build prot_domains tree
     prot_domains = defaultdict(lambda: defaultdict(set))
@@ -199,11 +360,11 @@ def load_go_slims(graph,tsv_paths):
         * go_slims tree
     """
 
-    # open and convert tsv_paths to namedtuple tables
+    # stream tsv_paths as namedtuple rows
     data_tables = []
     table_headers = ["ensembl_gene_id","ensembl_transcript_id","goslim_goa_accession","goslim_goa_description"]
     for tsv_path in tsv_paths:
-        data_tables.append(tableFile2namedTuple(tsv_path,headers=table_headers))
+        data_tables.append(iter_table_rows(tsv_path,headers=table_headers))
     
     # initialize and build prot_domains tree
     go_slim_terms = defaultdict(lambda: defaultdict(str))
@@ -296,14 +457,35 @@ def get_top_ortho_sets(ortho_meanScore_dict,percentile=90):
     
     #return top_orthos
 
-def get_ortho_set_PTCIs(gHandler,gene_list):
+def get_ortho_set_PTCIs(gHandler,gene_list,use_csr=False):
     """
+    ``use_csr=True`` walks the ``CSRAdjacency`` snapshot of the graph (built if needed)
+    instead of networkx.
     """
     gH = gHandler
     graph = gH.graph
     
     orthologs = {}
     
+    if use_csr:
+        csr = gH.csr if gH.csr is not None else gH.build_csr()
+        ptcis = csr.edge_values('PTCI')
+        for gene in gene_list:
+            gene_id = csr.name_ids[gene]
+            ortho_ids = [gene_id] + list(csr.neighbors(gene_id))
+            
+            ortho_scores = []
+            for id1,id2 in xuniqueCombinations(ortho_ids,2):
+                ptci = ptcis[csr.edge_id(id1,id2)]
+                if not isnan(ptci):
+                    ortho_scores.append(ptci)
+            
+            if len(ortho_scores) > 0:
+                key = tuple(sorted([csr.nodes[i].name for i in ortho_ids]))
+                orthologs[key] = np.mean(ortho_scores)
+        
+        return orthologs
+    
     for gene in gene_list:
         ortho_names = [gene]
         ortho_scores = []
@@ -329,7 +511,7 @@ def get_ortho_set_PTCIs(gHandler,gene_list):
 def get_starting_nodes(ortho_path):
     """
     """
-    rows = tableFile2namedTuple(ortho_path)
+    rows = iter_table_rows(ortho_path)
     node_names = [row[0] for row in rows]
     return node_names
         
@@ -451,14 +633,77 @@ def reset_random_edges(gHandler,gBuilder,n_way_ortho_table,ortho_parser):
     # randomize n-way 1:1 ortholog sets
     species = n_way_ortho_table.columns
     for s in species:
-        np.random.shuffle(n_way_ortho_table[s])
+        # shuffling the column's array draws the same permutation as shuffling the
+        # Series in place, without a pandas __setitem__ per swap
+        column = n_way_ortho_table[s].values.copy()
+        np.random.shuffle(column)
+        n_way_ortho_table[s] = column
         
     # rebuild edge connections/objects in edge_dict and gHandler.graph
-    for row in n_way_ortho_table.iterrows():
-        row = list(row[1])
-        ortho_parser._resgister_edge(row,node_dict,edge_dict,graph)
-        
-    gBuilder.map_registries_to_graph(nodes=False,edges=True)
+    id_matrix,nodes = ortho_parser.node_id_matrix(n_way_ortho_table.values,node_dict)
+    ortho_parser.register_edges_bulk(id_matrix,nodes,edge_dict,graph)
+    
+    if gBuilder.columnar:
+        gBuilder.edge_store = columnarize(edge_dict.itervalues())
+    gHandler.edge_store = gBuilder.edge_store
+    gHandler.invalidate_csr()
+
+def ortho_set_arrays(gHandler,n_way_ortho_table,divergence_info):
+    """
+    *GIVEN:*
+        * gHandler: GraphHandler with ``expression_vector`` data on its nodes
+        * n_way_ortho_table: pandas.DataFrame with one species column per ortholog
+          set member (same table as ``reset_random_edges()``)
+        * divergence_info: ``(div_map,div_min,div_max)`` from ``get_div_info()``
+    *DOES:*
+        * stacks the expression vectors of the table's genes into one matrix, once
+    *RETURNS:*
+        * Bunch(expression,ortho_index,weights,set_names) to feed ``gfunc.fdr.ortho_set_ptcis()``
+          and ``gfunc.fdr.ptci_null()``; ``set_names`` are the ``get_ortho_set_PTCIs()`` keys
+    """
+    node_dict = gHandler.node_dict
+    species = [s.replace('_',' ') for s in n_way_ortho_table.columns]
+    
+    vectors = []
+    row_of_name = {}
+    rows = n_way_ortho_table.values
+    ortho_index = np.empty(rows.shape,dtype=int)
+    for r_i,row in enumerate(rows):
+        for s_i,name in enumerate(row):
+            if name not in row_of_name:
+                try:
+                    vectors.append(node_dict[name].data.expression_vector)
+                    row_of_name[name] = len(vectors) - 1
+                except (KeyError,AttributeError):
+                    row_of_name[name] = -1
+            ortho_index[r_i,s_i] = row_of_name[name]
+    
+    return Bunch({'expression':np.array(vectors,dtype=float),
+                  'ortho_index':ortho_index,
+                  'weights':species_pair_weights(species,divergence_info),
+                  'set_names':[tuple(sorted(row)) for row in rows]})
+
+def ortho_set_ptci_fdr(gHandler,n_way_ortho_table,divergence_info,reps=100,seed=None,processes=1):
+    """
+    Graph free replacement of looping over ``reset_random_edges()``, ``measure_relations()``
+    and ``get_ortho_set_PTCIs()`` to build a randomized null.
+    
+    *GIVEN:*
+        * gHandler,n_way_ortho_table,divergence_info: see ``ortho_set_arrays()``
+        * reps,seed,processes: see ``gfunc.fdr.ptci_null()``
+    *RETURNS:*
+        * dict mapping each ortholog set key --> (mean PTCI, empirical FDR)
+    """
+    sets = ortho_set_arrays(gHandler,n_way_ortho_table,divergence_info)
+    observed = ortho_set_ptcis(sets.expression,sets.ortho_index,sets.weights)
+    null = ptci_null(sets.expression,sets.ortho_index,sets.weights,reps=reps,seed=seed,processes=processes)
+    fdr = empirical_fdr(observed,null)
+    
+    results = {}
+    for key,ptci,q in zip(sets.set_names,observed.tolist(),fdr.tolist()):
+        if not isnan(ptci):
+            results[key] = (ptci,q)
+    return results
 
 def to_dataFrame_from_node(graph,data_func,index_func=None,column_func=None):
     """
@@ -542,7 +787,7 @@ def main():
     ortho_parser = parser_list[-1]
     
     gHandler,gBuilder = construct_builder_and_handler(parser_list)
-    gHandler.measure_relations()
+    gHandler.measure_relations(batched=True)
     
     #gene_list = get_starting_nodes(yopts.edge_data.one_to_one_ortholog_list)
     #scored_orthos = get_ortho_set_PTCIs(gHandler,gene_list)    
@@ -0,0 +1,38 @@
+"""
+####################
+gfunc_snapshot.py
+####################
+Script converting saved GraphHandler objects between ``cPickle`` files and memory mappable snapshots.
+"""
+import argparse
+
+from gfunc.snapshot import pickle_to_snapshot
+from gfunc.snapshot import snapshot_to_pickle
+
+
+def main():
+    """
+    The main loop.  Lets ROCK!
+    """
+
+    desc = """Converts a pickled GraphHandler (exp: outputs.graph_pickle) into a snapshot directory or back."""
+
+    parser = argparse.ArgumentParser(description=desc)
+
+    parser.add_argument('direction', type=str, choices=['to-snapshot','to-pickle'],
+                        help="""'to-snapshot': in_path is a pickle, out_path a snapshot directory. 'to-pickle': the reverse.""")
+    parser.add_argument('in_path', type=str,
+                        help="""Path to the file/directory to convert.""")
+    parser.add_argument('out_path', type=str,
+                        help="""Path to write the converted file/directory to.""")
+
+    args = parser.parse_args()
+
+    if args.direction == 'to-snapshot':
+        pickle_to_snapshot(args.in_path,args.out_path)
+    else:
+        snapshot_to_pickle(args.in_path,args.out_path)
+
+if __name__ == '__main__':
+    main()
+    print "main() completed."
@@ -5,8 +5,11 @@ gfunc_sort.py
 Script supporting the querying of the graph database and gene-set sorting based on target profiles.
 """
 
+import os
+import gzip
 import argparse
 import cPickle
+import multiprocessing
 from collections import defaultdict
 
 import yaml
@@ -20,10 +23,11 @@ from gfunc.analysis_classes import VoteHandler
 from gfunc.analysis_classes import ExpressionSimilarity,TFBSSimilarity,BranchLength
 from gfunc.graphTools import GraphBuilder
 from gfunc.graphTools import GraphHandler
+from gfunc.snapshot import load_snapshot
+from gfunc.snapshot import save_snapshot
 ##from gfunc.parsers.Cufflinks import CDiffFpkmTrackerParser
 ##from gfunc.parsers.ETE import PhyloXMLParser
 ##from gfunc.parsers.JASPAR import BasicTFBSParser
-from gfunc.maths import bayesian_score
 
 def gather_metric_stats(node_list):
     """
@@ -40,69 +44,250 @@ def gather_metric_stats(node_list):
     return metric_scores,metric_votes
 
 
+######################
+# Multi-target batch mode
+######################
+
+# Read-only state shared with the worker processes.  It is filled in before the
+# pool forks so the workers inherit it instead of unpickling the graph again.
+_batch = Bunch()
+
+def get_table_path(table_path,target):
+    """
+    Returns the sorted table path for ``target``: ``'%s'`` in ``table_path`` is
+    replaced by the target name, otherwise the name is added before the extension.
+    """
+    if '%s' in table_path:
+        return table_path % (target)
+    root,ext = os.path.splitext(table_path)
+    return '%s.%s%s' % (root,target,ext)
+
+def stack_sub_scores(polls,direct_values,vote_types):
+    """
+    Returns 2D array (nodes x sub-score slots) holding each node's polled and direct
+    value of every metric in ``vote_types``; missing sub-scores are ``nan``.
+    """
+    # sub-scores are laid out in the same order as GFuncNode.get_sub_scores() reads a Bunch of polls
+    sub_scores = []
+    for metric in Bunch((vote_type,None) for vote_type in vote_types):
+        sub_scores.append(polls[metric])
+        sub_scores.append(direct_values[metric])
+    return np.column_stack(sub_scores)
+
+def score_sub_scores(sub_scores,votes):
+    """
+    *GIVEN:*
+        * ``sub_scores``: output of ``stack_sub_scores()``
+        * ``votes``: int array of each node's total votes
+    *DOES:*
+        * masks out the ``nan`` sub-scores and calculates each node's naive combo score (mean of
+          its sub-scores) and bayesian score (``gfunc.maths.bayesian_score()`` with ``c`` the median
+          votes and ``m`` the median naive score of the nodes with at least one vote).
+    *RETURNS:*
+        * ``(b_scores,naive_scores)`` arrays aligned with the rows of ``sub_scores``
+    """
+    has_score = ~np.isnan(sub_scores)
+    score_counts = has_score.sum(axis=1)
+    score_sums = np.where(has_score,sub_scores,0).sum(axis=1)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        naive_scores = score_sums / score_counts
+    
+    c = float(np.median(votes[votes > 0]))
+    m = np.median(naive_scores[votes > 0])
+    b_scores = ((c * m) + score_sums) / (score_counts + c)
+    if np.isnan(b_scores).any():
+        raise ValueError
     
-def calculate_straight_combo_score(node,gHandler):
+    return b_scores,naive_scores
+
+def score_target_polls(polls,voters,direct_values,vote_types):
     """
+    *GIVEN:*
+        * ``polls``, ``voters``: output of ``VoteHandler.poll_target_values()`` for the nodes to sort
+        * ``direct_values``: dict keyed by metric of each sorted node's own relation to the target
+        * ``vote_types``: the polled metrics
+    *DOES:*
+        * scores the nodes with ``score_sub_scores()`` using arrays instead of node attributes.
+    *RETURNS:*
+        * ``(b_scores,naive_scores,votes)`` arrays aligned with the polled nodes
     """
-    sub_scores = node.get_sub_scores(gHandler.target_node,gHandler.graph)
-    return np.mean([x for x in sub_scores if not np.isnan(x)])
+    sub_scores = stack_sub_scores(polls,direct_values,vote_types)
     
-def record_combo_scores(node_list,gHandler):
+    votes = np.zeros(len(sub_scores),dtype=int)
+    for metric in vote_types:
+        votes += voters[metric].counts()
+    
+    b_scores,naive_scores = score_sub_scores(sub_scores,votes)
+    return b_scores,naive_scores,votes
+
+def score_polled_nodes(node_list,gHandler):
     """
+    *GIVEN:*
+        * ``node_list``: nodes polled by ``GraphHandler.take_votes()`` about the installed target
+        * ``gHandler``: the GraphHandler
+    *DOES:*
+        * gathers every node's sub-scores in one pass, reading the target edges from the
+          ``CSRAdjacency`` snapshot (built if needed) instead of looking each one up in the graph,
+          and scores them with ``score_sub_scores()``.
+    *RETURNS:*
+        * ``(b_scores,naive_scores,votes)`` arrays aligned with ``node_list``
     """
-    comboScores = []
+    vote_types = gHandler.vote_handler.vote_types
+    csr = gHandler.csr if gHandler.csr is not None else gHandler.build_csr()
     
-    for node in node_list:
-        cScore = calculate_straight_combo_score(node,gHandler)
-        node.combo_score = cScore
-        comboScores.append(cScore)
-    gHandler.combo_scores = comboScores
+    node_ids = np.array([csr.node_ids[node] for node in node_list],dtype=int)
+    edge_to_target = csr.edge_ids_to(csr.node_ids[gHandler.target_node])[node_ids]
+    if (edge_to_target < 0).any():
+        raise KeyError("Some nodes have no edge to the target node.")
+    
+    polls = {}
+    direct_values = {}
+    for metric in vote_types:
+        polls[metric] = np.array([node.poll_results[metric] for node in node_list],dtype=float)
+        direct_values[metric] = csr.edge_values(metric)[edge_to_target]
+    votes = np.array([node.total_votes() for node in node_list],dtype=int)
+    
+    b_scores,naive_scores = score_sub_scores(stack_sub_scores(polls,direct_values,vote_types),votes)
+    return b_scores,naive_scores,votes
 
-def get_median_votes(node_list):
+def record_scores(node_list,gHandler):
     """
-    for node where there is at least one vote.
+    Sets ``node.combo_score`` (naive score) and ``node.b_score`` of every node in ``node_list``
+    and ``gHandler.combo_scores`` from ``score_polled_nodes()`` and returns its arrays.
     """
-    vote_totals = []
-    for node in node_list:
-        node_votes = node.total_votes()
-        if node_votes > 0:
-            vote_totals.append(node_votes)
-    return np.median(vote_totals)
-            
+    b_scores,naive_scores,votes = score_polled_nodes(node_list,gHandler)
+    for node,b_score,naive_score in zip(node_list,b_scores,naive_scores):
+        node.combo_score = naive_score
+        node.b_score = b_score
+    gHandler.combo_scores = list(naive_scores)
+    return b_scores,naive_scores,votes
+
+SORTED_TABLE_HEADERS = ['node','rank','b_score','naive_score','votes','std_dev_from_median_b_score']
 
-def record_bayesian_combo_score(node_list,median_votes,gHandler):
+def rank_scores(b_scores,top_k=None):
     """
+    *GIVEN:*
+        * ``b_scores``: array of bayesian scores
+        * ``top_k``: only rank the ``top_k`` best scores (``None`` ranks them all)
+    *DOES:*
+        * orders the scores the same way as sorting a list by b_score and then reversing it.
+          With ``top_k`` only the scores at or above the ``top_k``-th best one are sorted
+          (found by partial selection), so the order is that of the first ``top_k`` rows of the full ranking.
+    *RETURNS:*
+        * int array of the indexes of ``b_scores`` from best to worst
     """
-    scores_with_votes = []
-    for node in node_list:
-        if node.total_votes() > 0:
-            scores_with_votes.append(node.combo_score)
-            
-    median_score = np.median(scores_with_votes)
+    if top_k is None or top_k >= len(b_scores):
+        return np.argsort(b_scores,kind='mergesort')[::-1]
+    if top_k <= 0:
+        return np.array([],dtype=int)
     
-    target_node = gHandler.target_node
-    graph = gHandler.graph
-    for node in node_list:
-        c=median_votes
-        m=median_score
-        n=node.total_votes()
-        scores=node.get_sub_scores(target_node,graph)
-        node.b_score = bayesian_score(c,m,n,scores,scale_mod=1)
-    
-def write_sorted_table(node_list,table_path):
-    """
-    """
-    node_list.sort(key=lambda node: node.b_score)
-    node_list.reverse()
-    b_scores = [node.b_score for node in node_list]
-    std_dev = np.std(b_scores)
-    out_file = open(table_path,'w')
-    header = "%s\n" % ('\t'.join(['node','rank','b_score','naive_score','votes','std_dev_from_median_b_score']))
-    out_file.write(header)
-    for i,node in enumerate(node_list):
-        out_file.write('%s\n' % ('\t'.join([node.name,str(i+1),str(node.b_score),str(node.combo_score),str(node.total_votes()),str(node.b_score/std_dev)])))
-    out_file.close()
+    kth_best = b_scores[np.argpartition(b_scores,len(b_scores)-top_k)[len(b_scores)-top_k]]
+    # keep ties with the kth best score so they keep their full-ranking order
+    candidates = np.flatnonzero(b_scores >= kth_best)
+    return candidates[np.argsort(b_scores[candidates],kind='mergesort')[::-1]][:top_k]
+
+def _open_sorted_table(table_path):
+    """
+    Returns a file object to write ``table_path`` to: gzip compressed if it ends in '.gz'.
+    """
+    if table_path.endswith('.gz'):
+        return gzip.open(table_path,'wb')
+    return open(table_path,'w')
+
+def write_sorted_scores(names,b_scores,naive_scores,votes,table_path,top_k=None,chunk_rows=5000):
+    """
+    Writes the sorted table (``SORTED_TABLE_HEADERS`` columns, best b_score first) from
+    arrays aligned with ``names``.
+    
+    * ``top_k``: only write the ``top_k`` best ranked nodes (see ``rank_scores()``)
+    * ``table_path``: ending in '.gz' writes a gzip compressed table; ending in '.npz' writes
+      a ``numpy.savez_compressed`` file with one array per table column instead
+    * ``chunk_rows``: number of rows joined into each write
+    """
+    order = rank_scores(b_scores,top_k=top_k)
+    if top_k is None or top_k >= len(b_scores):
+        std_dev = np.std(b_scores[order])
+    else:
+        std_dev = np.std(b_scores)
+    
+    if table_path.endswith('.npz'):
+        columns = dict(zip(SORTED_TABLE_HEADERS,
+                           [np.array(names)[order],np.arange(1,len(order)+1),b_scores[order],
+                            naive_scores[order],votes[order],b_scores[order]/std_dev]))
+        np.savez_compressed(table_path,**columns)
+        return
+    
+    out_file = _open_sorted_table(table_path)
+    try:
+        out_file.write("%s\n" % ('\t'.join(SORTED_TABLE_HEADERS)))
+        for start in xrange(0,len(order),chunk_rows):
+            rows = []
+            for rank,i in enumerate(order[start:start+chunk_rows],start):
+                b_score = b_scores[i]
+                rows.append('\t'.join([names[i],str(rank+1),str(b_score),str(naive_scores[i]),str(votes[i]),str(b_score/std_dev)]))
+            out_file.write('%s\n' % ('\n'.join(rows)))
+    finally:
+        out_file.close()
+
+def sort_batch_target(target_index):
+    """
+    Polls, scores and writes the sorted table for one target of the batch.
+    Runs in the worker processes using the read-only state in ``_batch``.
+    """
+    b = _batch
+    target = b.targets[target_index]
+    
+    results = b.vote_handler.poll_virtual_target(b.sort_nodes,target,weights_by_edge=b.weights_by_edge)
+    b_scores,naive_scores,votes = score_target_polls(results.polls,results.voters,results.direct,b.vote_types)
     
+    table_path = get_table_path(b.table_path,target.source_node.name)
+    write_sorted_scores(b.names,b_scores,naive_scores,votes,table_path,top_k=b.top_k)
+    return table_path
+
+def sort_targets_in_batch(gHandler,targets,genes_to_sort,table_path,processes=None,top_k=None):
+    """
+    *GIVEN:*
+        * ``gHandler``: built GraphHandler with its metric handlers installed
+        * ``targets``: list of node names to use as targets
+        * ``genes_to_sort``: species whose nodes get sorted
+        * ``table_path``: sorted table path (see ``get_table_path()``)
+        * ``processes``: number of worker processes (``None`` = one per cpu)
+        * ``top_k``: only write the ``top_k`` best ranked nodes of each table
+    *DOES:*
+        * measures every target's relations to every node at once (``GraphHandler.virtual_targets()``)
+        * polls and scores the nodes of ``genes_to_sort`` separately for each target in
+          a process pool without installing any target node in the graph
+        * writes one sorted table per target
+    *RETURNS:*
+        * list of the written table paths in the order of ``targets``
+    """
+    vote_handler = gHandler.vote_handler
+    
+    # node order must match a loop over node_dict so that ties rank the same way as in main()
+    sort_nodes = [node for node in gHandler.node_dict.itervalues() if node.species == genes_to_sort]
+    
+    _batch.targets = gHandler.virtual_targets(targets)
+    _batch.vote_types = vote_handler.vote_types
+    _batch.vote_handler = vote_handler
+    _batch.sort_nodes = sort_nodes
+    _batch.names = [node.name for node in sort_nodes]
+    _batch.table_path = table_path
+    _batch.top_k = top_k
+    _batch.weights_by_edge = None
+    if vote_handler.weight_by is not None:
+        _batch.weights_by_edge = gHandler.csr.edge_values(vote_handler.weight_by)
+    
+    if processes == 1:
+        return map(sort_batch_target,range(len(targets)))
+    
+    pool = multiprocessing.Pool(processes)
+    try:
+        table_paths = pool.map(sort_batch_target,range(len(targets)))
+    finally:
+        pool.close()
+        pool.join()
+    return table_paths
+
 def main():
     """
     The main loop.  Lets ROCK!
@@ -119,7 +304,19 @@ def main():
     
     yopts = bunchify(yaml.load(open(args.config_file,'rU')))
     
-    gHandler = cPickle.load(open(yopts.outputs.graph_pickle,'rb'))
+    if 'graph_snapshot' in yopts.outputs:
+        gHandler = load_snapshot(yopts.outputs.graph_snapshot)
+    else:
+        gHandler = cPickle.load(open(yopts.outputs.graph_pickle,'rb'))
+    
+    # batch mode: sort for every target in the 'targets' list
+    if 'targets' in yopts:
+        sort_targets_in_batch(gHandler,yopts.targets,yopts.genes_to_sort,
+                              table_path=yopts.outputs.sorted_table,
+                              processes=yopts.get('processes'),
+                              top_k=yopts.get('top_k'))
+        return
+    
     gHandler.clone_node_as_target(yopts.target)
     gHandler.install_target()
     
@@ -128,13 +325,14 @@ def main():
     
     metric_scores,metric_votes = gather_metric_stats(node_list)
     
-    record_combo_scores(node_list,gHandler)
-    
-    median_votes = get_median_votes(node_list)
-    record_bayesian_combo_score(node_list,median_votes,gHandler)
+    b_scores,naive_scores,votes = record_scores(node_list,gHandler)
     
-    cPickle.dump(gHandler,open(yopts.outputs.polled_pickle,'w'))
-    write_sorted_table(node_list,table_path=yopts.outputs.sorted_table)
+    if 'polled_pickle' in yopts.outputs:
+        cPickle.dump(gHandler,open(yopts.outputs.polled_pickle,'w'))
+    if 'polled_snapshot' in yopts.outputs:
+        save_snapshot(gHandler,yopts.outputs.polled_snapshot)
+    write_sorted_scores([node.name for node in node_list],b_scores,naive_scores,votes,
+                        table_path=yopts.outputs.sorted_table,top_k=yopts.get('top_k'))
 
 if __name__ == '__main__':
     main()
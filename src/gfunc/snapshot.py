@@ -0,0 +1,520 @@
+"""
+####################
+snapshot.py
+####################
+Code supporting saving and loading whole GraphHandler objects as versioned on-disk
+snapshots made of flat ``.npy`` arrays that can be opened with ``numpy.memmap``.
+
+A snapshot is a directory holding:
+    | ``manifest.json`` -- format name/version, table sizes and the column catalog
+    | ``nodes.*.npy`` -- node table: name, species, flags
+    | ``edges.*.npy`` -- edge table: node ids of both ends, flags
+    | ``adj.*.npy`` -- CSR adjacency (``indptr``, ``indices``, ``edge_ids``) over table ids
+    | ``<table>.data.<i>.npy`` / ``<table>.present.<i>.npy`` -- one numeric data column
+      (exp: ``expression_vector`` as a 2D matrix, ``PTCI`` as a 1D array)
+    | ``extras.pickle`` -- whatever does not fit in flat arrays (metric handlers, object
+      columns, poll results, voters...) with nodes/edges referenced by table id
+
+Opening a snapshot with ``open_snapshot()`` only maps the arrays: it takes milliseconds
+and several processes can share the same pages, but it gives arrays, not a GraphHandler.
+``load_snapshot()`` rebuilds a ``GraphHandler`` whose node/edge ``data`` are ``ColumnView``
+objects over the mapped columns.  That still creates every GFuncNode/GFuncEdge, the
+networkx graph and the extras in Python, so it is O(nodes+edges) and about as slow as
+loading the old pickle; what it saves is reading and unpickling the data columns.  ``pickle_to_snapshot()`` and ``snapshot_to_pickle()`` convert from/to the
+``cPickle`` files written by older runs.
+"""
+import os
+import json
+import cPickle
+
+import numpy as np
+import networkx as nx
+
+from gfunc.data_classes import Bunch
+from gfunc.data_classes import GFuncNode
+from gfunc.data_classes import GFuncEdge
+from gfunc.data_classes import ColumnStore
+from gfunc.data_classes import ColumnView
+from gfunc.graphTools import CSRAdjacency
+from gfunc.graphTools import GraphHandler
+
+SNAPSHOT_FORMAT  = 'gfunc-graph-snapshot'
+SNAPSHOT_VERSION = 1
+
+# attributes kept in the flat tables instead of extras.pickle
+_NODE_TABLE_ATTRS    = set(['name','species','data','_is_target','_graph'])
+_EDGE_TABLE_ATTRS    = set(['nodes','key','data'])
+_HANDLER_TABLE_ATTRS = set(['node_dict','edge_dict','graph','node_store','edge_store','csr'])
+
+
+######################
+# Writing
+######################
+
+def save_snapshot(gHandler,path):
+    """
+    *GIVEN:*
+        * ``gHandler``: a GraphHandler (Bunch or ColumnStore backed)
+        * ``path``: directory to write the snapshot to (created if needed)
+    *DOES:*
+        * writes ``gHandler`` as a snapshot without changing it.
+    *RETURNS:*
+        * ``path``
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    graph = gHandler.graph
+
+    nodes,node_ids = _node_table(gHandler)
+    edges,edge_ids = _edge_table(gHandler,nodes,node_ids)
+
+    manifest = Bunch(format=SNAPSHOT_FORMAT,
+                     version=SNAPSHOT_VERSION,
+                     node_count=len(nodes),
+                     edge_count=len(edges),
+                     columns=Bunch(nodes=[],edges=[]),
+                     node_graph=None)
+    extras = Bunch(object_columns=Bunch(nodes=Bunch(),edges=Bunch()),
+                   node_dict_keys=Bunch(),
+                   edge_dict_keys=Bunch(),
+                   node_attrs=Bunch(),
+                   edge_attrs=Bunch(),
+                   graph_attrs=graph.graph,
+                   graph_node_attrs=Bunch(),
+                   graph_edge_attrs=Bunch(),
+                   handler_attrs=Bunch())
+
+    # --- node table --- #
+    node_dict_ids = set(id(n) for n in gHandler.node_dict.itervalues())
+    _save_array(path,'nodes.name',_string_array([node.name for node in nodes]))
+    _save_array(path,'nodes.species',_string_array([node.species if node.species is not None else '' for node in nodes]))
+    _save_array(path,'nodes.has_species',np.array([node.species is not None for node in nodes],dtype=np.bool_))
+    _save_array(path,'nodes.is_target',np.array([bool(getattr(node,'_is_target',False)) for node in nodes],dtype=np.bool_))
+    _save_array(path,'nodes.in_dict',np.array([id(node) in node_dict_ids for node in nodes],dtype=np.bool_))
+    _save_array(path,'nodes.in_graph',np.array([node in graph for node in nodes],dtype=np.bool_))
+
+    for key,node in gHandler.node_dict.iteritems():
+        if key != node.name:
+            extras.node_dict_keys[node_ids[node]] = key
+
+    node_graphs = set(id(getattr(node,'_graph',None)) for node in nodes)
+    if node_graphs <= set([id(graph)]):
+        manifest.node_graph = 'handler'
+    elif node_graphs == set([id(None)]):
+        manifest.node_graph = 'none'
+
+    for n_id,node in enumerate(nodes):
+        attrs = Bunch((k,v) for k,v in node.__dict__.iteritems() if k not in _NODE_TABLE_ATTRS)
+        if manifest.node_graph is None:
+            attrs['_graph'] = getattr(node,'_graph',None)
+        if attrs:
+            extras.node_attrs[n_id] = attrs
+        if node in graph and graph.node[node]:
+            extras.graph_node_attrs[n_id] = graph.node[node]
+
+    # --- edge table --- #
+    edge_dict_ids = set(id(e) for e in gHandler.edge_dict.itervalues())
+    _save_array(path,'edges.node1',np.array([node_ids[edge.nodes[0]] for edge in edges],dtype=np.int64))
+    _save_array(path,'edges.node2',np.array([node_ids[edge.nodes[1]] for edge in edges],dtype=np.int64))
+    _save_array(path,'edges.in_dict',np.array([id(edge) in edge_dict_ids for edge in edges],dtype=np.bool_))
+
+    in_graph = np.zeros(len(edges),dtype=np.bool_)
+    for node1,node2,attrs in graph.edges_iter(data=True):
+        e_id = edge_ids[attrs['edge']]
+        in_graph[e_id] = True
+        other_attrs = dict((k,v) for k,v in attrs.iteritems() if k != 'edge')
+        if other_attrs:
+            extras.graph_edge_attrs[e_id] = other_attrs
+    _save_array(path,'edges.in_graph',in_graph)
+
+    for key,edge in gHandler.edge_dict.iteritems():
+        if key != edge.key:
+            extras.edge_dict_keys[edge_ids[edge]] = key
+
+    for e_id,edge in enumerate(edges):
+        attrs = Bunch((k,v) for k,v in edge.__dict__.iteritems() if k not in _EDGE_TABLE_ATTRS)
+        if attrs:
+            extras.edge_attrs[e_id] = attrs
+
+    # --- adjacency in networkx iteration order --- #
+    indptr = np.zeros(len(nodes)+1,dtype=np.int64)
+    indices = []
+    adj_edge_ids = []
+    for n_id,node in enumerate(nodes):
+        if node in graph:
+            for neighbor,attrs in graph.adj[node].iteritems():
+                indices.append(node_ids[neighbor])
+                adj_edge_ids.append(edge_ids[attrs['edge']])
+        indptr[n_id+1] = len(indices)
+    _save_array(path,'adj.indptr',indptr)
+    _save_array(path,'adj.indices',np.array(indices,dtype=np.int64))
+    _save_array(path,'adj.edge_ids',np.array(adj_edge_ids,dtype=np.int64))
+
+    # --- data columns --- #
+    for table,objs in (('nodes',nodes),('edges',edges)):
+        store = _table_store(objs)
+        for col_i,name in enumerate(sorted(store._columns)):
+            values,present = store.column(name)
+            kind = store._kinds[name]
+            if kind == 'object':
+                extras.object_columns[table][name] = (values.tolist(),np.array(present))
+                continue
+            file_name = '%s.data.%s' % (table,col_i)
+            _save_array(path,file_name,values)
+            _save_array(path,'%s.present.%s' % (table,col_i),present)
+            manifest.columns[table].append(Bunch(name=name,kind=kind,file=file_name,
+                                                 present='%s.present.%s' % (table,col_i)))
+
+    # --- everything else the handler carries --- #
+    for k,v in gHandler.__dict__.iteritems():
+        if k not in _HANDLER_TABLE_ATTRS:
+            extras.handler_attrs[k] = v
+
+    extras_file = open(os.path.join(path,'extras.pickle'),'wb')
+    try:
+        pickler = cPickle.Pickler(extras_file,2)
+        pickler.persistent_id = _persistent_id_maker(graph,node_ids,edge_ids)
+        pickler.dump(extras)
+    finally:
+        extras_file.close()
+
+    # manifest goes last so a half written snapshot is not taken for a good one
+    manifest_file = open(os.path.join(path,'manifest.json'),'w')
+    try:
+        json.dump(manifest,manifest_file,indent=2,sort_keys=True)
+    finally:
+        manifest_file.close()
+    return path
+
+def _node_table(gHandler):
+    """
+    Returns ``(nodes,node_ids)``: every node of ``node_dict``, the graph and the edges
+    (in that order), and a dict mapping node --> table id.
+    """
+    nodes = []
+    node_ids = {}
+
+    def add(node):
+        if node not in node_ids:
+            node_ids[node] = len(nodes)
+            nodes.append(node)
+
+    for node in gHandler.node_dict.itervalues():
+        add(node)
+    for node in gHandler.graph.nodes_iter():
+        add(node)
+    for edge in gHandler.edge_dict.itervalues():
+        add(edge.nodes[0])
+        add(edge.nodes[1])
+    return nodes,node_ids
+
+def _edge_table(gHandler,nodes,node_ids):
+    """
+    Returns ``(edges,edge_ids)``: every GFuncEdge of ``edge_dict`` and of the graph (in
+    that order), and a dict mapping edge --> table id.
+    """
+    edges = []
+    edge_ids = {}
+
+    def add(edge):
+        if edge not in edge_ids:
+            edge_ids[edge] = len(edges)
+            edges.append(edge)
+
+    for edge in gHandler.edge_dict.itervalues():
+        add(edge)
+    for node1,node2,attrs in gHandler.graph.edges_iter(data=True):
+        try:
+            add(attrs['edge'])
+        except KeyError:
+            raise ValueError("Graph edge (%s,%s) has no 'edge' attribute: only graphs of GFuncEdges can be saved as snapshots." % (node1,node2))
+    return edges,edge_ids
+
+def _table_store(objs):
+    """
+    Returns a ``ColumnStore`` whose row ``i`` holds the data of ``objs[i]``.  The objects'
+    own store is used as is when it already has exactly that layout; otherwise their data
+    is copied into a new store and the objects are left untouched.
+    """
+    if len(objs) > 0 and all(isinstance(obj.data,ColumnView) for obj in objs):
+        store = objs[0].data._store
+        if len(store) == len(objs) and all(obj.data._store is store and obj.data.row == i for i,obj in enumerate(objs)):
+            return store
+
+    store = ColumnStore(capacity=len(objs))
+    for obj in objs:
+        store.view(store.add_row()).update(obj.data)
+    store.compact()
+    return store
+
+def _persistent_id_maker(graph,node_ids,edge_ids):
+    """
+    Returns a ``persistent_id`` function that pickles the graph, table nodes and table
+    edges as references.
+    """
+    def persistent_id(obj):
+        if obj is graph:
+            return 'graph'
+        if isinstance(obj,GFuncNode) and obj in node_ids:
+            return 'node:%d' % (node_ids[obj])
+        if isinstance(obj,GFuncEdge) and obj in edge_ids:
+            return 'edge:%d' % (edge_ids[obj])
+        return None
+    return persistent_id
+
+def _string_array(strings):
+    """
+    Returns ``strings`` as a fixed width numpy string array.
+    """
+    if len(strings) == 0:
+        return np.array([],dtype='S1')
+    return np.array(strings)
+
+def _save_array(path,name,array):
+    """
+    Writes ``array`` to ``<path>/<name>.npy``.
+    """
+    np.save(os.path.join(path,'%s.npy' % (name)),np.ascontiguousarray(array))
+
+
+######################
+# Reading
+######################
+
+class GraphSnapshot(object):
+    """
+    Flat-array view of a saved snapshot.  Arrays are opened with ``numpy.memmap`` when
+    ``mmap_mode`` is not ``None`` so nothing is read until it is used.
+
+    Attributes:
+        | ``manifest`` -- Bunch read from ``manifest.json``
+        | ``node_names``, ``node_species`` -- node table string arrays
+        | ``edge_node1``, ``edge_node2`` -- node table ids at both ends of each edge
+        | ``indptr``, ``indices``, ``edge_ids`` -- CSR adjacency over table ids
+    """
+    def __init__(self,path,mmap_mode='r'):
+        """
+        *GIVEN:*
+            * ``path``: snapshot directory
+            * ``mmap_mode``: passed to ``numpy.load`` (``'r'``, ``'c'``, ``None``...)
+        """
+        self.path = path
+        self.mmap_mode = mmap_mode
+
+        manifest_path = os.path.join(path,'manifest.json')
+        if not os.path.exists(manifest_path):
+            raise ValueError("%s is not a gfunc graph snapshot (no manifest.json)." % (path))
+        manifest = json.load(open(manifest_path,'rU'))
+        if manifest.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError("%s is not a gfunc graph snapshot (format: %r)." % (path,manifest.get('format')))
+        if manifest.get('version') != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported gfunc graph snapshot version %r in %s (this code reads version %s)." % (manifest.get('version'),path,SNAPSHOT_VERSION))
+        self.manifest = Bunch(manifest)
+
+        self.node_names   = self._load('nodes.name')
+        self.node_species = self._load('nodes.species')
+        self.edge_node1   = self._load('edges.node1')
+        self.edge_node2   = self._load('edges.node2')
+        self.indptr       = self._load('adj.indptr')
+        self.indices      = self._load('adj.indices')
+        self.edge_ids     = self._load('adj.edge_ids')
+
+    def __repr__(self):
+        """
+        Returns ``GraphSnapshot('<snapshot directory>')``.
+        """
+        return "GraphSnapshot(%r)" % (self.path)
+
+    def _load(self,name):
+        """
+        Returns the array saved as ``name``.
+        """
+        array_path = os.path.join(self.path,'%s.npy' % (name))
+        if self.mmap_mode is None:
+            return np.load(array_path)
+        try:
+            return np.load(array_path,mmap_mode=self.mmap_mode)
+        except ValueError:
+            # empty arrays can not be memory mapped
+            return np.load(array_path)
+
+    def column_names(self,table):
+        """
+        Returns the names of the numeric data columns of ``table`` (``'nodes'`` or ``'edges'``).
+        """
+        return [_plain_str(col['name']) for col in self.manifest.columns[table]]
+
+    def column(self,table,name):
+        """
+        Returns ``(values,present)`` arrays of data column ``name`` of ``table``
+        (``'nodes'`` or ``'edges'``).  Raises ``KeyError`` if there is no such numeric column.
+        """
+        for col in self.manifest.columns[table]:
+            if col['name'] == name:
+                return self._load(col['file']),self._load(col['present'])
+        raise KeyError(name)
+
+    def store(self,table):
+        """
+        Returns a ``ColumnStore`` over the data columns of ``table`` (object columns are
+        added by ``to_graph_handler()``).
+        """
+        size = self.manifest['%s_count' % (table[:-1])]
+        columns,present,kinds = {},{},{}
+        for col in self.manifest.columns[table]:
+            name = _plain_str(col['name'])
+            # plain ndarray views of the maps so node data does not come back as memmaps
+            columns[name] = np.asarray(self._load(col['file']))
+            present[name] = np.asarray(self._load(col['present']))
+            kinds[name] = col['kind']
+        return ColumnStore.from_arrays(size,columns,present,kinds)
+
+    def to_graph_handler(self):
+        """
+        Returns the saved GraphHandler rebuilt around ``ColumnStore`` objects of the mapped
+        columns.  Use ``mmap_mode='c'`` if the data will be changed (writes then stay private
+        to the process).
+        
+        The node/edge objects, registries and networkx graph are rebuilt one by one, so this
+        is O(nodes+edges) Python work; the data columns themselves are not copied.
+        """
+        manifest = self.manifest
+        graph = nx.Graph()
+
+        extras_file = open(os.path.join(self.path,'extras.pickle'),'rb')
+        try:
+            # nodes/edges must exist before the extras that point at them are read
+            nodes = []
+            edges = []
+            unpickler = cPickle.Unpickler(extras_file)
+            unpickler.persistent_load = _persistent_load_maker(graph,nodes,edges)
+            node_store = self.store('nodes')
+            edge_store = self.store('edges')
+
+            node_graph = graph if manifest.node_graph == 'handler' else None
+            has_species = self._load('nodes.has_species')
+            is_target = self._load('nodes.is_target')
+            species_list = self.node_species.tolist()
+            for n_id,name in enumerate(self.node_names.tolist()):
+                species = species_list[n_id] if has_species[n_id] else None
+                nodes.append(GFuncNode(name,species,node_graph,is_target=bool(is_target[n_id]),
+                                       store=node_store,row=n_id))
+
+            node1 = self.edge_node1.tolist()
+            node2 = self.edge_node2.tolist()
+            for e_id in xrange(manifest.edge_count):
+                edges.append(GFuncEdge(nodes[node1[e_id]],nodes[node2[e_id]],store=edge_store,row=e_id))
+
+            extras = unpickler.load()
+        finally:
+            extras_file.close()
+
+        for table,store in (('nodes',node_store),('edges',edge_store)):
+            for name,(values,present) in extras.object_columns[table].iteritems():
+                column = np.empty(len(values),dtype=object)
+                column[:] = values
+                store._columns[name] = column
+                store._present[name] = present
+                store._kinds[name] = 'object'
+
+        for n_id,attrs in extras.node_attrs.iteritems():
+            nodes[n_id].__dict__.update(attrs)
+        for e_id,attrs in extras.edge_attrs.iteritems():
+            edges[e_id].__dict__.update(attrs)
+
+        # --- graph --- #
+        graph.graph.update(extras.graph_attrs)
+        in_graph = self._load('nodes.in_graph')
+        for n_id in np.flatnonzero(in_graph):
+            graph.add_node(nodes[n_id],extras.graph_node_attrs.get(n_id,{}))
+        edge_in_graph = self._load('edges.in_graph')
+        for e_id in np.flatnonzero(edge_in_graph):
+            edge = edges[e_id]
+            attrs = Bunch({'edge':edge})
+            attrs.update(extras.graph_edge_attrs.get(e_id,{}))
+            graph.add_edge(edge.nodes[0],edge.nodes[1],attrs)
+
+        # --- registries --- #
+        node_dict = {}
+        for n_id in np.flatnonzero(self._load('nodes.in_dict')):
+            node_dict[extras.node_dict_keys.get(n_id,nodes[n_id].name)] = nodes[n_id]
+        edge_dict = {}
+        for e_id in np.flatnonzero(self._load('edges.in_dict')):
+            edge_dict[extras.edge_dict_keys.get(e_id,edges[e_id].key)] = edges[e_id]
+
+        gHandler = GraphHandler(node_dict,edge_dict,graph,node_store=node_store,edge_store=edge_store)
+        gHandler.__dict__.update(extras.handler_attrs)
+
+        # the saved adjacency is a ready made CSR snapshot when every node is in the graph
+        if in_graph.all():
+            gHandler.csr = CSRAdjacency.from_arrays(nodes,edges,self.indptr,self.indices,self.edge_ids)
+        return gHandler
+
+def _plain_str(text):
+    """
+    Returns ``text`` (read from json as unicode) as ``str`` when it is plain ascii.
+    """
+    try:
+        return str(text)
+    except UnicodeEncodeError:
+        return text
+
+def _persistent_load_maker(graph,nodes,edges):
+    """
+    Returns a ``persistent_load`` function that undoes ``_persistent_id_maker()``.
+    """
+    def persistent_load(pid):
+        if pid == 'graph':
+            return graph
+        table,i = pid.split(':')
+        if table == 'node':
+            return nodes[int(i)]
+        if table == 'edge':
+            return edges[int(i)]
+        raise cPickle.UnpicklingError("Unknown persistent id %r in snapshot extras." % (pid))
+    return persistent_load
+
+def open_snapshot(path,mmap_mode='r'):
+    """
+    Returns a ``GraphSnapshot`` of the snapshot at ``path`` with its arrays memory mapped.
+    """
+    return GraphSnapshot(path,mmap_mode=mmap_mode)
+
+def load_snapshot(path,mmap_mode='c'):
+    """
+    *GIVEN:*
+        * ``path``: snapshot directory written by ``save_snapshot()``
+        * ``mmap_mode``: ``'c'`` (default) maps the columns copy-on-write so processes
+          share pages until they write; ``None`` reads everything into memory.
+    *RETURNS:*
+        * the saved GraphHandler
+    
+    Every node, edge and graph entry is rebuilt in Python (see ``to_graph_handler()``), so
+    this takes time in proportion to the graph size; only the data columns are mapped
+    instead of read.  Use ``open_snapshot()`` to get at the arrays without that cost.
+    """
+    return GraphSnapshot(path,mmap_mode=mmap_mode).to_graph_handler()
+
+
+######################
+# Converters
+######################
+
+def pickle_to_snapshot(pickle_path,snapshot_path):
+    """
+    Converts a ``cPickle`` of a GraphHandler (exp: ``outputs.graph_pickle``) into a snapshot.
+    """
+    gHandler = cPickle.load(open(pickle_path,'rb'))
+    return save_snapshot(gHandler,snapshot_path)
+
+def snapshot_to_pickle(snapshot_path,pickle_path):
+    """
+    Converts a snapshot back into a ``cPickle`` of its GraphHandler.
+    """
+    gHandler = load_snapshot(snapshot_path,mmap_mode=None)
+    pickle_file = open(pickle_path,'wb')
+    try:
+        cPickle.dump(gHandler,pickle_file,protocol=2)
+    finally:
+        pickle_file.close()
+    return pickle_path
@@ -8,15 +8,103 @@ Code supporting calculations of statistical probabilities for gfunc.
 from decimal import Decimal
 import numpy as np
 import operator as o
+from scipy.special import gammaln
 # see bottom for conditional import of "bestChoose" 
 
 
 
-def basic_bootstrap_est(vec,reps=1000):
+# memory the index/sample matrices of one bootstrap chunk may use
+BOOTSTRAP_CHUNK_BYTES = 64 * 2**20
+
+# filled in by bootstrap() just before its worker processes are forked
+_bootstrap_job = {}
+
+def bootstrap(vec,reducer=np.median,reps=1000,seed=None,chunk_bytes=BOOTSTRAP_CHUNK_BYTES,processes=1):
     """
     *GIVEN:*
         * ``vec`` = vector of sample values
+        * ``reducer`` = function called as ``reducer(samples,axis=1)`` on a 2D array with one
+          resample per row (exp: ``np.median``, ``np.mean``, ``np.std``)
         * ``reps`` = number of resampling reps
+        * ``seed`` = int seed of the random draws (``None`` for a fresh random seed)
+        * ``chunk_bytes`` = memory budget of the resamples drawn at once
+        * ``processes`` = number of worker processes the chunks are spread over
+    
+    *DOES:*
+        * Resamples ``vec`` w/ replacement ``reps`` times by drawing whole index matrices
+          chunk by chunk and applies ``reducer`` to every resample.
+        * Each chunk gets its own seed drawn from ``seed``, so the same ``seed``, ``reps``
+          and ``chunk_bytes`` give the same results whatever ``processes`` is.
+    
+    *RETURNS:*
+        * array of the ``reps`` reduced resamples
+    """
+    vec = np.asarray(vec)
+    sampleSize = len(vec)
+    if sampleSize == 0:
+        raise ValueError("Can not bootstrap an empty vector.")
+    
+    # one chunk holds an int64 index matrix and the matching sample matrix
+    rows_per_chunk = max(1,int(chunk_bytes // (sampleSize * (8 + vec.itemsize))))
+    chunk_rows = [min(rows_per_chunk,reps-start) for start in xrange(0,reps,rows_per_chunk)]
+    chunk_seeds = np.random.RandomState(seed).randint(0,2**31-1,size=len(chunk_rows))
+    chunks = zip(chunk_seeds.tolist(),chunk_rows)
+    
+    _bootstrap_job['vec'] = vec
+    _bootstrap_job['reducer'] = reducer
+    try:
+        if (processes is None or processes > 1) and len(chunks) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_bootstrap_chunk,chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_bootstrap_chunk(chunk) for chunk in chunks]
+    finally:
+        _bootstrap_job.clear()
+    
+    if not results:
+        return np.array([])
+    return np.concatenate(results)
+
+def _bootstrap_chunk(chunk):
+    """
+    Draws and reduces one chunk of ``bootstrap()`` resamples.
+    """
+    chunk_seed,rows = chunk
+    vec = _bootstrap_job['vec']
+    indexes = np.random.RandomState(chunk_seed).randint(0,len(vec),size=(rows,len(vec)))
+    return np.asarray(_bootstrap_job['reducer'](vec[indexes],axis=1))
+
+def bootstrap_est(vec,reducer=np.median,reps=1000,seed=None,processes=1):
+    """
+    *GIVEN:*
+        * same as ``bootstrap()``
+    
+    *RETURNS:*
+        * tuple([*median of resampled statistics*, *SE est*, *loBound*, *hiBound*]) where the
+          bounds are the 95% CI.
+    """
+    reSampled = bootstrap(vec,reducer=reducer,reps=reps,seed=seed,processes=processes)
+    
+    seEstimate = np.std(reSampled,ddof=1)
+    medOfStats = np.median(reSampled)
+    
+    return (medOfStats,
+            seEstimate,
+            np.percentile(reSampled,2.5),
+            np.percentile(reSampled,97.5))
+
+def basic_bootstrap_est(vec,reps=1000,seed=None,processes=1):
+    """
+    *GIVEN:*
+        * ``vec`` = vector of sample values
+        * ``reps`` = number of resampling reps
+        * ``seed`` = int seed of the random draws (``None`` for a fresh random seed)
+        * ``processes`` = number of worker processes (see ``bootstrap()``)
     
     *DOES:*
         * Resample w/ replacement ``reps`` times and record the medians
@@ -29,24 +117,7 @@ def basic_bootstrap_est(vec,reps=1000):
     *RETURNS:*
         * tuple([*median of resampled medians*, *SE est*, *loBound*, *hiBound*])
     """
-    
-    reSampledMeds = []
-    sampleSize = len(vec)
-    
-    for rep in range(reps):
-        sample = []
-        for draw in range(sampleSize):
-            randIndex = np.random.randint(0,sampleSize)
-            sample.append(vec[randIndex])
-        reSampledMeds.append(np.median(sample))
-        
-    seEstimate = np.std(reSampledMeds,ddof=1)
-    medOfMeds = np.median(reSampledMeds)
-    
-    return (medOfMeds,
-            seEstimate,
-            np.percentile(reSampledMeds,2.5),
-            np.percentile(reSampledMeds,97.5))
+    return bootstrap_est(vec,reducer=np.median,reps=reps,seed=seed,processes=processes)
 
 def benjHochFDR(table,pValColumn=-1):
     """
@@ -54,34 +125,60 @@ def benjHochFDR(table,pValColumn=-1):
         * ``table``: 2D list(*hypothesis*,*p-value*) hypothesis could = *geneName* tested for enrichment
         * ``pValColumn``: integer of column index containing the *p-value*.
     *DOES:*
-        * Calculates the Benjamini-Hochberg adjusted *p-values*
+        * Calculates the Benjamini-Hochberg adjusted *p-values* (see ``bh_qvalues()``)
     *RETURNS:*
         * a new version of ``table`` with an extra column added to the end representing the BH corrected *p-values*
     
+    Like before, the *p-value* column is converted to floats in place and ``table`` is
+    sorted (lowest to highest *p-value*) in place.
     """
     assert type(pValColumn) == type(1),\
            "ERROR: pValColumn must be int type!"
-    # Sort table from highest to lowest after converting them all to floats.
     for i in range(len(table)):
         table[i][pValColumn] = float(table[i][pValColumn])
     table.sort(key=lambda x: x[pValColumn])
-    table.reverse()
-    
-    n = len(table)
     
-    lastPval = table[0][pValColumn]
-    for i in range(len(table)):
-        p    = table[i][pValColumn]
-        adj  = (float(n)/(n-i))
-        adjP = p*adj
-        miN  = min(adjP,lastPval)
-        table[i].append(miN)
-        lastPval = table[i][-1]
-    
-    table.reverse()
+    q_vals = bh_qvalues([row[pValColumn] for row in table]).tolist()
+    for row,q in zip(table,q_vals):
+        row.append(q)
     return table
 
-
+def bh_qvalues(p_vals,method='bh',axis=-1):
+    """
+    *GIVEN:*
+        * ``p_vals``: array of *p-values*; with more than one dimension every 1D slice
+          along ``axis`` (exp: one permutation per row) is corrected on its own
+        * ``method``: ``'bh'`` (Benjamini-Hochberg) or ``'by'`` (Benjamini-Yekutieli,
+          valid under any dependence between the tests)
+    *DOES:*
+        * sorts once, scales each *p-value* by ``n/rank`` (times ``sum(1/k)`` for ``'by'``)
+          and takes the cumulative minimum from the largest *p-value* down.
+    *RETURNS:*
+        * float array of *q-values* in the same order/shape as ``p_vals``
+    """
+    p_vals = np.asarray(p_vals,dtype=np.float64)
+    if method not in ('bh','by'):
+        raise ValueError("method must be 'bh' or 'by', not %r." % (method))
+    if p_vals.ndim == 0:
+        p_vals = p_vals.reshape(1)
+    p_vals = np.moveaxis(p_vals,axis,-1)
+    n = p_vals.shape[-1]
+    if n == 0:
+        return np.moveaxis(p_vals.copy(),-1,axis)
+    
+    # largest to smallest; position i of that order has rank n-i
+    order = np.argsort(p_vals,axis=-1,kind='mergesort')[...,::-1]
+    desc = np.take_along_axis(p_vals,order,axis=-1)
+    
+    adj = float(n)/(n-np.arange(n))
+    if method == 'by':
+        adj = adj * (1.0/np.arange(1,n+1)).sum()
+    q_desc = np.minimum.accumulate(desc*adj,axis=-1)
+    np.minimum(q_desc,1.0,out=q_desc)
+    
+    q_vals = np.empty_like(q_desc)
+    np.put_along_axis(q_vals,order,q_desc,axis=-1)
+    return np.moveaxis(q_vals,-1,axis)
 
 
 def binComb(n, k):
@@ -166,6 +263,157 @@ def cumHypergeoP(n,i,m,N):
     return cumPVal
 
 
+# hypergeo_sf() recomputes p-values below this with exact integer arithmetic
+HYPERGEO_EXACT_BELOW = 1e-15
+
+# max number of pmf terms hypergeo_sf() holds in memory at once
+HYPERGEO_CHUNK_TERMS = 2**22
+
+# exact_hypergeo_sf() work budget of one query in hypergeo_sf(): (number of pmf terms) * (n+m).
+# Its big-int time grows faster than that product (~0.02s at 3e7, ~0.15s at 2e8, ~5s at 3e9).
+HYPERGEO_EXACT_MAX_WORK = 2 * 10**8
+
+# log p-values below this come out as 0.0 in float64 however exactly they are computed
+_LOG_FLOAT64_UNDERFLOW = -746.0
+
+def _log_choose(n,k):
+    """
+    Returns log(choose(``n``,``k``)) for float arrays with 0 <= ``k`` <= ``n``.
+    """
+    return gammaln(n+1) - gammaln(k+1) - gammaln(n-k+1)
+
+def log_hypergeoP(n,i,m,N):
+    """
+    Log-gamma version of ``hypergeoP()`` that accepts arrays: returns log(*P(x=i)*)
+    (``-inf`` where *P(x=i)* is 0).
+    """
+    n,i,m,N = [np.asarray(a,dtype=np.float64) for a in np.broadcast_arrays(n,i,m,N)]
+    possible = (i >= 0) & (i <= n) & (N-i >= 0) & (N-i <= m)
+    
+    logP = np.empty(n.shape)
+    logP.fill(-np.inf)
+    with np.errstate(invalid='ignore'):
+        logP[possible] = (_log_choose(n[possible],i[possible])
+                          + _log_choose(m[possible],N[possible]-i[possible])
+                          - _log_choose(n[possible]+m[possible],N[possible]))
+    if logP.ndim == 0:
+        return float(logP)
+    return logP
+
+def log_hypergeo_sf(n,i,m,N):
+    """
+    Returns log(*P(x >= i)*) for arrays of ``(n,i,m,N)`` (see ``cumHypergeoP()``) by summing
+    the log-gamma pmf terms of every query in log space in one vectorized pass.
+    """
+    shape = np.broadcast(n,i,m,N).shape
+    n,i,m,N = [np.asarray(a,dtype=np.int64).ravel() for a in np.broadcast_arrays(n,i,m,N)]
+    
+    # non-zero terms of each query run from lo to hi
+    lo = np.maximum(i,np.maximum(N-m,0))
+    hi = np.minimum(n,N)
+    counts = np.maximum(hi-lo+1,0)
+    
+    log_sf = np.empty(len(n))
+    log_sf.fill(-np.inf)
+    
+    # process queries in chunks holding at most HYPERGEO_CHUNK_TERMS terms
+    ends = np.cumsum(counts)
+    start = 0
+    while start < len(n):
+        stop = max(np.searchsorted(ends,ends[start]-counts[start]+HYPERGEO_CHUNK_TERMS,side='right'),start+1)
+        stop = min(stop,len(n))
+        log_sf[start:stop] = _log_sf_chunk(n[start:stop],m[start:stop],N[start:stop],
+                                           lo[start:stop],counts[start:stop])
+        start = stop
+    
+    # i at or below the support: the whole distribution, exactly 1
+    log_sf[(i <= np.maximum(N-m,0)) & (counts > 0)] = 0.0
+    log_sf = np.minimum(log_sf,0.0)
+    if len(shape) == 0:
+        return float(log_sf[0])
+    return log_sf.reshape(shape)
+
+def _log_sf_chunk(n,m,N,lo,counts):
+    """
+    Returns the log of the summed pmf terms ``lo`` to ``lo+counts-1`` of each query.
+    """
+    offsets = np.zeros(len(n)+1,dtype=np.int64)
+    np.cumsum(counts,out=offsets[1:])
+    owners = np.repeat(np.arange(len(n)),counts)
+    x = np.arange(offsets[-1]) - np.repeat(offsets[:-1]-lo,counts)
+    
+    n_o,m_o,N_o = n[owners].astype(np.float64),m[owners].astype(np.float64),N[owners].astype(np.float64)
+    logP = _log_choose(n_o,x) + _log_choose(m_o,N_o-x) - _log_choose(n_o+m_o,N_o)
+    
+    # log-sum-exp per query
+    has = counts > 0
+    log_sum = np.empty(len(n))
+    log_sum.fill(-np.inf)
+    if has.any():
+        starts = offsets[:-1][has]
+        seg_max = np.maximum.reduceat(logP,starts)
+        seg_sum = np.add.reduceat(np.exp(logP - np.repeat(seg_max,counts[has])),starts)
+        log_sum[has] = seg_max + np.log(seg_sum)
+    return log_sum
+
+def exact_hypergeo_sf(n,i,m,N):
+    """
+    Exact integer arithmetic version of ``cumHypergeoP()``: the pmf numerators are summed
+    as integers and divided once, so it is correct (down to float underflow) even where
+    ``cumHypergeoP()`` loses precision or overflows a float.
+    """
+    lo = max(i,N-m,0)
+    hi = min(n,N)
+    if lo > hi:
+        return 0.0
+    
+    # walk choose(n,x) and choose(m,N-x) with exact integer recurrences
+    n_choose_x = bestChoose(n,lo)
+    m_choose_Nx = bestChoose(m,N-lo)
+    numerator = 0
+    for x in xrange(lo,hi+1):
+        numerator += n_choose_x*m_choose_Nx
+        n_choose_x = n_choose_x*(n-x)//(x+1)
+        m_choose_Nx = m_choose_Nx*(N-x)//(m-N+x+1) if m-N+x+1 > 0 else 0
+    return o.truediv(numerator,bestChoose(n+m,N))
+
+def hypergeo_sf(n,i,m,N,exact_below=HYPERGEO_EXACT_BELOW,exact_max_work=HYPERGEO_EXACT_MAX_WORK):
+    """
+    *GIVEN:*
+        * ``n``, ``i``, ``m``, ``N``: ints or arrays of them as for ``cumHypergeoP()``
+        * ``exact_below``: p-values smaller than this are recomputed with
+          ``exact_hypergeo_sf()`` (``None`` to never do so)
+        * ``exact_max_work``: only queries whose *(number of pmf terms) x (n+m)* is at most
+          this are recomputed (``None`` for no cap)
+    *RETURNS:*
+        * cumulative hypergeometric *p-value* *P(x >= i)* (float or array of floats)
+    
+    The exact fallback runs one Python big-int loop per small p-value and its cost grows
+    faster than *terms x (n+m)*, so without a cap a few genome-scale queries could take
+    minutes each.  Queries over ``exact_max_work`` keep their log-gamma value, as do those
+    so small that the exact value would also underflow to 0.0.
+    """
+    log_p = log_hypergeo_sf(n,i,m,N)
+    p_vals = np.exp(log_p)
+    if exact_below is None:
+        return p_vals
+    
+    scalar = np.ndim(p_vals) == 0
+    flat = np.atleast_1d(p_vals).ravel()
+    redo = (flat < exact_below) & (np.atleast_1d(log_p).ravel() > _LOG_FLOAT64_UNDERFLOW)
+    if not redo.any():
+        return p_vals
+    
+    n,i,m,N = [np.asarray(a,dtype=np.int64).ravel() for a in np.broadcast_arrays(n,i,m,N)]
+    if exact_max_work is not None:
+        terms = np.minimum(n,N) - np.maximum(i,np.maximum(N-m,0)) + 1
+        redo &= terms.astype(np.float64) * (n+m) <= exact_max_work
+    for j in np.flatnonzero(redo):
+        flat[j] = exact_hypergeo_sf(int(n[j]),int(i[j]),int(m[j]),int(N[j]))
+    if scalar:
+        return flat[0]
+    return flat.reshape(p_vals.shape)
+
 def binomialPval(n,k,p):
     """
     *RETURNS:* 
@@ -0,0 +1,121 @@
+"""
+####################
+test_stats.py
+####################
+Accuracy tests of the vectorized ``gfunc.stats.hypergeo_sf()`` against the exact integer
+``gfunc.stats.exact_hypergeo_sf()``::
+
+    python -m unittest discover -s tests
+"""
+import unittest
+from fractions import Fraction
+
+import numpy as np
+
+from gfunc.stats import choose
+from gfunc.stats import exact_hypergeo_sf
+from gfunc.stats import hypergeo_sf
+from gfunc.stats import HYPERGEO_EXACT_BELOW
+
+# log-gamma p-values agree with the exact ones to about 1e-10 (relative)
+RTOL = 1e-9
+
+
+def fraction_sf(n,i,m,N):
+    """
+    Returns *P(x >= i)* summed as a ``Fraction``: the reference for small queries.
+    """
+    return sum([Fraction(choose(n,x)*choose(m,N-x),choose(n+m,N)) for x in range(max(i,0),min(n,N)+1)])
+
+def random_queries(count,population,seed=0):
+    """
+    Returns int array of ``count`` random ``(n,i,m,N)`` rows with ``n+m <= population``.
+    """
+    rand = np.random.RandomState(seed)
+    queries = []
+    for q in range(count):
+        total = rand.randint(2,population+1)
+        n = rand.randint(0,total+1)
+        N = rand.randint(0,total+1)
+        i = rand.randint(0,min(n,N)+2)
+        queries.append((n,i,total-n,N))
+    return np.array(queries,dtype=np.int64)
+
+def exact_values(queries):
+    """
+    Returns array of ``exact_hypergeo_sf()`` of each ``(n,i,m,N)`` row.
+    """
+    return np.array([exact_hypergeo_sf(*[int(x) for x in q]) for q in queries])
+
+
+class ExactHypergeoSfTests(unittest.TestCase):
+    
+    def test_matches_fractions_on_small_grid(self):
+        for n in range(0,7):
+            for m in range(0,7):
+                for N in range(0,n+m+1):
+                    for i in range(0,min(n,N)+2):
+                        self.assertEqual(exact_hypergeo_sf(n,i,m,N),float(fraction_sf(n,i,m,N)))
+
+
+class HypergeoSfTests(unittest.TestCase):
+    
+    def check_close(self,approx,exact):
+        representable = exact > 1e-300
+        rel_err = np.abs(approx[representable]-exact[representable]) / exact[representable]
+        self.assertTrue(rel_err.max() < RTOL,"max relative error %g" % (rel_err.max()))
+        # values that underflow exactly must come out as (nearly) 0 too
+        self.assertTrue((approx[~representable] < 1e-290).all())
+    
+    def check_fallback(self,queries,exact):
+        n,i,m,N = queries.T
+        with_fallback = hypergeo_sf(n,i,m,N)
+        self.check_close(with_fallback,exact)
+        # everything the fallback recomputed is exact
+        tiny = (exact < HYPERGEO_EXACT_BELOW) & (exact > 0)
+        self.assertTrue(tiny.any())
+        np.testing.assert_array_equal(with_fallback[tiny],exact[tiny])
+    
+    def test_small_queries(self):
+        queries = np.array([(n,i,m,N) for n in range(0,12) for m in range(0,12)
+                            for N in range(0,n+m+1) for i in range(0,min(n,N)+2)],dtype=np.int64)
+        exact = exact_values(queries)
+        n,i,m,N = queries.T
+        self.check_close(hypergeo_sf(n,i,m,N,exact_below=None),exact)
+    
+    def test_large_queries(self):
+        queries = random_queries(60,20000)
+        exact = exact_values(queries)
+        n,i,m,N = queries.T
+        self.check_close(hypergeo_sf(n,i,m,N,exact_below=None),exact)
+        self.check_fallback(queries,exact)
+    
+    def test_tiny_and_underflowing_queries(self):
+        # strongly enriched samples: p-values from ~1e-20 down to far below float range
+        queries = np.array([(n,i,m,N) for n,m,N in [(50,950,60),(200,19800,300),(2000,18000,2500)]
+                            for i in np.linspace(N//4,min(n,N),8).astype(int)],dtype=np.int64)
+        exact = exact_values(queries)
+        self.assertTrue((exact == 0).any() and (exact > 0).any())
+        n,i,m,N = queries.T
+        self.check_close(hypergeo_sf(n,i,m,N,exact_below=None),exact)
+        self.check_fallback(queries,exact)
+    
+    def test_work_cap_keeps_log_gamma_values(self):
+        queries = random_queries(100,5000,seed=1)
+        n,i,m,N = queries.T
+        np.testing.assert_array_equal(hypergeo_sf(n,i,m,N,exact_max_work=0),
+                                      hypergeo_sf(n,i,m,N,exact_below=None))
+    
+    def test_scalar_queries(self):
+        for q in [(10,3,30,12),(50,40,950,60),(3,5,4,4)]:
+            value = hypergeo_sf(*q)
+            self.assertEqual(np.ndim(value),0)
+            exact = exact_hypergeo_sf(*q)
+            if exact < HYPERGEO_EXACT_BELOW:
+                self.assertEqual(value,exact)
+            else:
+                self.assertTrue(abs(value-exact) <= RTOL*exact)
+
+
+if __name__ == '__main__':
+    unittest.main()